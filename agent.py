@@ -1,14 +1,16 @@
 import mesa
-import importlib
 
-import user_logic
+from compact_agents import AgentView
+from policy_registry import registry
 from policyblocks import (WealthExchange, Fascism, Capitalism, Communism)
 from utilities import calculate_bartholomew_mobility
 
 class WealthAgent(mesa.Agent):
     
-    def __init__(self,model, proportion,innovation,party_elite):
+    def __init__(self,model, proportion,innovation,party_elite, index=0):
         super().__init__(model)
+        # Position in the model's population arrays (exchange buffer, flows)
+        self.index = index
         self.wealth=1
         self.party_elite = party_elite
         self.bracket = "Middle"
@@ -18,24 +20,15 @@ class WealthAgent(mesa.Agent):
         self.W = proportion
         self.I = innovation
         self.innovating = False
-        # Exchange tracking: UIDs this agent paid money to this step.
-        # Cleared at the start of each step's WealthExchange call so the
-        # /api/data/exchanges endpoint always reflects the latest step.
-        self.last_paid_uids = []
-        self.last_paid_amounts = []
 
 
     def step(self):
-        
-        try:
-            importlib.reload(user_logic)
-        except Exception:
-            pass 
 
-        # 2. Check if Custom Logic is Active
-        if getattr(user_logic, 'HAS_CUSTOM_LOGIC', False):
+        # Check if Custom Logic is Active (set through the policy registry)
+        custom_step = registry.step_logic
+        if custom_step is not None:
             # --- USE CUSTOM BLOCKLY LOGIC ---
-            user_logic.step(self)
+            custom_step(self)
 
         else:
             # Update bracket 
@@ -72,4 +65,13 @@ class WealthAgent(mesa.Agent):
             # Calculate Bartholomew mobility ratio
             self.mobility = calculate_bartholomew_mobility(self)
 
-    
+
+class CompactWealthAgent(AgentView):
+    '''
+    WealthAgent backed by a row of the model's AgentTable (compact_agents.py),
+    used for large populations. Same attributes and step logic.
+    '''
+
+    __slots__ = ()
+
+    step = WealthAgent.step
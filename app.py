@@ -1,81 +1,80 @@
-from flask import Flask, jsonify, request, send_from_directory, Response
-from flask_cors import CORS
-import json
-import numpy as np
-import threading
-import time
-import logging
-import os
-import re
-import traceback
-
-from dotenv import load_dotenv
-load_dotenv()
-
-import google.genai as genai
-from google.genai import types
+import startup
+
+with startup.phase("import flask + numpy"):
+    from flask import Flask, jsonify, request, Response
+    from flask_cors import CORS
+    import json
+    import numpy as np
+    import time
+    import logging
+    import os
+    import traceback
+
+    from dotenv import load_dotenv
+    load_dotenv()
 
 # --- Model Imports ---
-from model import WealthModel, compute_gini, total_wealth
+# The simulation stack (mesa, which pulls in pandas and scipy) and google.genai
+# are imported on first use or by the startup preload thread, not here.
+with startup.phase("import policy subsystems"):
+    import chat_tasks
+    import sim_daemon
+
+with startup.phase("import static assets + explainers"):
+    import assets
+    from explanatory.econophysics import econophysics
+    from explanatory.communism import communism
+    from explanatory.fascism import fascism
+    from explanatory.capitalism import capitalism
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__, static_folder='docs', static_url_path='')
+# Static files go through assets.send (precompressed, ETag, Range, cache headers)
+app = Flask(__name__, static_folder=None)
 CORS(app, origins=['*'])
+app.jinja_env.globals['asset_url'] = assets.url
+for explainer in (econophysics, communism, fascism, capitalism):
+    app.register_blueprint(explainer, url_prefix=f'/explain/{explainer.name}')
 
 # --- Global State ---
-current_model = None
-model_lock = threading.Lock()
-gemini_client = None
+# The model, policy registry, active policy and job queue live in
+# sim_daemon.backend(): this process, or the shared daemon (SIM_DAEMON_SOCKET),
+# as do the chat tasks and their Gemini client
 
 # --- Constants ---
-CUSTOM_POLICIES_FILE = 'custom_policies.py'
-USER_LOGIC_FILE = 'user_logic.py'
 USER_BLOCKS_FILE = 'blockly/user_blocks.js'
+# "lazy": build the default model in a background thread and create the Gemini
+# client on the first /api/chat. "eager": do both before serving.
+STARTUP_MODE = os.environ.get('STARTUP_MODE', 'lazy')
 
-class NumpyEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, np.ndarray): return obj.tolist()
-        if isinstance(obj, np.integer): return int(obj)
-        if isinstance(obj, np.floating): return float(obj)
-        return super().default(obj)
+NumpyEncoder = sim_daemon.NumpyEncoder
 
 def json_response(data):
     return Response(json.dumps(data, cls=NumpyEncoder), mimetype='application/json')
 
-# --- Gemini Initialization ---
-def init_gemini():
-    """Initializes Google Gen AI Client"""
-    global gemini_client
-    api_key = os.environ.get("GOOGLE_API_KEY")
-    
-    if not api_key:
-        logging.warning("GOOGLE_API_KEY not found. Chat will not work.")
-        return
-
+def simulate(command, **args):
+    """Runs a sim_daemon command and returns its JSON body as the response"""
     try:
-        logging.info("Initializing Google Gen AI Client...")
-        gemini_client = genai.Client(api_key=api_key)
-        logging.info("Gemini Client Loaded Successfully.")
-    except Exception as e:
-        logging.exception(f"Warning: Failed to load Gemini Client. Error: {e}")
+        status, body = sim_daemon.backend().call(command, **args)
+    except sim_daemon.DaemonUnavailable as e:
+        logger.error(str(e))
+        return jsonify({'error': str(e)}), 503
+    return Response(body, status=status, mimetype='application/json')
 
 # --- Helper to Reset Logic ---
+def reset_user_blocks():
+    with open(USER_BLOCKS_FILE, 'w') as f:
+        f.write("// User generated blocks will be saved here\n\n")
+
 def reset_logic_internal():
-    """Resets user_logic.py, custom_policies.py, and user_blocks.js to default"""
+    """Clears the policy registry (custom policies + agent logic) and resets user_blocks.js"""
     try:
-        default_content = "HAS_CUSTOM_LOGIC = False\n\ndef step(self):\n    pass\n"
-        with open(USER_LOGIC_FILE, 'w') as f:
-            f.write(default_content)
-        
-        with open(CUSTOM_POLICIES_FILE, 'w') as f:
-            f.write("# Custom user-generated policies will be appended here\n\n")
-
-        with open(USER_BLOCKS_FILE, 'w') as f:
-            f.write("// User generated blocks will be saved here\n\n")
-            
+        status, body = sim_daemon.backend().call('reset_code')
+        if status != 200:
+            raise RuntimeError(body.decode())
+        reset_user_blocks()
         logger.info("Logic, Custom Policies, and User Blocks reset to default.")
         return True
     except Exception as e:
@@ -83,217 +82,268 @@ def reset_logic_internal():
         return False
 
 # --- Simulation Setup Function ---
+def preload_default_model():
+    """Imports the simulation stack and builds the default model (the daemon preloads its own)"""
+    if sim_daemon.SOCKET_PATH:
+        return
+    sim_daemon.backend().preload()
+    print("Default WealthModel initialized.")
+
+def start_preload():
+    if sim_daemon.SOCKET_PATH:
+        return None
+    return startup.in_background("preload-default-model", preload_default_model)
+
 def setup_simulation():
     """Forces a clean state for the simulation on startup"""
-    global current_model
-    
     print("--- PERFORMING SYSTEM RESET ---")
     reset_logic_internal()
     
-    if not os.path.exists(CUSTOM_POLICIES_FILE):
-        with open(CUSTOM_POLICIES_FILE, 'w') as f: f.write("# Init\n")
     if not os.path.exists(USER_BLOCKS_FILE):
         with open(USER_BLOCKS_FILE, 'w') as f: f.write("// Init\n")
 
-    with model_lock:
-        current_model = WealthModel()
-        print("Default WealthModel initialized.")
-    
-    init_gemini()
+    if STARTUP_MODE == 'eager':
+        preload_default_model()
+        if not sim_daemon.SOCKET_PATH:
+            chat_tasks.get_client()
+    else:
+        start_preload()
 
 # --- Standard Routes ---
 @app.route('/')
-def landing(): return send_from_directory('docs', 'index.html')
+def landing(): return assets.send('docs', 'index.html')
 
 @app.route('/simulator')
-def simulator(): return send_from_directory('docs', 'landing.html')
+def simulator(): return assets.send('docs', 'landing.html')
 
 @app.route('/<path:filename>')
-def static_files(filename): return send_from_directory('docs', filename)
+def static_files(filename): return assets.send('docs', filename)
 
 @app.route('/blockly/')
-def blockly_home(): return send_from_directory('blockly', 'index.html')
+def blockly_home(): return assets.send('blockly', 'index.html')
 
 @app.route('/blockly/<path:filename>')
-def blockly_files(filename): return send_from_directory('blockly', filename)
+def blockly_files(filename): return assets.send('blockly', filename)
 
-@app.route('/explain/<name>')
-def explain_template(name):
-    if name == 'econophysics': return send_from_directory('explanatory/templates', 'index.html')
-    return send_from_directory('explanatory/templates', f'{name}.html')
+# Explainer pages are blueprints (explanatory/*.py) mounted at /explain/<name>
 
 @app.route('/css/<path:filename>')
-def explain_css(filename): return send_from_directory('explanatory/static/css', filename)
+def explain_css(filename): return assets.send('explain', f'css/{filename}')
 
 @app.route('/js/<path:filename>')
-def explain_js(filename): return send_from_directory('explanatory/static/js', filename)
+def explain_js(filename): return assets.send('explain', f'js/{filename}')
 
 @app.route('/static/assets/<path:filename>')
-def explain_assets(filename): return send_from_directory('explanatory/static/assets', filename)
+def explain_assets(filename): return assets.send('explain', f'assets/{filename}')
+
+@app.route('/hashed/<digest>/<root>/<path:filename>')
+def hashed_asset(digest, root, filename):
+    """Content-hashed URL from assets.url(); immutable while the hash matches"""
+    return assets.send(root, filename, digest=digest)
 
 # --- API Endpoints ---
 
 # Active policy: set by the Blockly editor whenever the user clicks
 # "Update Agent Logic". The frontend reads this to display the current policy.
-_active_policy = 'econophysics'
-
 @app.route('/api/set_active_policy', methods=['POST'])
 def set_active_policy():
-    global _active_policy
     data = request.get_json(silent=True) or {}
-    policy = str(data.get('policy', 'econophysics')).strip()
-    if policy:
-        _active_policy = policy
-    return jsonify({'status': 'success', 'policy': _active_policy})
+    return simulate('set_active_policy', policy=str(data.get('policy', 'econophysics')))
 
 @app.route('/api/get_active_policy', methods=['GET'])
 def get_active_policy():
-    return jsonify({'policy': _active_policy})
+    return simulate('get_active_policy')
 
 @app.route('/api/system_reset', methods=['POST'])
 def system_reset():
-    reset_logic_internal()
-    global current_model
-    with model_lock:
-        current_model = None
-    return jsonify({'status': 'success', 'message': 'System reset complete'})
+    response = simulate('system_reset')
+    reset_user_blocks()
+    return response
 
 @app.route('/api/initialize', methods=['POST'])
 def initialize_model():
-    global current_model
     data = request.get_json(silent=True) or {}
-    policy = str(data.get('policy', 'econophysics'))
-    population = int(data.get('population', 200))
-    start_up_required = int(data.get('start_up_required', 1))
-    patron = bool(data.get('patron', False))
-
-    with model_lock:
-        current_model = WealthModel(
-            policy=policy,
-            population=population,
-            start_up_required=start_up_required,
-            patron=patron,
-            rng=42,
-        )
-    return jsonify({'status': 'initialized', 'policy': policy}), 200
+    # statistics: "exact" or "approximate" (sketch-based brackets and Gini); None = SIM_STATISTICS
+    # network: exchange topology, e.g. "small_world" or {"kind": "ring", "degree": 4}
+    # replay: keep keyframes and control events so /api/data/at_step can rebuild any step
+    # initial_state: "fresh" (everyone at wealth 1) or "equilibrium" (a burned-in population)
+    fields = ('policy', 'population', 'start_up_required', 'patron', 'statistics', 'network', 'replay',
+              'initial_state')
+    return simulate('initialize', **{name: data[name] for name in fields if name in data})
 
 @app.route('/api/step', methods=['POST'])
 def step_model():
-    global current_model
-    if current_model is None: return jsonify({'error': 'Model not initialized'}), 400
-    try:
-        with model_lock:
-            current_model.step()
-            # datacollector.collect is already called inside WealthModel.step(),
-            # so we do NOT call it again here to avoid duplicate rows.
-        return jsonify({'status': 'success'})
-    except Exception as e:
-        import traceback
-        logger.error("Exception in step_model:\n" + traceback.format_exc())
-        return jsonify({'error': str(e), 'traceback': traceback.format_exc()}), 500
+    # ?n= (or {"n": ...}) runs several steps in one request
+    data = request.get_json(silent=True) or {}
+    return simulate('step', n=request.args.get('n', data.get('n', 1)))
+
+@app.route('/api/run_until_converged', methods=['POST'])
+def run_until_converged():
+    """Steps until Gini, growth and mobility stop drifting, or max_steps; reports the converged step"""
+    data = request.get_json(silent=True) or {}
+    fields = ('max_steps', 'window', 'tolerance', 'test')
+    return simulate('run_until_converged', **{name: data[name] for name in fields if name in data})
 
+@app.route('/api/control', methods=['POST'])
+def control_model():
+    """Changes policy, patron or start_up_required of the current run from its next step on"""
+    data = request.get_json(silent=True) or {}
+    fields = ('policy', 'patron', 'start_up_required')
+    return simulate('control', **{name: data[name] for name in fields if name in data})
+
+# --- Replay (replay.py): any past step of the current run ---
+@app.route('/api/data/at_step/<int:step>', methods=['GET'])
+def data_at_step(step):
+    """Metrics, wealth, brackets, mobility and exchanges at step, rebuilt from the nearest keyframe"""
+    return simulate('at_step', step=step)
+
+@app.route('/api/replay', methods=['GET'])
+def replay_log():
+    return simulate('replay_log')
+
+# --- Background jobs (jobs.py): long runs and sweeps outside the request workers ---
+@app.route('/api/jobs', methods=['POST'])
+def submit_job():
+    """Queues a 'run' (one configuration) or 'sweep' (a list of configs); poll /api/jobs/<id>"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Expected a JSON object'}), 400
+    return simulate('submit_job', **data)
+
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    return simulate('list_jobs')
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    return simulate('get_job', job_id=job_id)
+
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    return simulate('get_job_result', job_id=job_id)
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    return simulate('cancel_job', job_id=job_id)
+
+# --- What-if branches (branches.py): fork the running model and continue under other settings ---
+@app.route('/api/branches', methods=['POST'])
+def fork_branch():
+    """Forks the current run (or the branch named by parent) at its current step; optional policy, patron, start_up_required"""
+    data = request.get_json(silent=True) or {}
+    fields = ('parent', 'name', 'policy', 'patron', 'start_up_required')
+    return simulate('fork', **{name: data[name] for name in fields if name in data})
+
+@app.route('/api/branches', methods=['GET'])
+def list_branches():
+    return simulate('list_branches')
+
+@app.route('/api/branches/compare', methods=['GET'])
+def compare_branches():
+    """?series=Gini|Total|Mobility for the current run and every branch (or ?ids=b1,b2)"""
+    ids = request.args.get('ids')
+    return simulate('compare_branches', series=request.args.get('series', 'Gini'),
+                    ids=ids.split(',') if ids else None)
+
+@app.route('/api/branches/<branch_id>/step', methods=['POST'])
+def step_branch(branch_id):
+    data = request.get_json(silent=True) or {}
+    return simulate('step_branch', branch_id=branch_id, steps=data.get('steps', 1))
+
+@app.route('/api/branches/<branch_id>', methods=['DELETE'])
+def delete_branch(branch_id):
+    return simulate('delete_branch', branch_id=branch_id)
+
+# --- Export (export.py): run history streamed in chunks as CSV or Arrow IPC ---
+@app.route('/api/export/<table>', methods=['GET'])
+def export_run(table):
+    '''
+    table: model (per-step metrics) or agents (per-agent rows). Query:
+    format=csv|arrow, columns=a,b, start/stop (inclusive steps), every
+    (step stride), sample (agent stride), branch=<id>, policy= (comparison)
+    '''
+    import export   # pyarrow is only loaded by the first export
+    args = {name: request.args[name] for name in ('format', 'start', 'stop', 'every', 'sample', 'branch', 'policy')
+            if name in request.args}
+    if 'columns' in request.args:
+        args['columns'] = request.args['columns'].split(',')
+    try:
+        status, body = sim_daemon.backend().call('export_plan', table=table, **args)
+    except sim_daemon.DaemonUnavailable as e:
+        return jsonify({'error': str(e)}), 503
+    if status != 200:
+        return Response(body, status=status, mimetype='application/json')
+    plan = json.loads(body)
+
+    def chunks():
+        backend = sim_daemon.backend()
+        for index in range(plan['chunks']):
+            status, data = backend.call('export_chunk', plan=plan, index=index)
+            if status != 200:
+                # Headers are already sent; a truncated file is the only signal left
+                logger.warning(f"Export stopped at chunk {index}: {data.decode(errors='replace')}")
+                return
+            yield data
+
+    name = plan['branch'] or plan['policy'] or plan['run_policy']
+    extension = 'csv' if plan['format'] == 'csv' else 'arrows'
+    return Response(chunks(), mimetype=export.MIMETYPES[plan['format']], headers={
+        'Content-Disposition': f'attachment; filename="{name}-{table}.{extension}"'})
+
+# --- Data series; in comparison mode keyed by policy, otherwise under 'current' ---
 @app.route('/api/data/wealth-distribution', methods=['GET'])
 def get_wealth_distribution():
-    global current_model
-    if current_model is None: return jsonify({'error': 'Model not initialized'}), 400
-    with model_lock:
-        if current_model.policy == "comparison":
-            return json_response({
-                policy: data['final_wealth'] 
-                for policy, data in current_model.comparison_results.items()
-            })
-        else:
-            wealth_vals = [agent.wealth for agent in current_model.agents]
-            return json_response({'current': wealth_vals})
+    return simulate('data', kind='wealth-distribution')
 
 @app.route('/api/data/mobility', methods=['GET'])
 def get_mobility_data():
-    global current_model
-    if current_model is None: return jsonify({'error': 'Model not initialized'}), 400
-    with model_lock:
-        if current_model.policy == "comparison":
-            comparison_data = {}
-            for policy, sub_model in current_model.comparison_models.items():
-                agents_data = []
-                for agent in sub_model.agents:
-                    agents_data.append({
-                        'bracket': agent.bracket,
-                        'mobility': agent.mobility,
-                        'wealth': agent.wealth,
-                        'policy': policy
-                    })
-                comparison_data[policy] = agents_data
-            return json_response(comparison_data)
-        else:
-            agents_data = []
-            for agent in current_model.agents:
-                agents_data.append({
-                    'bracket': agent.bracket,
-                    'mobility': agent.mobility,
-                    'wealth': agent.wealth,
-                    'policy': current_model.policy
-                })
-            return json_response(agents_data)
+    return simulate('data', kind='mobility')
 
 @app.route('/api/data/gini', methods=['GET'])
 def get_gini_data():
-    global current_model
-    if current_model is None: return jsonify({'error': 'Model not initialized'}), 400
-    with model_lock:
-        if current_model.policy == "comparison":
-            return json_response({
-                policy: data['gini'] 
-                for policy, data in current_model.comparison_results.items()
-            })
-        else:
-            model_data = current_model.datacollector.get_model_vars_dataframe()
-            gini_data = model_data['Gini'].tolist() if 'Gini' in model_data.columns else []
-            return json_response({'current': gini_data})
+    return simulate('data', kind='gini')
 
 @app.route('/api/data/total-wealth', methods=['GET'])
 def get_total_wealth_data():
-    global current_model
-    if current_model is None: return jsonify({'error': 'Model not initialized'}), 400
-    with model_lock:
-        if current_model.policy == "comparison":
-            return json_response({
-                policy: data['total'] 
-                for policy, data in current_model.comparison_results.items()
-            })
-        else:
-            model_data = current_model.datacollector.get_model_vars_dataframe()
-            total_data = model_data['Total'].tolist() if 'Total' in model_data.columns else []
-            return json_response({'current': total_data})
+    return simulate('data', kind='total-wealth')
+
+@app.route('/api/data/transitions', methods=['GET'])
+def get_transitions():
+    """Per-step 3x3 bracket transition matrices, plus churn and up/down flows over the last ?window= steps"""
+    return simulate('data', kind='transitions', window=request.args.get('window', 20, type=int))
 
 @app.route('/api/data/exchanges', methods=['GET'])
 def get_exchanges():
-    global current_model
-    if current_model is None: return jsonify({'error': 'Model not initialized'}), 400
-    with model_lock:
-        edges = []
-        if current_model.policy == "comparison":
-            for sub_model in current_model.comparison_models.values():
-                for agent in sub_model.agents:
-                    uids = getattr(agent, 'last_paid_uids', [])
-                    amounts = getattr(agent, 'last_paid_amounts', [])
-                    for k, paid_uid in enumerate(uids):
-                        amt = amounts[k] if k < len(amounts) else 0
-                        edges.append([agent.unique_id, paid_uid, amt])
-        else:
-            for agent in current_model.agents:
-                uids = getattr(agent, 'last_paid_uids', [])
-                amounts = getattr(agent, 'last_paid_amounts', [])
-                for k, paid_uid in enumerate(uids):
-                    amt = amounts[k] if k < len(amounts) else 0
-                    edges.append([agent.unique_id, paid_uid, amt])
-        return json_response({'edges': edges})
+    return simulate('data', kind='exchanges')
+
+@app.route('/api/data/flows', methods=['GET'])
+def get_flows():
+    """Rolling money-flow aggregate: bracket matrix, totals by kind, top-k payers/receivers"""
+    return simulate('data', kind='flows', top_k=request.args.get('top_k', 10, type=int))
+
+@app.route('/api/startup', methods=['GET'])
+def get_startup_report():
+    """Cold-start breakdown: time spent in each import / initialization phase"""
+    return jsonify(startup.report())
+
+@app.route('/api/server_stats', methods=['GET'])
+def get_server_stats():
+    """Simulation lock wait and CPU time, plus this web process's CPU time (read by loadtest.py)"""
+    try:
+        status, body = sim_daemon.backend().call('server_stats')
+    except sim_daemon.DaemonUnavailable as e:
+        return jsonify({'error': str(e)}), 503
+    return jsonify({'simulation': json.loads(body),
+                    'web': {'pid': os.getpid(), 'cpu_s': round(time.process_time(), 3)}})
+
+@app.route('/api/memory', methods=['GET'])
+def get_memory():
+    """Accounted and measured memory of the current run and branches, against SIM_MEMORY_BUDGET_MB"""
+    return simulate('memory_usage')
 
 @app.route('/api/status', methods=['GET'])
 def get_status():
-    global current_model
-    if current_model is None: return jsonify({'initialized': False})
-    with model_lock:
-        return json_response({'initialized': True, 'policy': current_model.policy})
+    return simulate('status')
 
 @app.route('/api/reset_code', methods=['POST'])
 def reset_code():
@@ -303,32 +353,18 @@ def reset_code():
 
 @app.route('/api/add_custom_policy', methods=['POST'])
 def add_custom_policy():
-    try:
-        data = request.get_json()
-        python_code = data.get('code', '')
-        if not python_code: return jsonify({'error': 'No code provided'}), 400
-        with open(CUSTOM_POLICIES_FILE, 'a') as f:
-            f.write("\n\n" + python_code + "\n")
-        return jsonify({'status': 'success', 'message': 'Policy added.'})
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    data = request.get_json(silent=True) or {}
+    return simulate('add_custom_policy', code=data.get('code', ''))
 
 @app.route('/api/update_code', methods=['POST'])
 def update_code():
-    try:
-        data = request.get_json()
-        raw_code = data.get('code')
-        file_content = (
-            "HAS_CUSTOM_LOGIC = True\n\n"
-            "from policyblocks import *\n"
-            "from utilities import *\n"
-            "try:\n    from custom_policies import *\nexcept ImportError:\n    pass\n\n" + raw_code
-        )
-        with open(USER_LOGIC_FILE, 'w') as f:
-            f.write(file_content)
-        return jsonify({'status': 'success', 'message': 'Logic updated!'})
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    data = request.get_json(silent=True) or {}
+    return simulate('update_code', code=data.get('code'))
+
+@app.route('/api/policies', methods=['GET'])
+def list_policies():
+    """Registered custom policies and the active agent logic, with content hashes"""
+    return simulate('policies')
     
 @app.route('/api/save_block_definition', methods=['POST'])
 def save_block_definition():
@@ -349,203 +385,31 @@ def save_block_definition():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-# --- VALIDATION LOGIC ---
-class MockModel:
-    def __init__(self):
-        # Match attributes from WealthModel in model.py
-        self.agents = []
-        self.survival_cost = 1.0
-        self.policy = "custom"
-        self.population = 10
-        self.brackets = [10, 20]
-        self.start_up_required = 1
-        self.patron = False
-        self.total = 1000.0
-        self.comparison_results = {}
-        # Mock DataCollector
-        self.datacollector = type('MockDataCollector', (), {'collect': lambda s, m: None})()
-
-class MockAgent:
-    def __init__(self, model):
-        # Match attributes from WealthAgent
-        self.wealth = 10.0
-        self.W = 0.2
-        self.I = 1.0 # Innovation
-        self.model = model
-        self.unique_id = 1
-        self.bracket = "Middle"
-        self.bracket_history = []
-        self.party_elite = False
-        self.mobility = 0
-
-def validate_policy_code(code_str):
-    """
-    Tries to compile and execute the generated code in a mock environment.
-    Returns (success: bool, message: str)
-    """
-    try:
-        # 1. Syntax Check
-        compile(code_str, '<string>', 'exec')
-        
-        # 2. Runtime Check (Safe Execution)
-        local_scope = {}
-        exec(code_str, {'np': np, 'random': np.random}, local_scope)
-        
-        # Find the class definition
-        policy_class = None
-        for name, val in local_scope.items():
-            if isinstance(val, type):
-                policy_class = val
-                break
-        
-        if not policy_class:
-            return False, "Code executed but no class definition was found."
-
-        # 3. Execution Check
-        mock_model = MockModel()
-        mock_agent = MockAgent(mock_model)
-        mock_model.agents.append(mock_agent)
-        
-        instance = policy_class()
-        
-        # Try running it
-        if not hasattr(instance, 'execute'):
-            return False, f"Class '{policy_class.__name__}' missing 'execute' method."
-            
-        try:
-            instance.execute(mock_agent, mock_model)
-        except TypeError:
-            instance.execute(mock_agent)
-            
-        return True, "Verified: Code compiled and ran successfully in test environment."
-        
-    except Exception as e:
-        tb = traceback.format_exc()
-        
-        # --- IMPROVED ERROR REPORTING FOR AI ---
-        # If it's an attribute error, list what IS available so the AI can fix it.
-        error_msg = f"{type(e).__name__}: {str(e)}"
-        
-        if isinstance(e, AttributeError):
-            # Create fresh mocks to inspect attributes
-            m_attrs = [k for k in MockModel().__dict__.keys() if not k.startswith('_')]
-            a_attrs = [k for k in MockAgent(MockModel()).__dict__.keys() if not k.startswith('_')]
-            
-            error_msg += f"\n[HINT] Available Model attributes: {m_attrs}"
-            error_msg += f"\n[HINT] Available Agent attributes: {a_attrs}"
-            error_msg += "\nPlease check your variable names."
-
-        return False, error_msg
-
-def sanitize_ai_response(json_text):
-    try:
-        clean_text = re.sub(r'^```json\s*|```\s*$', '', json_text.strip(), flags=re.MULTILINE)
-        data = json.loads(clean_text)
-        
-        if 'python_code' in data:
-            if 'model.schedule.agents' in data['python_code']:
-                data['python_code'] = data['python_code'].replace('model.schedule.agents', 'model.agents')
-
-        if 'block_generator' in data:
-            gen_code = data['block_generator']
-            if re.search(r'\.execute\(\s*self\s*,\s*model\s*\)', gen_code):
-                data['block_generator'] = re.sub(
-                    r'\.execute\(\s*self\s*,\s*model\s*\)', 
-                    '.execute(self, self.model)', 
-                    gen_code
-                )
-
-        # Ensure description is always a non-empty string
-        desc = data.get('description', '')
-        if not isinstance(desc, str) or not desc.strip():
-            print("WARNING: AI response missing 'description' field.")
-            data['description'] = ''
-        else:
-            print(f"AI description present ({len(desc)} chars): {desc[:80]}...")
-
-        return data
-    except Exception as e:
-        print(f"Sanitization Warning: {e}")
-        return None
-
+# --- AI policy generation (chat_tasks.py): runs in the background, the editor polls ---
 @app.route('/api/chat', methods=['POST'])
 def chat_endpoint():
-    global gemini_client
-    if gemini_client is None: 
-        try: 
-            logging.info("Initializing Gemini")
-            init_gemini()
-        except: 
-            return jsonify({'error': 'Gemini not initialized'}), 503
-    
-    data = request.get_json()
-    user_query = data.get('message', '')
-    
-    # SYSTEM PROMPT
-    base_prompt = (
-        "You are a Policy Generator for a Mesa Agent simulation (Mesa 3.0+). "
-        "Convert the user's idea into a Python class and a Blockly block definition.\n\n"
-
-        "### CODING RULES (CRITICAL) ###\n"
-        "1. **MESA 3.0 COMPATIBILITY**: `model.schedule.agents` DOES NOT EXIST. Use `model.agents` (it is a list).\n"
-        "2. **SCOPE SAFETY**: This code runs inside `Agent.step(self)`. The variable `model` is NOT global. You MUST use `self.model`.\n"
-        "3. **GENERATOR**: In the block generator, pass `self.model` to your class. Ex: `MyPol().execute(self, self.model)`.\n"
-        "4. **ATTRIBUTES**: Verify attributes exist. The model has `survival_cost` (NOT survival_amount or threshold).\n\n"
-
-        "### OUTPUT FORMAT (Strict JSON) ###\n"
-        "Return a single JSON object with ALL four of these fields:\n"
-        "{\n"
-        '  "description": "A plain-English, numbered step-by-step explanation of exactly what this policy does during each simulation step. Each numbered step should be one sentence describing one action. Example: \'1. Every agent pays 10% of their wealth as tax. 2. The collected tax is pooled together. 3. The pool is divided equally among agents below the survival threshold.\'",\n'
-        '  "python_code": "class MyPolicy:\\n    def execute(self, agent, model):\\n        # logic",\n'
-        '  "block_json": { "type": "my_policy", "message0": "Execute My Policy", "previousStatement": null, "nextStatement": null, "colour": 0 },\n'
-        '  "block_generator": "Blockly.Python.forBlock[\'my_policy\'] = function(block) { return \'MyPolicy().execute(self, self.model)\\n\'; };"\n'
-        "}\n\n"
-        "The `description` field is REQUIRED and must be a numbered list explaining the policy mechanics "
-        "in plain language that a non-programmer can understand. Do not use code or technical jargon in the description.\n"
-    )
-
-    current_prompt = base_prompt + f"\nUser Idea: {user_query}"
-    
-    max_retries = 3
-    status_log = []
-    final_response = None
-    
-    for attempt in range(max_retries):
-        status_log.append(f"Phase 1 (Attempt {attempt+1}): Generating Code...")
-        try:
-            response = gemini_client.models.generate_content(
-                model='gemini-2.0-flash',
-                contents=current_prompt,
-                config=types.GenerateContentConfig(response_mime_type='application/json')
-            )
-            
-            # 1. Parse & Sanitize
-            json_data = sanitize_ai_response(response.text)
-            if not json_data:
-                raise ValueError("Failed to parse JSON response")
-            
-            # 2. Test Code
-            status_log.append(f"Phase 2 (Attempt {attempt+1}): Testing Code...")
-            valid, message = validate_policy_code(json_data['python_code'])
-            
-            if valid:
-                status_log.append("Phase 2: Success! Code verified.")
-                json_data['status_message'] = f"✅ Success! (Attempt {attempt+1})\n" + "\n".join(status_log)
-                final_response = json_data
-                break
-            else:
-                status_log.append(f"Phase 2 Failed: {message}")
-                # Feedback loop: Add error to prompt and retry
-                current_prompt += f"\n\nPREVIOUS ATTEMPT FAILED VALIDATION:\nCode:\n{json_data['python_code']}\nError:\n{message}\n\nPlease fix the code and return the JSON again."
-        
-        except Exception as e:
-            status_log.append(f"Error in attempt {attempt+1}: {str(e)}")
-            time.sleep(1) 
-    
-    if final_response:
-        return jsonify({'response': json.dumps(final_response)})
-    else:
-        return jsonify({'error': "Failed to generate valid code after 3 attempts.\nLogs:\n" + "\n".join(status_log)}), 500
+    """Queues a policy generation; 202 with the task id, or 200 with the answer when cached"""
+    data = request.get_json(silent=True) or {}
+    # fanout: candidates generated at once per attempt (speculative mode); default CHAT_FANOUT
+    return simulate('submit_chat', **{name: data[name] for name in ('message', 'fanout') if name in data})
+
+@app.route('/api/chat/<task_id>', methods=['GET'])
+def get_chat(task_id):
+    """status, progress log, and the response (JSON text) or error once finished"""
+    return simulate('get_chat', task_id=task_id)
+
+@app.route('/api/chat/<task_id>', methods=['DELETE'])
+def cancel_chat(task_id):
+    return simulate('cancel_chat', task_id=task_id)
+
+@app.cli.command('warm-cache')
+def warm_cache_command():
+    """Precompute the default scenarios into the result cache (run at deploy time)"""
+    # Warms in this process with the built-in policies; no daemon needed
+    from policy_registry import registry
+    registry.reset()
+    reset_user_blocks()
+    sim_daemon.simulation().warm()
 
 if __name__ == "__main__":
     setup_simulation()
@@ -0,0 +1,206 @@
+'''
+Static asset pipeline and serving
+
+Build step (run at deploy time, see render.yaml):
+
+    python assets.py build
+
+Every file under the static roots (docs/, blockly/, explanatory/static/) is
+content-hashed. It is precompressed with gzip, and with brotli when the
+Brotli package is installed, and the variants are kept only when they are
+smaller. Output goes to SIM_ASSET_DIR (.assets/) together with a
+manifest.json.
+
+send(root, filename) serves a file with:
+
+- the precompressed variant the client accepts (Content-Encoding, Vary),
+  so nothing is compressed per request
+- a content-hash ETag, so revalidation is a 304
+- HTTP Range support (identity bytes, for large GLB/FBX models)
+- `immutable` caching for content-hashed URLs (url()), and `no-cache`
+  (always revalidate) for the plain URLs the pages and scripts use directly
+
+Files that changed after the build, or were never built (development,
+blockly/user_blocks.js), are hashed on first request and served
+uncompressed.
+'''
+
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import threading
+
+from flask import abort, request, send_file
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ASSET_DIR = os.path.join(_BASE_DIR, os.environ.get('SIM_ASSET_DIR', '.assets'))
+MANIFEST = os.path.join(ASSET_DIR, 'manifest.json')
+
+# URL root name -> directory
+ROOTS = {
+    'docs': 'docs',
+    'blockly': 'blockly',
+    'explain': os.path.join('explanatory', 'static'),
+}
+# Content-hashed URLs never change meaning, so clients may keep them for a year
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# Keep a compressed variant only if it saves at least this fraction
+MIN_SAVING = 0.1
+HASH_LENGTH = 16
+
+mimetypes.add_type('model/gltf-binary', '.glb')
+mimetypes.add_type('application/octet-stream', '.fbx')
+mimetypes.add_type('text/javascript', '.js')
+
+
+def _digest(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()[:HASH_LENGTH]
+
+
+def _files():
+    """(key, path) for every file under the static roots; key is 'root/relative/path'"""
+    for root, directory in ROOTS.items():
+        top = os.path.join(_BASE_DIR, directory)
+        for dirpath, dirnames, filenames in os.walk(top):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+            for name in sorted(filenames):
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(dirpath, name)
+                yield f"{root}/{os.path.relpath(path, top).replace(os.sep, '/')}", path
+
+
+def build(asset_dir=ASSET_DIR):
+    """Hashes and precompresses every static file; writes the manifest"""
+    os.makedirs(asset_dir, exist_ok=True)
+    manifest = {}
+    saved = 0
+    for key, path in _files():
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+        stat = os.stat(path)
+        entry = {'hash': digest, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        variants = [('gzip', '.gz', lambda d: gzip.compress(d, compresslevel=9, mtime=0))]
+        if brotli is not None:
+            variants.append(('br', '.br', lambda d: brotli.compress(d, quality=11)))
+        for encoding, suffix, compress in variants:
+            compressed = compress(data)
+            if len(compressed) <= (1 - MIN_SAVING) * len(data):
+                name = digest + suffix
+                with open(os.path.join(asset_dir, name), 'wb') as f:
+                    f.write(compressed)
+                entry[encoding] = name
+                saved += len(data) - len(compressed)
+        manifest[key] = entry
+    tmp = f'{MANIFEST}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, MANIFEST)
+    logger.info(f"Built {len(manifest)} assets into {asset_dir} "
+                f"({'gzip + brotli' if brotli else 'gzip'}; {saved / 1024:.0f} KiB saved per full download)")
+    return manifest
+
+
+class AssetIndex:
+    '''
+    Build manifest plus hashes computed on demand for files the build did
+    not cover. An entry is trusted only while the file's size and mtime
+    still match.
+    '''
+
+    def __init__(self, manifest_path=MANIFEST):
+        self.lock = threading.Lock()
+        self.built = {}
+        self.computed = {}
+        try:
+            with open(manifest_path) as f:
+                self.built = json.load(f)
+        except FileNotFoundError:
+            logger.info("No asset manifest; run `python assets.py build` for precompressed assets")
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable asset manifest {manifest_path}: {e}")
+
+    def entry(self, key, path):
+        stat = os.stat(path)
+        entry = self.built.get(key)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry
+        with self.lock:
+            entry = self.computed.get(key)
+            if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+                entry = {'hash': _digest(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+                self.computed[key] = entry
+        return entry
+
+
+index = AssetIndex()
+
+
+def _resolve(root, filename):
+    directory = ROOTS.get(root)
+    path = safe_join(os.path.join(_BASE_DIR, directory), filename) if directory else None
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    return path
+
+
+def url(key):
+    """Content-hashed, immutable URL for a static file, e.g. url('explain/css/style.css')"""
+    root, _, filename = key.partition('/')
+    entry = index.entry(key, _resolve(root, filename))
+    return f"/hashed/{entry['hash']}/{key}"
+
+
+def send(root, filename, digest=None):
+    path = _resolve(root, filename)
+    entry = index.entry(f"{root}/{filename}", path)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    variant, encoding = path, None
+    # Ranges address the identity bytes, so range requests skip the compressed variants
+    if 'Range' not in request.headers:
+        for name in ('br', 'gzip'):
+            if entry.get(name) and request.accept_encodings[name]:
+                variant, encoding = os.path.join(ASSET_DIR, entry[name]), name
+                break
+
+    hashed = digest is not None and digest == entry['hash']
+    response = send_file(variant, mimetype=mimetype, conditional=True,
+                         etag=entry['hash'] + (f"-{encoding}" if encoding else ""),
+                         max_age=IMMUTABLE_MAX_AGE if hashed else None)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if entry.get('gzip') or entry.get('br'):
+        response.vary.add('Accept-Encoding')
+    if hashed:
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    else:
+        # Plain URLs may change content; the ETag makes revalidation cheap
+        response.cache_control.no_cache = True
+    return response
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Precompress and hash static assets")
+    parser.add_argument('command', choices=['build'])
+    args = parser.parse_args()
+    build()
@@ -136,8 +136,8 @@ var pythonGenerator = Blockly.Python.forBlock || Blockly.Python;
 pythonGenerator['policy_root'] = function(block) {
     // Read the policy block directly to get the active policy type.
     // We do NOT use statementToCode here because that adds 4-space indent,
-    // which would bury the output inside the except ImportError: block in
-    // user_logic.py and prevent def step from ever being defined.
+    // which would leave def step nested instead of at module level, and the
+    // server's policy registry would never find it.
     var policyBlock = block.getInputTargetBlock('POLICY');
     var policyType  = policyBlock ? policyBlock.type : null;
 
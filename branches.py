@@ -0,0 +1,148 @@
+'''
+What-if branches forked from a running model
+
+fork(model) clones a single-policy run at its current step so it can
+continue under a different policy or parameters ("what if we switched to
+communism at step 300?"). Only the divergent steps are simulated:
+
+- State is cloned with one pickle round trip of the live WealthModel. The
+  result cache already snapshots tails this way. The clone gets the agents,
+  the RNG state, the bracket thresholds and the rolling flow window. For
+  compact populations (compact_agents.py) the agent state is a handful of
+  flat columns, so the copy is a memcpy per column.
+- History is shared, not copied. The clone keeps a reference to its parent
+  and the fork step, and WealthModel.series() reads the parent's series up
+  to that step before its own. Collected series are append-only, so the
+  shared prefix never changes.
+
+A fork with no changes continues exactly as its parent would, because the
+RNG state is part of the clone.
+
+A cached run that is replaying has no live model at its current step. If
+the step is the end of its cache entry it resumes from the stored tail.
+Otherwise it is re-simulated up to that step once (CachedRun.live_model).
+Comparison runs are not forked; fork the single-policy run instead.
+'''
+
+import copy
+import itertools
+import os
+import pickle
+import time
+
+MAX_BRANCHES = int(os.environ.get('SIM_MAX_BRANCHES', 8))
+# Steps one /api/branches/<id>/step request may run
+MAX_BRANCH_STEPS = 1000
+POLICIES = ("econophysics", "fascism", "communism", "capitalism")
+SERIES = ("Gini", "Total", "Mobility")
+
+
+def fork(model, policy=None, patron=None, start_up_required=None):
+    """Clone of model at its current step, optionally under another policy or parameters"""
+    from model import WealthModel   # imports mesa; web workers never need it
+    if getattr(model, 'policy', None) == "comparison":
+        raise ValueError("Comparison runs cannot be forked; fork a single-policy run")
+    source = model.live_model() if hasattr(model, 'live_model') else model
+    if not isinstance(source, WealthModel):
+        raise ValueError(f"Cannot fork a {type(model).__name__}")
+    clone = pickle.loads(pickle.dumps(source, protocol=pickle.HIGHEST_PROTOCOL))
+    clone.history_parent = model
+    clone.fork_step = model.steps
+    clone.converged_step = None
+    # The exchange network never changes during a run, so branches share it
+    clone.network = source.network
+    # A cached run's live model leaves per-agent history to the cache entry
+    clone.set_agent_record_every(getattr(model, 'agent_record_every', 1))
+    if clone.flows is None and getattr(model, 'flows', None) is not None:
+        # A cached run keeps its flow window outside the live model
+        clone.flows = copy.deepcopy(model.flows)
+    apply_changes(clone, policy=policy, patron=patron, start_up_required=start_up_required)
+    return clone
+
+
+def apply_changes(model, policy=None, patron=None, start_up_required=None):
+    """Sets a run's policy and parameters (those not None); returns the changes"""
+    changes = {}
+    if policy is not None:
+        if policy not in POLICIES and policy not in _custom_policies():
+            raise ValueError(f"Unknown policy {policy!r}")
+        changes['policy'] = policy
+    if patron is not None:
+        changes['patron'] = bool(patron)
+    if start_up_required is not None:
+        changes['start_up_required'] = int(start_up_required)
+    for name, value in changes.items():
+        setattr(model, name, value)
+    return changes
+
+
+def _custom_policies():
+    from policy_registry import registry
+    return registry.by_name
+
+
+class Branch:
+    def __init__(self, branch_id, model, parent, name=None, changes=None):
+        self.id = branch_id
+        self.name = name or branch_id
+        self.model = model
+        self.parent = parent          # 'current' or a branch id
+        self.changes = changes or {}
+        self.created = time.time()
+
+    def describe(self):
+        return {'id': self.id, 'name': self.name, 'parent': self.parent, 'fork_step': self.model.fork_step,
+                'steps': self.model.steps, 'policy': self.model.policy, 'patron': self.model.patron,
+                'start_up_required': self.model.start_up_required, 'changes': self.changes,
+                'created': self.created}
+
+
+class BranchSet:
+    """The branches forked from one session's runs (callers hold the simulation lock)"""
+
+    def __init__(self, max_branches=MAX_BRANCHES):
+        self.max_branches = max_branches
+        self.branches = {}
+        self.ids = itertools.count(1)
+
+    def fork(self, model, parent='current', name=None, **changes):
+        if len(self.branches) >= self.max_branches:
+            raise OverflowError(f"At most {self.max_branches} branches; delete one first")
+        changes = {key: value for key, value in changes.items() if value is not None}
+        branch = Branch(f"b{next(self.ids)}", fork(model, **changes), parent, name, changes)
+        self.branches[branch.id] = branch
+        return branch
+
+    def get(self, branch_id):
+        return self.branches.get(branch_id)
+
+    def remove(self, branch_id):
+        return self.branches.pop(branch_id, None)
+
+    def clear(self):
+        self.branches.clear()
+
+    def list(self):
+        return [branch.describe() for branch in self.branches.values()]
+
+    def step(self, branch_id, steps=1):
+        branch = self.branches[branch_id]
+        if not 1 <= steps <= MAX_BRANCH_STEPS:
+            raise ValueError(f"steps must be between 1 and {MAX_BRANCH_STEPS}")
+        for _ in range(steps):
+            branch.model.step()
+        return branch
+
+    def compare(self, current, name="Gini", ids=None):
+        """One series for the current run and each branch, with their fork steps"""
+        if name not in SERIES:
+            raise ValueError(f"series must be one of {SERIES}")
+        runs = {}
+        if current is not None:
+            runs['current'] = {'fork_step': None, 'policy': current.policy, 'values': current.series(name)}
+        for branch_id, branch in self.branches.items():
+            if ids and branch_id not in ids:
+                continue
+            runs[branch_id] = {'fork_step': branch.model.fork_step, 'policy': branch.model.policy,
+                               'name': branch.name, 'values': branch.model.series(name)}
+        return {'series': name, 'runs': runs}
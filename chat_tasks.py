@@ -0,0 +1,488 @@
+'''
+AI policy generation as background tasks (/api/chat)
+
+A generation makes up to CHAT_ATTEMPTS Gemini round trips, each followed
+by a sandbox validation (policy_sandbox.py), with a retry delay after a
+failed call. Inside a web request that held a worker for tens of seconds,
+so a handful of chat users could stall /api/step for everyone. Instead:
+
+- POST /api/chat submits a ChatTask and returns its id at once (202), or
+  the finished task (200) when the prompt cache already has an answer.
+- The generate -> validate -> retry loop runs on a small thread pool.
+  At most CHAT_CONCURRENCY tasks generate at a time (a global limit).
+  At most CHAT_QUEUE_DEPTH more wait; past that submit() raises QueueFull.
+- Each Gemini call is abandoned after CHAT_CALL_TIMEOUT seconds and counts
+  as a failed attempt. Validation is time-boxed by the sandbox.
+- GET /api/chat/<id> polls the task: its status, the progress log and,
+  once done, the response. DELETE cancels it before its next attempt.
+- Finished tasks are kept for CHAT_RESULT_TTL seconds.
+- Speculative mode (fanout > 1, per request or CHAT_FANOUT): each attempt
+  requests several candidates at once, with different temperatures and
+  prompt hints, validates them in parallel sandbox workers as they arrive,
+  and keeps the first that passes. CHAT_SPECULATIVE_BUDGET caps the extra
+  candidates in flight across all tasks.
+
+The tasks live in sim_daemon's Simulation, next to the job queue, so every
+web worker can answer a poll. With GEMINI_STUB=1 the offline client from
+gemini_stub.py answers instead of the API.
+'''
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import policy_sandbox
+import startup
+from gemini_stub import StubGeminiClient
+from prompt_cache import PromptCache
+
+logger = logging.getLogger(__name__)
+
+CHAT_CONCURRENCY = int(os.environ.get('CHAT_CONCURRENCY', 4))
+CHAT_QUEUE_DEPTH = int(os.environ.get('CHAT_QUEUE_DEPTH', 32))
+CHAT_CALL_TIMEOUT = float(os.environ.get('CHAT_CALL_TIMEOUT', 60))
+CHAT_RESULT_TTL = float(os.environ.get('CHAT_RESULT_TTL', 900))
+CHAT_ATTEMPTS = 3
+# Speculative mode: candidates requested at once per attempt (default, and the
+# most a request may ask for), and extra candidates in flight across all tasks
+CHAT_FANOUT = int(os.environ.get('CHAT_FANOUT', 1))
+CHAT_MAX_FANOUT = int(os.environ.get('CHAT_MAX_FANOUT', 4))
+CHAT_SPECULATIVE_BUDGET = int(os.environ.get('CHAT_SPECULATIVE_BUDGET', 8))
+# Seconds to wait after a failed Gemini call before the next attempt
+RETRY_DELAY = 1.0
+GEMINI_MODEL = 'gemini-2.0-flash'
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+# SYSTEM PROMPT
+BASE_PROMPT = (
+    "You are a Policy Generator for a Mesa Agent simulation (Mesa 3.0+). "
+    "Convert the user's idea into a Python class and a Blockly block definition.\n\n"
+
+    "### CODING RULES (CRITICAL) ###\n"
+    "1. **MESA 3.0 COMPATIBILITY**: `model.schedule.agents` DOES NOT EXIST. Use `model.agents` (it is a list).\n"
+    "2. **SCOPE SAFETY**: This code runs inside `Agent.step(self)`. The variable `model` is NOT global. You MUST use `self.model`.\n"
+    "3. **GENERATOR**: In the block generator, pass `self.model` to your class. Ex: `MyPol().execute(self, self.model)`.\n"
+    "4. **ATTRIBUTES**: Verify attributes exist. The model has `survival_cost` (NOT survival_amount or threshold).\n\n"
+    + policy_sandbox.BATCH_PROMPT +
+
+    "### OUTPUT FORMAT (Strict JSON) ###\n"
+    "Return a single JSON object with ALL four of these fields:\n"
+    "{\n"
+    '  "description": "A plain-English, numbered step-by-step explanation of exactly what this policy does during each simulation step. Each numbered step should be one sentence describing one action. Example: \'1. Every agent pays 10% of their wealth as tax. 2. The collected tax is pooled together. 3. The pool is divided equally among agents below the survival threshold.\'",\n'
+    '  "python_code": "class MyPolicy:\\n    def execute(self, agent, model):\\n        # logic\\n    def execute_batch(self, pop, model):\\n        # optional: the same logic on arrays",\n'
+    '  "block_json": { "type": "my_policy", "message0": "Execute My Policy", "previousStatement": null, "nextStatement": null, "colour": 0 },\n'
+    '  "block_generator": "Blockly.Python.forBlock[\'my_policy\'] = function(block) { return \'MyPolicy().execute(self, self.model)\\n\'; };"\n'
+    "}\n\n"
+    "The `description` field is REQUIRED and must be a numbered list explaining the policy mechanics "
+    "in plain language that a non-programmer can understand. Do not use code or technical jargon in the description.\n"
+)
+
+prompt_cache = PromptCache()
+
+
+class QueueFull(Exception):
+    pass
+
+
+# --- Gemini client ---
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """The shared Google Gen AI client, created on first use; None without an API key"""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            return _client
+        if os.environ.get("GEMINI_STUB"):
+            logger.info("GEMINI_STUB set: using the offline stub Gemini client.")
+            _client = StubGeminiClient()
+            return _client
+        api_key = os.environ.get("GOOGLE_API_KEY")
+        if not api_key:
+            logger.warning("GOOGLE_API_KEY not found. Chat will not work.")
+            return None
+        try:
+            logger.info("Initializing Google Gen AI Client...")
+            with startup.phase("import google.genai"):
+                import google.genai as genai
+            _client = genai.Client(api_key=api_key)
+            logger.info("Gemini Client Loaded Successfully.")
+        except Exception as e:
+            logger.exception(f"Warning: Failed to load Gemini Client. Error: {e}")
+        return _client
+
+
+def call_with_timeout(timeout, fn, *args, **kwargs):
+    """
+    fn(*args, **kwargs) on a helper thread; TimeoutError after timeout seconds.
+    A call that overruns is abandoned, not stopped: its result is dropped.
+    """
+    outcome = {}
+
+    def target():
+        try:
+            outcome['value'] = fn(*args, **kwargs)
+        except BaseException as e:
+            outcome['error'] = e
+
+    thread = threading.Thread(target=target, name="gemini-call", daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise TimeoutError(f"Gemini did not answer within {timeout:g}s")
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['value']
+
+
+# --- Generation pipeline ---
+# Generated code is executed only inside policy_sandbox worker processes.
+def sanitize_ai_response(json_text):
+    try:
+        clean_text = re.sub(r'^```json\s*|```\s*$', '', json_text.strip(), flags=re.MULTILINE)
+        data = json.loads(clean_text)
+
+        if 'python_code' in data:
+            if 'model.schedule.agents' in data['python_code']:
+                data['python_code'] = data['python_code'].replace('model.schedule.agents', 'model.agents')
+
+        if 'block_generator' in data:
+            gen_code = data['block_generator']
+            if re.search(r'\.execute\(\s*self\s*,\s*model\s*\)', gen_code):
+                data['block_generator'] = re.sub(
+                    r'\.execute\(\s*self\s*,\s*model\s*\)',
+                    '.execute(self, self.model)',
+                    gen_code
+                )
+
+        # Ensure description is always a non-empty string
+        desc = data.get('description', '')
+        if not isinstance(desc, str) or not desc.strip():
+            print("WARNING: AI response missing 'description' field.")
+            data['description'] = ''
+        else:
+            print(f"AI description present ({len(desc)} chars): {desc[:80]}...")
+
+        return data
+    except Exception as e:
+        print(f"Sanitization Warning: {e}")
+        return None
+
+
+def feedback(code, result):
+    """What to add to the prompt after code failed validation with result"""
+    message = result['message']
+    if result.get('over_budget') or result.get('timed_out'):
+        return (
+            f"\n\nPREVIOUS ATTEMPT WAS TOO SLOW:\nCode:\n{code}\nMeasured:\n{message}\n\n"
+            "execute() runs once per agent per step, so it must not loop over `model.agents` or sort the "
+            "population. Rewrite it to touch only the agent and a few randomly chosen agents, "
+            "and return the JSON again."
+        )
+    if result.get('batch_mismatch'):
+        return (
+            f"\n\nPREVIOUS ATTEMPT FAILED VALIDATION:\nCode:\n{code}\nError:\n{message}\n\n"
+            "execute_batch(pop, model) must have the same effect as calling execute(agent, model) on every "
+            "agent. Fix execute_batch so they agree (or leave it out) and return the JSON again."
+        )
+    return f"\n\nPREVIOUS ATTEMPT FAILED VALIDATION:\nCode:\n{code}\nError:\n{message}\n\nPlease fix the code and return the JSON again."
+
+
+# Candidates of a speculative round differ in sampling temperature and a
+# prompt hint. The first is the plain prompt, so fanout=1 behaves as before.
+VARIANTS = (
+    (None, ""),
+    (1.0, ""),
+    (0.4, "\nKeep the policy as short and simple as the idea allows.\n"),
+    (0.8, "\nInclude an `execute_batch(self, pop, model)` so the whole population is handled at once.\n"),
+)
+
+
+class SpeculationBudget:
+    """Extra candidates in flight across all chat tasks; each task always has its first"""
+
+    def __init__(self, size=CHAT_SPECULATIVE_BUDGET):
+        self.size = size
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def take(self, wanted):
+        """Reserves up to wanted extra candidates; returns how many were granted"""
+        with self.lock:
+            granted = max(0, min(wanted, self.size - self.used))
+            self.used += granted
+            return granted
+
+    def give_back(self, count):
+        with self.lock:
+            self.used -= count
+
+
+budget = SpeculationBudget()
+
+
+def _candidate(client, prompt, variant, timeout, model):
+    """One Gemini answer, parsed and sanitized; raises when there is none"""
+    temperature, hint = variant
+    config = {'response_mime_type': 'application/json'}
+    if temperature is not None:
+        config['temperature'] = temperature
+    response = call_with_timeout(timeout, client.models.generate_content,
+                                 model=model, contents=prompt + hint, config=config)
+    json_data = sanitize_ai_response(response.text)
+    if not json_data:
+        raise ValueError("Failed to parse JSON response")
+    return json_data
+
+
+def _validate(json_data):
+    """Sandbox validation; the benchmark is added to json_data as 'performance'"""
+    result = policy_sandbox.validate(json_data['python_code'])
+    if 'cost_us' in result:
+        json_data['performance'] = {k: result[k] for k in ('cost_us', 'budget_us', 'population', 'over_budget')}
+        if 'batch' in result:
+            json_data['performance']['batch'] = result['batch']
+    return result
+
+
+def _speculate(client, prompt, attempt, width, log, cancelled, timeout, model):
+    '''
+    One attempt as width candidates requested at once, each validated as
+    soon as it arrives. Returns (json_data, result) of the first to pass, or
+    of the first failure for the retry feedback. Raises when no candidate
+    produced code. The rest are abandoned: answers still in flight are
+    dropped without being validated. Candidates after the first hold a
+    budget slot (taken by the caller) until their call actually returns.
+    '''
+    won = threading.Event()
+
+    def run(index):
+        json_data = _candidate(client, prompt, VARIANTS[index % len(VARIANTS)], timeout, model)
+        if won.is_set() or cancelled.is_set():
+            return None
+        log.append(f"Phase 2 (Attempt {attempt+1}, candidate {index+1}): Testing Code...")
+        return index, json_data, _validate(json_data)
+
+    log.append(f"Phase 1 (Attempt {attempt+1}): Generating {width} candidates in parallel...")
+    executor = ThreadPoolExecutor(max_workers=width, thread_name_prefix="chat-candidate")
+    futures = {}
+    for index in range(width):
+        future = executor.submit(run, index)
+        if index:
+            # An abandoned candidate keeps calling Gemini; its slot stays taken until it is done
+            future.add_done_callback(lambda _: budget.give_back(1))
+        futures[future] = index
+    pending, failed, errors = set(futures), None, []
+    try:
+        while pending and not cancelled.is_set():
+            finished, pending = wait(pending, timeout=0.25, return_when=FIRST_COMPLETED)
+            for future in finished:
+                try:
+                    outcome = future.result()
+                except Exception as e:
+                    errors.append(f"candidate {futures[future]+1}: {e}")
+                    continue
+                if outcome is None:
+                    continue
+                index, json_data, result = outcome
+                if result['valid']:
+                    won.set()
+                    if pending:
+                        log.append(f"Candidate {index+1} passed first; cancelled the {len(pending)} still running.")
+                    return json_data, result
+                log.append(f"Phase 2 Failed (candidate {index+1}): {result['message']}")
+                failed = failed or (json_data, result)
+    finally:
+        won.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+    if failed is None:
+        raise RuntimeError("; ".join(errors) or "cancelled")
+    return failed
+
+
+def generate(client, user_query, log, cancelled=None, attempts=CHAT_ATTEMPTS, timeout=CHAT_CALL_TIMEOUT,
+             fanout=1, prompt=BASE_PROMPT, model=GEMINI_MODEL):
+    '''
+    The generate -> validate -> retry loop. Returns the validated response
+    (a dict with a status_message), or None when every attempt failed or
+    cancelled (a threading.Event) was set. Progress lines go to log.
+    With fanout > 1 each attempt requests up to fanout candidates at once
+    (_speculate). Candidates beyond the first come from the global budget,
+    so under load an attempt narrows down to one. Their slots are released
+    as each candidate finishes, not when the attempt returns.
+    '''
+    cancelled = cancelled or threading.Event()
+    current_prompt = prompt + f"\nUser Idea: {user_query}"
+    for attempt in range(attempts):
+        if cancelled.is_set():
+            return None
+        extra = budget.take(fanout - 1) if fanout > 1 else 0
+        try:
+            if extra:
+                json_data, result = _speculate(client, current_prompt, attempt, 1 + extra, log, cancelled,
+                                               timeout, model)
+            else:
+                log.append(f"Phase 1 (Attempt {attempt+1}): Generating Code...")
+                json_data = _candidate(client, current_prompt, VARIANTS[0], timeout, model)
+                log.append(f"Phase 2 (Attempt {attempt+1}): Testing Code...")
+                result = _validate(json_data)
+
+            if result['valid']:
+                log.append(f"Phase 2: Success! {result['message']}")
+                json_data['status_message'] = f"✅ Success! (Attempt {attempt+1})\n" + "\n".join(log)
+                return json_data
+            if not extra:
+                log.append(f"Phase 2 Failed: {result['message']}")
+            # Feedback loop: Add error to prompt and retry
+            current_prompt += feedback(json_data['python_code'], result)
+
+        except Exception as e:
+            log.append(f"Error in attempt {attempt+1}: {str(e)}")
+            cancelled.wait(RETRY_DELAY)
+    return None
+
+
+# --- Tasks ---
+class ChatTask:
+    def __init__(self, message, fanout=1):
+        self.id = uuid.uuid4().hex
+        self.message = message
+        self.fanout = fanout
+        self.status = QUEUED
+        self.log = []
+        self.response = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancelled = threading.Event()
+
+    def describe(self):
+        # response is the JSON text /api/chat has always returned, so the editor parses it unchanged
+        return {'id': self.id, 'status': self.status, 'fanout': self.fanout, 'log': list(self.log),
+                'created': self.created, 'started': self.started, 'finished': self.finished,
+                'error': self.error, 'response': json.dumps(self.response) if self.response else None}
+
+
+class ChatTasks:
+
+    def __init__(self, concurrency=CHAT_CONCURRENCY, depth=CHAT_QUEUE_DEPTH, ttl=CHAT_RESULT_TTL,
+                 timeout=CHAT_CALL_TIMEOUT):
+        self.concurrency = max(1, concurrency)
+        self.depth = depth
+        self.ttl = ttl
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.tasks = {}
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="chat")
+
+    def submit(self, message, fanout=None):
+        """fanout: candidates per attempt (speculative mode), default CHAT_FANOUT, at most CHAT_MAX_FANOUT"""
+        fanout = max(1, min(int(CHAT_FANOUT if fanout is None else fanout), CHAT_MAX_FANOUT))
+        with self.lock:
+            self._expire()
+            task = ChatTask(message, fanout)
+            # Validated answers to the same idea (up to filler words) cost no API call
+            cached = prompt_cache.get(message)
+            if cached:
+                response, exact = cached
+                match = "exact match" if exact else "same request apart from filler words"
+                response['status_message'] = f"✅ Success! (served from cache: {match})"
+                task.response = response
+                self._finish(task, DONE)
+                self.tasks[task.id] = task
+                return task
+            if sum(t.status == QUEUED for t in self.tasks.values()) >= self.depth:
+                raise QueueFull(f"Too many policy generations in progress ({self.depth} waiting)")
+            self.tasks[task.id] = task
+        self.executor.submit(self._run, task)
+        return task
+
+    def get(self, task_id):
+        with self.lock:
+            self._expire()
+            return self.tasks.get(task_id)
+
+    def cancel(self, task_id):
+        """Cancels a waiting task; a running one stops before its next attempt"""
+        with self.lock:
+            task = self.tasks.get(task_id)
+            if task is None or task.status in FINISHED:
+                return task
+            task.cancelled.set()
+            if task.status == QUEUED:
+                self._finish(task, CANCELLED)
+            return task
+
+    def stats(self):
+        with self.lock:
+            counts = {}
+            for task in self.tasks.values():
+                counts[task.status] = counts.get(task.status, 0) + 1
+            return {'concurrency': self.concurrency, 'depth': self.depth, 'tasks': counts,
+                    'speculative': {'budget': budget.size, 'in_flight': budget.used}}
+
+    def close(self):
+        for task in list(self.tasks.values()):
+            task.cancelled.set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        for task_id in [t.id for t in self.tasks.values() if t.status in FINISHED and t.finished < cutoff]:
+            del self.tasks[task_id]
+
+    def _finish(self, task, status, error=None):
+        task.status = status
+        task.error = error
+        task.finished = time.time()
+
+    def _run(self, task):
+        with self.lock:
+            if task.status != QUEUED:
+                return
+            task.status = RUNNING
+            task.started = time.time()
+        try:
+            client = get_client()
+            if client is None:
+                response, error = None, 'Gemini not initialized'
+            else:
+                response = generate(client, task.message, task.log, task.cancelled, timeout=self.timeout,
+                                    fanout=task.fanout)
+                error = f"Failed to generate valid code after {CHAT_ATTEMPTS} attempts.\nLogs:\n" + "\n".join(task.log)
+        except Exception as e:
+            logger.exception("Chat task failed")
+            response, error = None, f"{type(e).__name__}: {e}"
+        if response is not None:
+            prompt_cache.put(task.message, response)
+        with self.lock:
+            task.response = response
+            if response is not None:
+                self._finish(task, DONE)
+            elif task.cancelled.is_set():
+                self._finish(task, CANCELLED)
+            else:
+                self._finish(task, FAILED, error)
+
+
+_tasks = None
+_tasks_lock = threading.Lock()
+
+
+def get_tasks():
+    """Process-wide chat tasks, started on first use"""
+    global _tasks
+    with _tasks_lock:
+        if _tasks is None:
+            _tasks = ChatTasks()
+        return _tasks
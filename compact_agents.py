@@ -0,0 +1,467 @@
+'''
+Columnar agent storage for large populations
+
+A full Mesa agent costs several hundred bytes (an instance __dict__, boxed
+floats, a list of bracket strings and three registry entries). AgentTable
+keeps the population in flat columns instead: array.array for the scalars
+(fast per-element access that returns plain Python floats) and a bytearray
+ring of bracket codes for the history, each also exposed as a zero-copy NumPy
+view for vectorized reads.
+
+Agents are AgentView objects, two-slot proxies created on access that read
+and write one row of the table. They expose the same attributes as
+WealthAgent (wealth, W, I, bracket, previous, bracket_history, mobility,
+party_elite, innovating, unique_id, model, random), so existing step logic
+and generated policy code run unchanged. Attributes the table has no column
+for are kept in a sparse per-name dict.
+'''
+
+from array import array
+
+import numpy as np
+
+from utilities import bartholomew_mobility_array
+
+BRACKETS = ["Lower", "Middle", "Upper"]
+BRACKET_CODES = {name: code for code, name in enumerate(BRACKETS)}
+# Bracket history entries kept per agent (WealthAgent.step truncates to 20)
+HISTORY_LEN = 20
+
+
+def _column(values, typecode, dtype):
+    column = array(typecode)
+    column.frombytes(np.ascontiguousarray(values, dtype=dtype).tobytes())
+    return column
+
+
+class BracketHistory:
+    """List-like window onto one agent's bracket history"""
+
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def _codes(self):
+        start = self.index * HISTORY_LEN
+        return self.table.history[start:start + self.table.history_len[self.index]]
+
+    def __len__(self):
+        return self.table.history_len[self.index]
+
+    def __iter__(self):
+        return (BRACKETS[code] for code in self._codes())
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [BRACKETS[code] for code in self._codes()[item]]
+        return BRACKETS[self._codes()[item]]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def append(self, bracket):
+        self.table.push_history(self.index, BRACKET_CODES[bracket])
+
+
+class AgentView:
+    '''
+    One row of an AgentTable. Views are transient, so compare agents with
+    == / != rather than `is`; equal views refer to the same row.
+    '''
+
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        object.__setattr__(self, 'table', table)
+        object.__setattr__(self, 'index', index)
+
+    def __eq__(self, other):
+        return isinstance(other, AgentView) and other.index == self.index and other.table is self.table
+
+    def __hash__(self):
+        return hash((id(self.table), self.index))
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {self.unique_id}>"
+
+    # Attributes without a column are stored sparsely on the table
+    def __getattr__(self, name):
+        values = self.table.extras.get(name)
+        if values is None or self.index not in values:
+            raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+        return values[self.index]
+
+    def __setattr__(self, name, value):
+        if name in _VIEW_ATTRIBUTES:
+            object.__setattr__(self, name, value)
+        else:
+            self.table.extras.setdefault(name, {})[self.index] = value
+
+    @property
+    def model(self):
+        return self.table.model
+
+    @property
+    def unique_id(self):
+        return self.table.first_uid + self.index
+
+    @property
+    def pos(self):
+        return None
+
+    @property
+    def random(self):
+        return self.table.model.random
+
+    @property
+    def rng(self):
+        return self.table.model.rng
+
+    @property
+    def wealth(self):
+        return self.table.wealth[self.index]
+
+    @wealth.setter
+    def wealth(self, value):
+        self.table.wealth[self.index] = value
+
+    @property
+    def W(self):
+        return self.table.W[self.index]
+
+    @W.setter
+    def W(self, value):
+        self.table.W[self.index] = value
+
+    @property
+    def I(self):
+        return self.table.I[self.index]
+
+    @I.setter
+    def I(self, value):
+        self.table.I[self.index] = value
+
+    @property
+    def mobility(self):
+        return self.table.mobility[self.index]
+
+    @mobility.setter
+    def mobility(self, value):
+        self.table.mobility[self.index] = value
+
+    @property
+    def bracket(self):
+        return BRACKETS[self.table.bracket[self.index]]
+
+    @bracket.setter
+    def bracket(self, value):
+        self.table.bracket[self.index] = BRACKET_CODES[value]
+
+    @property
+    def previous(self):
+        return BRACKETS[self.table.previous[self.index]]
+
+    @previous.setter
+    def previous(self, value):
+        self.table.previous[self.index] = BRACKET_CODES[value]
+
+    @property
+    def party_elite(self):
+        return self.table.party_elite[self.index] == 1
+
+    @party_elite.setter
+    def party_elite(self, value):
+        self.table.party_elite[self.index] = 1 if value else 0
+
+    @property
+    def innovating(self):
+        return self.table.innovating[self.index] == 1
+
+    @innovating.setter
+    def innovating(self, value):
+        self.table.innovating[self.index] = 1 if value else 0
+
+    @property
+    def bracket_history(self):
+        return BracketHistory(self.table, self.index)
+
+    @bracket_history.setter
+    def bracket_history(self, brackets):
+        self.table.set_history(self.index, [BRACKET_CODES[b] for b in brackets])
+
+
+_VIEW_ATTRIBUTES = frozenset(name for name in dir(AgentView) if not name.startswith('__'))
+
+
+class AgentTable:
+    '''
+    Column store for one model's population, built in one pass from the
+    arrays create_agents draws. Row i is the agent with unique_id first_uid + i.
+    '''
+
+    def __init__(self, model, proportion, innovation, party_elite, view_class=AgentView, first_uid=1):
+        size = len(proportion)
+        self.model = model
+        self.size = size
+        self.view_class = view_class
+        self.first_uid = first_uid
+        self.wealth = array('d', [1.0]) * size
+        self.W = _column(proportion, 'd', np.float64)
+        self.I = _column(innovation, 'd', np.float64)
+        self.mobility = array('d', [0.0]) * size
+        self.bracket = array('b', [BRACKET_CODES["Middle"]]) * size
+        self.previous = array('b', [BRACKET_CODES["Middle"]]) * size
+        self.party_elite = _column(party_elite, 'b', np.int8)
+        self.innovating = array('b', [0]) * size
+        self.history = bytearray(size * HISTORY_LEN)
+        self.history_len = array('b', [0]) * size
+        self.extras = {}
+        self.agents = AgentColumnsSet(self)
+        self.reset_history()
+
+    def view(self, index):
+        return self.view_class(self, index)
+
+    def column(self, name):
+        """Zero-copy NumPy view of a column (history is shaped (size, HISTORY_LEN))"""
+        if name == 'history':
+            return np.frombuffer(self.history, dtype=np.int8).reshape(self.size, HISTORY_LEN)
+        data = getattr(self, name)
+        return np.frombuffer(data, dtype=np.float64 if data.typecode == 'd' else np.int8)
+
+    def values(self, name):
+        """Per-agent values of an attribute, in row order"""
+        if name in ('wealth', 'W', 'I', 'mobility'):
+            return getattr(self, name)
+        if name in ('bracket', 'previous'):
+            return [BRACKETS[code] for code in getattr(self, name)]
+        if name in ('party_elite', 'innovating'):
+            return [code == 1 for code in getattr(self, name)]
+        return [getattr(self.view(i), name) for i in range(self.size)]
+
+    def assign_brackets(self, brackets):
+        """Vectorized bracket assignment (Lower below brackets[0], Upper from brackets[1])"""
+        wealth = self.column('wealth')
+        codes = np.where(wealth < brackets[0], 0, np.where(wealth >= brackets[1], 2, 1))
+        self.column('bracket')[:] = codes
+
+    def reset_history(self):
+        """Bracket history becomes [current bracket] for every agent"""
+        self.column('history')[:, 0] = self.column('bracket')
+        self.column('history_len')[:] = 1
+
+    def push_history(self, index, code):
+        start = index * HISTORY_LEN
+        length = self.history_len[index]
+        if length == HISTORY_LEN:
+            # Full: drop the oldest entry, as the step logic's [-20:] truncation does
+            self.history[start:start + HISTORY_LEN - 1] = self.history[start + 1:start + HISTORY_LEN]
+            self.history[start + HISTORY_LEN - 1] = code
+        else:
+            self.history[start + length] = code
+            self.history_len[index] = length + 1
+
+    def set_history(self, index, codes):
+        codes = codes[-HISTORY_LEN:]
+        start = index * HISTORY_LEN
+        self.history[start:start + len(codes)] = bytes(codes)
+        self.history_len[index] = len(codes)
+
+    def nbytes(self):
+        columns = (self.wealth, self.W, self.I, self.mobility, self.bracket, self.previous,
+                   self.party_elite, self.innovating, self.history_len)
+        return sum(c.itemsize * len(c) for c in columns) + len(self.history)
+
+
+class AgentColumnsSet:
+    '''
+    Ordered, O(1)-indexable collection of table rows with the parts of the
+    Mesa AgentSet API the model, policies and DataCollector use.
+    '''
+
+    def __init__(self, table, rows=None):
+        self.table = table
+        self.rows = rows   # None = every row, in creation order
+
+    @property
+    def random(self):
+        return self.table.model.random
+
+    def _indices(self):
+        return range(self.table.size) if self.rows is None else self.rows
+
+    def __len__(self):
+        return self.table.size if self.rows is None else len(self.rows)
+
+    def __iter__(self):
+        view = self.table.view
+        return (view(i) for i in self._indices())
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return AgentColumnsSet(self.table, list(self._indices()[item]))
+        if self.rows is None and 0 <= item < self.table.size:
+            # Fast path for random.choice(model.agents)
+            return self.table.view_class(self.table, item)
+        return self.table.view(self._indices()[item])
+
+    def __contains__(self, agent):
+        return (isinstance(agent, AgentView) and agent.table is self.table
+                and (self.rows is None or agent.index in self.rows))
+
+    def shuffle_do(self, method, *args, **kwargs):
+        """Same draws as AgentSet.shuffle_do: one shuffle of a list of len(self)"""
+        order = list(self._indices())
+        self.random.shuffle(order)
+        table, view_class = self.table, self.table.view_class
+        for i in order:
+            agent = view_class(table, i)
+            if isinstance(method, str):
+                getattr(agent, method)(*args, **kwargs)
+            else:
+                method(agent, *args, **kwargs)
+        return self
+
+    def do(self, method, *args, **kwargs):
+        for agent in self:
+            if isinstance(method, str):
+                getattr(agent, method)(*args, **kwargs)
+            else:
+                method(agent, *args, **kwargs)
+        return self
+
+    def map(self, method, *args, **kwargs):
+        if isinstance(method, str):
+            return [getattr(agent, method)(*args, **kwargs) for agent in self]
+        return [method(agent, *args, **kwargs) for agent in self]
+
+    def select(self, filter_func=None, at_most=float("inf"), inplace=False, agent_type=None):
+        rows = []
+        for i in self._indices():
+            if len(rows) >= at_most:
+                break
+            if filter_func is None or filter_func(self.table.view(i)):
+                rows.append(i)
+        if inplace:
+            self.rows = rows
+            return self
+        return AgentColumnsSet(self.table, rows)
+
+    def get(self, attr_names):
+        if isinstance(attr_names, str):
+            if self.rows is None:
+                return list(self.table.values(attr_names))
+            return [getattr(agent, attr_names) for agent in self]
+        return [[getattr(agent, name) for name in attr_names] for agent in self]
+
+    def groupby(self, by):
+        groups = {}
+        for agent in self:
+            key = getattr(agent, by) if isinstance(by, str) else by(agent)
+            groups.setdefault(key, []).append(agent.index)
+        return AgentGroups({key: AgentColumnsSet(self.table, rows) for key, rows in groups.items()})
+
+
+class AgentGroups:
+    """Result of AgentColumnsSet.groupby"""
+
+    def __init__(self, groups):
+        self.groups = groups
+
+    def __iter__(self):
+        return iter(self.groups.items())
+
+    def __len__(self):
+        return len(self.groups)
+
+    def count(self):
+        return {key: len(group) for key, group in self.groups.items()}
+
+    def map(self, method, *args, **kwargs):
+        return {key: group.map(method, *args, **kwargs) for key, group in self.groups.items()}
+
+    def do(self, method, *args, **kwargs):
+        for group in self.groups.values():
+            group.do(method, *args, **kwargs)
+        return self
+
+
+class PopulationArrays:
+    '''
+    Whole-population arrays for the batch policy forms (execute_population,
+    execute_batch) used by sharded.py and policy_sandbox.py. With compact
+    agents every array is a view of the AgentTable, so writes land directly;
+    with WealthAgent objects the values are gathered here and written back by
+    commit().
+    '''
+
+    def __init__(self, model):
+        self.model = model
+        table = model.agent_table
+        self.table = table
+        if table is not None:
+            self.size = table.size
+            for name in ('wealth', 'W', 'I', 'mobility', 'bracket', 'previous'):
+                setattr(self, name, table.column(name))
+            self.party_elite = table.column('party_elite').view(np.bool_)
+            self.innovating = table.column('innovating').view(np.bool_)
+            self.history = table.column('history')
+            self.history_len = table.column('history_len')
+            return
+
+        agents = model.agent_list
+        self.size = len(agents)
+        for name in ('wealth', 'W', 'I', 'mobility'):
+            setattr(self, name, np.array([getattr(a, name) for a in agents], dtype=np.float64))
+        self.bracket = np.array([BRACKET_CODES[a.bracket] for a in agents], dtype=np.int8)
+        self.previous = np.array([BRACKET_CODES[a.previous] for a in agents], dtype=np.int8)
+        self.party_elite = np.array([bool(a.party_elite) for a in agents], dtype=np.bool_)
+        self.innovating = np.array([bool(a.innovating) for a in agents], dtype=np.bool_)
+        self.history = np.zeros((self.size, HISTORY_LEN), dtype=np.int8)
+        self.history_len = np.zeros(self.size, dtype=np.int8)
+        for i, agent in enumerate(agents):
+            codes = [BRACKET_CODES[b] for b in agent.bracket_history[-HISTORY_LEN:]]
+            self.history[i, :len(codes)] = codes
+            self.history_len[i] = len(codes)
+
+    def everyone(self):
+        return np.ones(self.size, dtype=np.bool_)
+
+    def credit(self, receivers, amount):
+        """Adds amount (array or scalar) to each receiver's wealth; repeats accumulate"""
+        np.add.at(self.wealth, receivers, amount)
+
+    def update_history(self, mask):
+        """Appends the current bracket, keeping the last HISTORY_LEN entries"""
+        grow = np.flatnonzero(mask & (self.history_len < HISTORY_LEN))
+        full = np.flatnonzero(mask & (self.history_len >= HISTORY_LEN))
+        self.history[grow, self.history_len[grow]] = self.bracket[grow]
+        self.history_len[grow] += 1
+        self.history[full, :-1] = self.history[full, 1:]
+        self.history[full, -1] = self.bracket[full]
+
+    def calc_agent_metrics(self, mask):
+        """Bracket from the model's thresholds, then Bartholomew mobility"""
+        lower, upper = self.model.brackets
+        wealth = self.wealth[mask]
+        self.bracket[mask] = np.where(wealth < lower, 0, np.where(wealth >= upper, 2, 1))
+        self.mobility[mask] = bartholomew_mobility_array(self.history[mask], self.history_len[mask])
+
+    def commit(self):
+        """Writes gathered values back to WealthAgent objects (no-op for compact agents)"""
+        if self.table is not None:
+            return
+        for i, agent in enumerate(self.model.agent_list):
+            agent.wealth = float(self.wealth[i])
+            agent.W = float(self.W[i])
+            agent.I = float(self.I[i])
+            agent.mobility = float(self.mobility[i])
+            agent.bracket = BRACKETS[self.bracket[i]]
+            agent.previous = BRACKETS[self.previous[i]]
+            agent.innovating = bool(self.innovating[i])
+            agent.bracket_history = [BRACKETS[code] for code in self.history[i, :self.history_len[i]]]
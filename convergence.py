@@ -0,0 +1,158 @@
+'''
+Steady-state detection for long runs
+
+ConvergenceMonitor watches the per-step metrics of a run and decides when
+they have stopped drifting. It compares two adjacent windows of the
+tracked statistics: the last `window` steps against the `window` steps
+before them. Three statistics are tracked:
+
+- Gini
+- Growth: log(Total_t / Total_t-1). Total grows exponentially under most
+  policies, so its level never settles, but its per-step growth rate does.
+- Mobility
+
+Two tests are available (SIM_CONVERGENCE_TEST):
+
+- relative: each windowed mean moved by at most `tolerance` times the
+  earlier mean. Means below RELATIVE_FLOOR are scaled as if they were
+  RELATIVE_FLOOR, so Growth near zero does not divide by zero.
+- meanvar: the windowed means differ by at most `tolerance` standard errors
+  (Welch), and neither window's variance is more than 4x the other's.
+
+run_until_converged(model, max_steps) steps any model with step() and
+metrics() (WealthModel, CachedRun, ShardedWealthModel) until the monitor
+reports convergence. It records the step in model.converged_step.
+'''
+
+import logging
+import math
+import os
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+CONVERGENCE_WINDOW = int(os.environ.get('SIM_CONVERGENCE_WINDOW', 20))
+CONVERGENCE_TEST = os.environ.get('SIM_CONVERGENCE_TEST', 'relative')
+# Relative change for 'relative', standard errors for 'meanvar'
+CONVERGENCE_TOLERANCE = float(os.environ.get('SIM_CONVERGENCE_TOLERANCE', 0.02))
+# Smallest mean the 'relative' test divides by
+RELATIVE_FLOOR = 0.01
+# Largest variance ratio between the two windows for 'meanvar'
+MAX_VARIANCE_RATIO = 4.0
+
+STATISTICS = ("Gini", "Growth", "Mobility")
+TESTS = ("relative", "meanvar")
+
+
+def _mean_var(values):
+    n = len(values)
+    mean = sum(values) / n
+    return mean, sum((v - mean) ** 2 for v in values) / max(n - 1, 1)
+
+
+class ConvergenceMonitor:
+
+    def __init__(self, window=CONVERGENCE_WINDOW, tolerance=CONVERGENCE_TOLERANCE, test=CONVERGENCE_TEST):
+        if test not in TESTS:
+            raise ValueError(f"Unknown convergence test {test!r}; expected one of {TESTS}")
+        if window < 2:
+            raise ValueError("Convergence window must be at least 2 steps")
+        self.window = window
+        self.tolerance = tolerance
+        self.test = test
+        self.steps = 0
+        self.converged_step = None
+        self.last_total = None
+        # Two adjacent windows per statistic: [previous | recent]
+        self.history = {name: deque(maxlen=2 * window) for name in STATISTICS}
+        self.changes = {}
+
+    @property
+    def converged(self):
+        return self.converged_step is not None
+
+    def update(self, metrics, step=None):
+        """Feeds one step's metrics (Gini, Total, Mobility); returns True once converged.
+        step is the model's step number, recorded as converged_step (default: steps seen)"""
+        self.steps += 1
+        total = float(metrics["Total"])
+        if self.last_total is not None and self.last_total > 0 and total > 0:
+            self.history["Growth"].append(math.log(total / self.last_total))
+            self.history["Gini"].append(float(metrics["Gini"]))
+            self.history["Mobility"].append(float(metrics["Mobility"]))
+        self.last_total = total
+        if self.converged_step is None and self._stationary():
+            self.converged_step = self.steps if step is None else step
+        return self.converged
+
+    def _stationary(self):
+        if any(len(values) < 2 * self.window for values in self.history.values()):
+            return False
+        stationary = True
+        for name, values in self.history.items():
+            values = list(values)
+            (previous, previous_var), (recent, recent_var) = (_mean_var(values[:self.window]),
+                                                              _mean_var(values[self.window:]))
+            if self.test == "relative":
+                change = abs(recent - previous) / max(abs(previous), RELATIVE_FLOOR)
+                ok = change <= self.tolerance
+            else:
+                error = math.sqrt((previous_var + recent_var) / self.window)
+                change = abs(recent - previous) / error if error > 0 else 0.0
+                low, high = sorted((previous_var, recent_var))
+                ok = change <= self.tolerance and high <= MAX_VARIANCE_RATIO * max(low, 1e-300)
+            self.changes[name] = change
+            stationary = stationary and ok
+        return stationary
+
+    def summary(self):
+        return {'converged': self.converged, 'converged_step': self.converged_step, 'steps': self.steps,
+                'window': self.window, 'test': self.test, 'tolerance': self.tolerance,
+                'changes': dict(self.changes)}
+
+
+def latest_metrics(model):
+    """The metrics of the step just taken, without recomputing the model's reporters"""
+    collector = getattr(model, 'datacollector', None)
+    if collector is not None and collector.model_vars.get("Gini"):
+        return {name: values[-1] for name, values in collector.model_vars.items()}
+    return model.metrics()
+
+
+def run_until_converged(model, max_steps, monitor=None, on_step=None, **options):
+    '''
+    Steps model until its metrics settle or max_steps steps have run.
+    Returns the monitor. In comparison mode every sub-model gets a monitor
+    and the run stops once all of them have converged. The converged step
+    (or None) is stored on model.converged_step, and on each sub-model.
+    on_step(steps_run), if given, is called after every step.
+    '''
+    if getattr(model, 'policy', None) == "comparison":
+        monitors = {policy: ConvergenceMonitor(**options) for policy in model.comparison_models}
+        for _ in range(max_steps):
+            model.step()
+            if on_step is not None:
+                on_step(model.steps)
+            for policy, sub_model in model.comparison_models.items():
+                monitors[policy].update(latest_metrics(sub_model), sub_model.steps)
+            if all(m.converged for m in monitors.values()):
+                break
+        for policy, sub_model in model.comparison_models.items():
+            sub_model.converged_step = monitors[policy].converged_step
+        steps = [m.converged_step for m in monitors.values()]
+        model.converged_step = None if None in steps else max(steps)
+        model.convergence = {policy: m.summary() for policy, m in monitors.items()}
+        return monitors
+
+    monitor = monitor or ConvergenceMonitor(**options)
+    for _ in range(max_steps):
+        model.step()
+        if on_step is not None:
+            on_step(model.steps)
+        if monitor.update(latest_metrics(model), model.steps):
+            break
+    model.converged_step = monitor.converged_step
+    model.convergence = monitor.summary()
+    if monitor.converged:
+        logger.info(f"{model.policy} converged at step {monitor.converged_step}")
+    return monitor
@@ -1,2 +0,0 @@
-# Custom user-generated policies will be appended here
-
@@ -0,0 +1,235 @@
+'''
+Burn-in cache of pre-equilibrated starting populations
+
+Every run starts with all agents at wealth 1, and its first hundred or so
+steps are a transient users skip before they look at the dynamics.
+WealthModel(initial_state="equilibrium") starts from a settled population
+instead. It comes from a burn-in run of the same configuration (policy,
+population, start_up_required, patron, seed, statistics, network) stepped
+until its Gini, growth and mobility settle (convergence.py), for at most
+SIM_BURN_IN_MAX_STEPS steps.
+
+Only the evolving agent state is copied into the new model: wealth, pay
+(W) and innovation (I, innovating), bracket, previous bracket, bracket
+history and mobility, plus the survival cost. Capitalism raises W by I when
+an agent starts innovating, so the three travel together. The party elite,
+the network and the RNG stream are the new model's own seeded draws, so it
+is as reproducible as a fresh run and starts at step 0 of its own history.
+
+Burned-in states are stored compressed under SIM_BURN_IN_DIR, one .npz
+per configuration, keyed like the result cache (the simulation source and
+registered user code included) plus the burn-in settings. The first
+request for a configuration burns it in; build them ahead with
+
+    python equilibrium.py build --populations 100 200 --seeds 42
+
+Runs with a seed that is not an integer, or on an edge-list network, are
+burned in every time and not stored.
+'''
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+import convergence
+from compact_agents import BRACKETS, BRACKET_CODES, HISTORY_LEN
+
+logger = logging.getLogger(__name__)
+
+BURN_IN_DIR = os.environ.get('SIM_BURN_IN_DIR', '.sim_burn_in')
+BURN_IN_MAX_STEPS = int(os.environ.get('SIM_BURN_IN_MAX_STEPS', 500))
+
+INITIAL_STATES = ("fresh", "equilibrium")
+# Per-agent state a burn-in hands over, as AgentTable columns
+FIELDS = ('wealth', 'W', 'I', 'mobility', 'bracket', 'previous', 'innovating', 'history', 'history_len')
+
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def burn_in_key(model):
+    """Content address of model's burned-in state; None when it is not stored"""
+    spec = model.network_spec
+    if not isinstance(model.seed, int) or (spec is not None and 'degree' not in spec):
+        return None
+    from result_cache import run_key   # result_cache imports model.py
+    run = run_key(model.policy, model.population, model.start_up_required, model.patron, model.seed,
+                  statistics=model.statistics, network=spec)
+    digest = hashlib.sha256(run.encode())
+    digest.update(json.dumps([BURN_IN_MAX_STEPS, convergence.CONVERGENCE_WINDOW,
+                              convergence.CONVERGENCE_TOLERANCE, convergence.CONVERGENCE_TEST]).encode())
+    with open(os.path.join(_BASE_DIR, 'convergence.py'), 'rb') as f:
+        digest.update(f.read())
+    return digest.hexdigest()[:32]
+
+
+def capture(model):
+    """The evolving state of a single-policy WealthModel, as arrays"""
+    if model.agent_table is not None:
+        state = {name: model.agent_table.column(name).copy() for name in FIELDS}
+    else:
+        agents = model.agent_list
+        history = np.zeros((len(agents), HISTORY_LEN), dtype=np.int8)
+        lengths = np.zeros(len(agents), dtype=np.int8)
+        for i, agent in enumerate(agents):
+            codes = [BRACKET_CODES[b] for b in agent.bracket_history[-HISTORY_LEN:]]
+            history[i, :len(codes)] = codes
+            lengths[i] = len(codes)
+        state = {
+            'wealth': np.array([agent.wealth for agent in agents], dtype=np.float64),
+            'W': np.array([agent.W for agent in agents], dtype=np.float64),
+            'I': np.array([agent.I for agent in agents], dtype=np.float64),
+            'mobility': np.array([agent.mobility for agent in agents], dtype=np.float64),
+            'bracket': np.array([BRACKET_CODES[agent.bracket] for agent in agents], dtype=np.int8),
+            'previous': np.array([BRACKET_CODES[agent.previous] for agent in agents], dtype=np.int8),
+            'innovating': np.array([agent.innovating for agent in agents], dtype=np.int8),
+            'history': history,
+            'history_len': lengths,
+        }
+    state['survival_cost'] = np.float64(model.survival_cost)
+    return state
+
+
+def apply(model, state):
+    """Writes a captured state into model's agents (same population size)"""
+    if len(state['wealth']) != model.population:
+        raise ValueError(f"Burned-in state has {len(state['wealth'])} agents, the model {model.population}")
+    if model.agent_table is not None:
+        for name in FIELDS:
+            model.agent_table.column(name)[:] = state[name]
+    else:
+        for i, agent in enumerate(model.agent_list):
+            agent.wealth = float(state['wealth'][i])
+            agent.W = float(state['W'][i])
+            agent.I = float(state['I'][i])
+            agent.mobility = float(state['mobility'][i])
+            agent.bracket = BRACKETS[state['bracket'][i]]
+            agent.previous = BRACKETS[state['previous'][i]]
+            agent.innovating = bool(state['innovating'][i])
+            agent.bracket_history = [BRACKETS[code] for code in state['history'][i, :state['history_len'][i]]]
+    model.survival_cost = float(state['survival_cost'])
+
+
+def burn_in(model, max_steps=BURN_IN_MAX_STEPS):
+    """Runs model's configuration until it settles; returns (state, description)"""
+    from model import WealthModel
+    started = time.perf_counter()
+    run = WealthModel(policy=model.policy, population=model.population,
+                      start_up_required=model.start_up_required, patron=model.patron,
+                      rng=model.seed if isinstance(model.seed, int) else None, statistics=model.statistics,
+                      compact_agents=model.compact_agents, agent_record_every=0, network=model.network)
+    convergence.run_until_converged(run, max_steps)
+    info = {'steps': run.steps, 'converged_step': run.converged_step,
+            'seconds': round(time.perf_counter() - started, 3), 'metrics': {k: float(v) for k, v in run.metrics().items()}}
+    logger.info(f"Burned in {model.policy} (pop {model.population}) for {run.steps} steps "
+                f"({'converged' if run.converged_step else 'not converged'}, {info['seconds']}s)")
+    return capture(run), info
+
+
+class BurnInStore:
+    """Burned-in states on local disk, one compressed .npz per key"""
+
+    def __init__(self, directory=BURN_IN_DIR):
+        self.directory = directory
+        self.lock = threading.Lock()
+        # One burn-in per key at a time; later requests wait and load it
+        self.building = {}
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.npz')
+
+    def get(self, key):
+        try:
+            with np.load(self._path(key)) as data:
+                state = {name: data[name] for name in data.files if name != 'info'}
+                return state, json.loads(str(data['info']))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Dropping unreadable burn-in state {key}: {e}")
+            self.remove(key)
+            return None
+
+    def put(self, key, state, info):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        tmp = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez_compressed(tmp, info=np.array(json.dumps(info)), **state)
+        os.replace(tmp, path)
+
+    def remove(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith('.npz'):
+                    os.remove(os.path.join(self.directory, name))
+
+    def load(self, model):
+        '''
+        Puts model's agents in their burned-in state, burning the
+        configuration in first when it is not stored. Returns the burn-in's
+        description with 'cached' (whether it was loaded from disk).
+        '''
+        key = burn_in_key(model)
+        if key is None:
+            state, info = burn_in(model)
+            apply(model, state)
+            return dict(info, cached=False)
+        with self.lock:
+            lock = self.building.setdefault(key, threading.Lock())
+        with lock:
+            found = self.get(key)
+            if found is None:
+                state, info = burn_in(model)
+                self.put(key, state, info)
+            else:
+                state, info = found
+        apply(model, state)
+        return dict(info, cached=found is not None)
+
+
+# Shared process-wide store
+default_store = BurnInStore()
+
+
+def build(policies, populations, seeds, start_up_required=1, patron=False, statistics=None, network=None):
+    """Burns in every combination ahead of time; returns how many were new"""
+    from model import WealthModel
+    built = 0
+    for policy in policies:
+        for population in populations:
+            for seed in seeds:
+                model = WealthModel(policy=policy, population=population, start_up_required=start_up_required,
+                                    patron=patron, rng=seed, statistics=statistics, agent_record_every=0,
+                                    network=network, initial_state="equilibrium")
+                built += not model.burn_in['cached']
+    return built
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['build', 'clear'])
+    parser.add_argument('--policies', nargs='+', default=["econophysics", "fascism", "communism", "capitalism"])
+    parser.add_argument('--populations', nargs='+', type=int, default=[100, 200])
+    parser.add_argument('--seeds', nargs='+', type=int, default=[42])
+    parser.add_argument('--start-up-required', type=int, default=1)
+    parser.add_argument('--patron', action='store_true')
+    parser.add_argument('--network', default=None, help="Exchange topology kind (topology.py)")
+    args = parser.parse_args()
+    if args.command == 'clear':
+        default_store.clear()
+    else:
+        built = build(args.policies, args.populations, args.seeds, start_up_required=args.start_up_required,
+                      patron=args.patron, network=args.network)
+        print(f"Burned in {built} new configurations into {default_store.directory}")
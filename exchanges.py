@@ -0,0 +1,153 @@
+'''
+Exchange recording for the wealth inequality model
+
+Every payment made during a step is written into a per-model COO edge buffer
+(payer index, receiver index, amount, kind) that is allocated once and reused
+each step. FlowWindow aggregates those edges over a rolling window of steps
+for the money-flow views.
+'''
+
+from collections import deque
+
+import numpy as np
+
+# Exchange kinds
+SURVIVAL = 0
+THRIVE = 1
+TAX = 2
+PATRON = 3
+KINDS = ["survival", "thrive", "tax", "patron"]
+
+BRACKETS = ["Lower", "Middle", "Upper"]
+
+
+class ExchangeBuffer:
+    '''
+    Preallocated edge list for one step. Capacity grows (doubling) only if a
+    step records more edges than any step before it.
+    '''
+
+    def __init__(self, capacity):
+        capacity = max(int(capacity), 16)
+        self.payer = np.empty(capacity, dtype=np.int32)
+        self.receiver = np.empty(capacity, dtype=np.int32)
+        self.amount = np.empty(capacity, dtype=np.float64)
+        self.kind = np.empty(capacity, dtype=np.int8)
+        self.count = 0
+
+    def reset(self):
+        self.count = 0
+
+    def record(self, payer, receiver, amount, kind):
+        i = self.count
+        if i == len(self.amount):
+            self._grow()
+        self.payer[i] = payer
+        self.receiver[i] = receiver
+        self.amount[i] = amount
+        self.kind[i] = kind
+        self.count = i + 1
+
+    def record_many(self, payer, receiver, amount, kind):
+        """Records a batch of edges (arrays of equal length; amount may be scalar)"""
+        n = len(payer)
+        while self.count + n > len(self.amount):
+            self._grow()
+        i = self.count
+        self.payer[i:i + n] = payer
+        self.receiver[i:i + n] = receiver
+        self.amount[i:i + n] = amount
+        self.kind[i:i + n] = kind
+        self.count = i + n
+
+    def _grow(self):
+        size = 2 * len(self.amount)
+        for name in ("payer", "receiver", "amount", "kind"):
+            old = getattr(self, name)
+            new = np.empty(size, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def view(self):
+        """(payer, receiver, amount, kind) arrays for the current step; not copies"""
+        n = self.count
+        return self.payer[:n], self.receiver[:n], self.amount[:n], self.kind[:n]
+
+    def as_array(self):
+        """Compact (n, 4) copy of the current step, used by the result cache"""
+        payer, receiver, amount, kind = self.view()
+        return np.column_stack([payer, receiver, amount, kind]).astype(float)
+
+
+def edge_list(edges, uids):
+    """[payer_uid, receiver_uid, amount, kind] rows from an (n, 4) edge array"""
+    if not len(edges):
+        return []
+    payer = uids[edges[:, 0].astype(int)].tolist()
+    receiver = uids[edges[:, 1].astype(int)].tolist()
+    return [[p, r, amount, KINDS[int(kind)]]
+            for p, r, amount, kind in zip(payer, receiver, edges[:, 2].tolist(), edges[:, 3].tolist())]
+
+
+class FlowWindow:
+    '''
+    Rolling aggregate of money flows over the last `window` steps:
+    a Lower/Middle/Upper payer -> receiver matrix, totals by kind, and
+    per-agent paid/received totals for top-k queries. Per-agent totals are
+    kept as running sums over a ring of per-step vectors, so memory is
+    window * population floats.
+    '''
+
+    def __init__(self, window, population):
+        self.window = window
+        self.population = population
+        self.steps = deque()
+        self.brackets = np.zeros(9)
+        self.kinds = np.zeros(len(KINDS))
+        self.paid = np.zeros(population)
+        self.received = np.zeros(population)
+
+    def update(self, payer, receiver, amount, kind, bracket_codes):
+        """Add one step of edges; bracket_codes holds each agent's 0/1/2 bracket"""
+        payer = np.asarray(payer, dtype=np.int64)
+        receiver = np.asarray(receiver, dtype=np.int64)
+        cells = bracket_codes[payer] * 3 + bracket_codes[receiver]
+        step = (np.bincount(cells, weights=amount, minlength=9),
+                np.bincount(np.asarray(kind, dtype=np.int64), weights=amount, minlength=len(KINDS)),
+                np.bincount(payer, weights=amount, minlength=self.population),
+                np.bincount(receiver, weights=amount, minlength=self.population))
+        self._add(step, 1)
+        self.steps.append(step)
+        if len(self.steps) > self.window:
+            self._add(self.steps.popleft(), -1)
+
+    def update_edges(self, edges, bracket_codes):
+        """update() from an (n, 4) edge array as stored by the result cache"""
+        self.update(edges[:, 0].astype(np.int64), edges[:, 1].astype(np.int64), edges[:, 2],
+                    edges[:, 3].astype(np.int64), np.asarray(bracket_codes, dtype=np.int64))
+
+    def _add(self, step, sign):
+        brackets, kinds, paid, received = step
+        self.brackets += sign * brackets
+        self.kinds += sign * kinds
+        self.paid += sign * paid
+        self.received += sign * received
+
+    def summary(self, uids, top_k=10):
+        top_k = max(0, min(int(top_k), self.population))
+
+        def top(totals):
+            if top_k == 0:
+                return []
+            idx = np.argpartition(totals, -top_k)[-top_k:]
+            idx = idx[np.argsort(totals[idx])[::-1]]
+            return [[int(uids[i]), float(totals[i])] for i in idx if totals[i] > 0]
+
+        return {
+            'window': len(self.steps),
+            'brackets': BRACKETS,
+            'bracket_matrix': self.brackets.reshape(3, 3).tolist(),
+            'by_kind': dict(zip(KINDS, self.kinds.tolist())),
+            'top_payers': top(self.paid),
+            'top_receivers': top(self.received),
+        }
@@ -1,12 +1,17 @@
-from flask import Flask, render_template
+from flask import Blueprint, render_template
 
-capitalism = Flask(__name__)
+# Mounted by the main app (app.py) at /explain/capitalism
+capitalism = Blueprint('capitalism', __name__, template_folder='templates')
 
-@capitalism.route('/')
+@capitalism.route('')
 def home():
     return render_template('capitalism.html')
 
 if __name__ == '__main__':
+    # Standalone: runs the main app, which serves this page and its assets
+    import os, sys
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from app import app
     print("Starting Capitalism Simulation Server...")
-    print("Open your browser to: http://127.0.0.1:7063")
-    capitalism.run(debug=True, port=7063)
\ No newline at end of file
+    print("Open your browser to: http://127.0.0.1:7063/explain/capitalism")
+    app.run(debug=True, port=7063)
\ No newline at end of file
@@ -1,13 +1,17 @@
-from flask import Flask, render_template
+from flask import Blueprint, render_template
 
-econophysics = Flask(__name__)
+# Mounted by the main app (app.py) at /explain/econophysics
+econophysics = Blueprint('econophysics', __name__, template_folder='templates')
 
-@econophysics.route('/')
+@econophysics.route('')
 def home():
     return render_template('index.html')
 
 if __name__ == '__main__':
-    # Runs the server on localhost:5000
+    # Standalone: runs the main app, which serves this page and its assets
+    import os, sys
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from app import app
     print("Starting Flask server...")
-    print("Open your browser to: http://127.0.0.1:7060")
-    econophysics.run(debug=True, port=7060)
\ No newline at end of file
+    print("Open your browser to: http://127.0.0.1:7060/explain/econophysics")
+    app.run(debug=True, port=7060)
\ No newline at end of file
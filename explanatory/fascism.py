@@ -1,12 +1,17 @@
-from flask import Flask, render_template
+from flask import Blueprint, render_template
 
-fascism = Flask(__name__)
+# Mounted by the main app (app.py) at /explain/fascism
+fascism = Blueprint('fascism', __name__, template_folder='templates')
 
-@fascism.route('/')
+@fascism.route('')
 def home():
     return render_template('fascism.html')
 
 if __name__ == '__main__':
+    # Standalone: runs the main app, which serves this page and its assets
+    import os, sys
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from app import app
     print("Starting Fascism Simulation Server...")
-    print("Open your browser to: http://127.0.0.1:7062")
-    fascism.run(debug=True, port=7062)
\ No newline at end of file
+    print("Open your browser to: http://127.0.0.1:7062/explain/fascism")
+    app.run(debug=True, port=7062)
\ No newline at end of file
@@ -0,0 +1,214 @@
+'''
+Streaming export of run history as CSV or Arrow IPC
+
+Two tables can be exported from any run (WealthModel, CachedRun, a branch
+fork, or one comparison sub-model):
+
+- model: step, Gini, Total, Mobility. One row per step.
+- agents: step, agent_id, wealth, bracket, mobility. One row per agent per
+  step. Recorded history comes from the result cache rows of a cached run,
+  or from the agent records of the DataCollector (object agents). Replay
+  runs rebuild each step from their ReplayLog (replay.py), passed as
+  `replay`. Other compact populations keep no per-agent history, so they
+  export only their current step. Runs downscaled by memory.py record
+  agents every n-th step and export only those steps.
+
+Both tables support column selection, a step range (start..stop inclusive,
+every n-th step) and agent subsampling (every `sample`-th agent).
+
+An export is planned once: plan() resolves the range and splits it into
+chunks of about SIM_EXPORT_CHUNK_ROWS rows. Each chunk is then encoded on
+its own by chunk(plan, index). Memory therefore stays at one chunk whatever
+the run length, and the daemon can serve an export one chunk per request
+without holding any state between them. The chunks concatenate to one
+valid file:
+
+- CSV: the header is in chunk 0.
+- Arrow: the IPC stream format. Chunk 0 starts with the schema message,
+  each chunk holds one record batch, and the last chunk ends with the
+  end-of-stream marker.
+
+Arrow needs the optional pyarrow package.
+
+Python API:
+
+    import export
+    with open("run.csv", "wb") as f:
+        export.write(model, f, table="agents", start=100, sample=10)
+'''
+
+import csv
+import io
+import math
+import os
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+except ImportError:  # optional: CSV only
+    pa = None
+
+EXPORT_CHUNK_ROWS = int(os.environ.get('SIM_EXPORT_CHUNK_ROWS', 65536))
+
+FORMATS = ('csv', 'arrow')
+TABLES = ('model', 'agents')
+MODEL_COLUMNS = ('step', 'Gini', 'Total', 'Mobility')
+AGENT_COLUMNS = ('step', 'agent_id', 'wealth', 'bracket', 'mobility')
+MIMETYPES = {'csv': 'text/csv', 'arrow': 'application/vnd.apache.arrow.stream'}
+BRACKETS = np.array(["Lower", "Middle", "Upper"])
+BRACKET_CODES = {"Lower": 0, "Middle": 1, "Upper": 2}
+ARROW_EOS = b'\xff\xff\xff\xff\x00\x00\x00\x00'
+
+
+# --- Sources ---
+def agent_steps(model, replay=None):
+    """(first, last) step with per-agent history"""
+    entry = getattr(model, 'entry', None)
+    if entry is not None or replay is not None:
+        return 0, model.steps
+    if not model.datacollector.agent_reporters:
+        return model.steps, model.steps     # compact agents record no per-agent history
+    parent = getattr(model, 'history_parent', None)
+    if parent is not None:
+        return min(agent_steps(parent)[0], model.fork_step), model.steps
+    records = model.datacollector._agent_records
+    return min(min(records, default=model.steps), model.steps), model.steps
+
+
+def agent_frame(model, step, replay=None):
+    """Columns of every agent at step: agent_id, wealth, bracket (0/1/2), mobility"""
+    if replay is not None and step != model.steps:
+        return agent_frame(replay.at(step), step)
+    entry = getattr(model, 'entry', None)
+    if entry is not None:
+        row = entry.rows[step]
+        return {'agent_id': np.asarray(entry.uids), 'wealth': row['wealth'],
+                'bracket': row['bracket'], 'mobility': row['mobility']}
+    parent = getattr(model, 'history_parent', None)
+    if parent is not None and step <= model.fork_step:
+        return agent_frame(parent, step)
+    records = model.datacollector._agent_records.get(step) if step != model.steps else None
+    if records:
+        # (step, agent_id, Wealth, Bracket, Pay, Mobility) per agent
+        _, uids, wealth, brackets, _, mobility = zip(*records)
+        return {'agent_id': np.array(uids, dtype=np.int64), 'wealth': np.array(wealth, dtype=float),
+                'bracket': np.array([BRACKET_CODES[b] for b in brackets], dtype=np.int8),
+                'mobility': np.array(mobility, dtype=float)}
+    if step != model.steps:
+        raise ValueError(f"No agent history recorded for step {step}")
+    return {'agent_id': np.asarray(model.agent_uids), 'wealth': np.asarray(model.agent_values("wealth"), dtype=float),
+            'bracket': model.bracket_codes(), 'mobility': np.asarray(model.agent_values("mobility"), dtype=float)}
+
+
+# --- Planning ---
+def plan(model, table='model', format='csv', columns=None, start=None, stop=None, every=1, sample=1,
+         replay=None):
+    """Validated export settings with the resolved step range and chunk layout"""
+    if table not in TABLES:
+        raise ValueError(f"table must be one of {TABLES}")
+    if format not in FORMATS:
+        raise ValueError(f"format must be one of {FORMATS}")
+    if format == 'arrow' and pa is None:
+        raise ValueError("Arrow export needs the pyarrow package")
+    available = MODEL_COLUMNS if table == 'model' else AGENT_COLUMNS
+    columns = list(columns or available)
+    unknown = [c for c in columns if c not in available]
+    if unknown or not columns:
+        raise ValueError(f"Unknown columns {unknown}; available: {list(available)}")
+    every, sample = int(every), int(sample)
+    if every < 1 or sample < 1:
+        raise ValueError("every and sample must be at least 1")
+    if start is not None and stop is not None and int(start) > int(stop):
+        raise ValueError(f"start ({start}) must not be after stop ({stop})")
+
+    if table == 'model':
+        first, last = 1, model.steps
+        rows_per_step = 1
+    else:
+        first, last = agent_steps(model, replay)
+        rows_per_step = max(1, math.ceil(model.population / sample))
+        recorded = getattr(model, 'entry', None) is None and replay is None
+        stride = getattr(model, 'agent_record_every', 1) if recorded else 1
+        if stride > 1:
+            # Agents are recorded every stride-th step (memory.py downscaling)
+            every = math.lcm(every, stride)
+            first = -(-first // stride) * stride
+    requested = start is not None or stop is not None
+    start = first if start is None else max(int(start), first)
+    stop = last if stop is None else min(int(stop), last)
+    if requested and start > stop:
+        raise ValueError(f"No {table} history in the requested steps; recorded steps are {first} to {last}")
+    steps = len(range(start, stop + 1, every))
+    steps_per_chunk = max(1, EXPORT_CHUNK_ROWS // rows_per_step)
+    return {'table': table, 'format': format, 'columns': columns, 'start': start, 'stop': stop,
+            'every': every, 'sample': sample, 'rows': steps * rows_per_step,
+            'steps_per_chunk': steps_per_chunk, 'chunks': max(1, math.ceil(steps / steps_per_chunk))}
+
+
+def _chunk_columns(model, plan, index, replay=None):
+    steps = range(plan['start'], plan['stop'] + 1, plan['every'])
+    steps = steps[index * plan['steps_per_chunk']:(index + 1) * plan['steps_per_chunk']]
+    if plan['table'] == 'model':
+        values = {name: model.series(name) for name in MODEL_COLUMNS[1:] if name in plan['columns']}
+        data = {'step': np.array(steps, dtype=np.int64)}
+        for name, series in values.items():
+            # series[i] is the value after step i + 1
+            data[name] = np.array([series[step - 1] for step in steps], dtype=float)
+        return data
+    frames = []
+    for step in steps:
+        try:
+            values = agent_frame(model, step, replay)
+        except ValueError:
+            continue    # not recorded: the agent-record rate was lowered to fit the memory budget
+        frame = {name: column[::plan['sample']] for name, column in values.items()}
+        frame['step'] = np.full(len(frame['agent_id']), step, dtype=np.int64)
+        frames.append(frame)
+    if not frames:
+        # Typed like a filled chunk, so the Arrow schema still applies
+        return {'step': np.zeros(0, dtype=np.int64), 'agent_id': np.zeros(0, dtype=np.int64),
+                'wealth': np.zeros(0), 'bracket': BRACKETS[:0], 'mobility': np.zeros(0)}
+    data = {name: np.concatenate([frame[name] for frame in frames]) for name in AGENT_COLUMNS}
+    data['bracket'] = BRACKETS[data['bracket'].astype(np.int64)]
+    return data
+
+
+def _arrow_schema(plan):
+    types = {'step': pa.int64(), 'agent_id': pa.int64(), 'bracket': pa.string()}
+    return pa.schema([(name, types.get(name, pa.float64())) for name in plan['columns']])
+
+
+def chunk(model, plan, index, replay=None):
+    """Encoded bytes of chunk index (0 <= index < plan['chunks'])"""
+    data = _chunk_columns(model, plan, index, replay)
+    columns = plan['columns']
+    if plan['format'] == 'csv':
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator='\n')
+        if index == 0:
+            writer.writerow(columns)
+        writer.writerows(zip(*(data[name].tolist() for name in columns)))
+        return out.getvalue().encode()
+    schema = _arrow_schema(plan)
+    batch = pa.RecordBatch.from_arrays([pa.array(data[name], type=schema.field(name).type) for name in columns],
+                                       schema=schema)
+    parts = [schema.serialize().to_pybytes()] if index == 0 else []
+    if batch.num_rows:
+        parts.append(batch.serialize().to_pybytes())
+    if index == plan['chunks'] - 1:
+        parts.append(ARROW_EOS)
+    return b''.join(parts)
+
+
+def stream(model, **options):
+    """Yields the export of model chunk by chunk (options as for plan())"""
+    settings = plan(model, **options)
+    for index in range(settings['chunks']):
+        yield chunk(model, settings, index, options.get('replay'))
+
+
+def write(model, fp, **options):
+    """Writes the export to a binary file object"""
+    for data in stream(model, **options):
+        fp.write(data)
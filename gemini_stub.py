@@ -0,0 +1,64 @@
+'''
+Offline stand-in for google.genai.Client
+
+Implements just the surface the app uses, client.models.generate_content(...),
+and returns a canned, valid policy response. Select it with GEMINI_STUB=1
+(chat_tasks.get_client) to exercise the chat pipeline without an API key or quota.
+'''
+
+import json
+import threading
+import time
+
+DEFAULT_RESPONSE = {
+    "description": "1. Every agent richer than the upper bracket pays 10% of their wealth as tax. "
+                   "2. The tax is removed from the economy.",
+    "python_code": "class StubTaxRich:\n"
+                   "    def execute(self, agent, model):\n"
+                   "        if agent.wealth > model.brackets[1]:\n"
+                   "            agent.wealth -= agent.wealth * 0.1\n"
+                   "    def execute_batch(self, pop, model):\n"
+                   "        rich = pop.wealth > model.brackets[1]\n"
+                   "        pop.wealth[rich] -= pop.wealth[rich] * 0.1\n",
+    "block_json": {"type": "stub_tax_rich", "message0": "Tax The Rich (stub)",
+                   "previousStatement": None, "nextStatement": None, "colour": 0},
+    "block_generator": "Blockly.Python.forBlock['stub_tax_rich'] = function(block) "
+                       "{ return 'StubTaxRich().execute(self, self.model)\\n'; };",
+}
+
+
+class StubResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class StubModels:
+    def __init__(self, client):
+        self.client = client
+
+    def generate_content(self, model=None, contents=None, config=None):
+        client = self.client
+        with client.lock:
+            client.calls.append({'model': model, 'contents': contents})
+            index = min(len(client.calls), len(client.responses)) - 1
+        if client.latency:
+            time.sleep(client.latency)
+        response = client.responses[index]
+        if isinstance(response, Exception):
+            raise response
+        return StubResponse(response if isinstance(response, str) else json.dumps(response))
+
+
+class StubGeminiClient:
+    '''
+    responses: payloads returned in order (dicts are JSON-encoded, strings are
+    returned verbatim, exceptions are raised); the last one repeats.
+    latency: seconds to sleep per call, to mimic network round trips.
+    '''
+
+    def __init__(self, responses=None, latency=0.0):
+        self.responses = list(responses or [DEFAULT_RESPONSE])
+        self.latency = latency
+        self.calls = []
+        self.lock = threading.Lock()
+        self.models = StubModels(self)
@@ -0,0 +1,56 @@
+# Picked up automatically by `gunicorn app:app` (see render.yaml)
+
+import os
+import socket
+import subprocess
+import sys
+import time
+
+# With SIM_DAEMON_SOCKET set, the master starts the simulation daemon before
+# forking workers, so any number of workers (WEB_CONCURRENCY) share one model.
+# Set SIM_DAEMON_EXTERNAL=1 when the daemon is run separately.
+DAEMON_SOCKET = os.environ.get('SIM_DAEMON_SOCKET')
+DAEMON_START_TIMEOUT = 30
+_daemon = None
+
+
+def _daemon_listening():
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(DAEMON_SOCKET)
+        return True
+    except OSError:
+        return False
+    finally:
+        probe.close()
+
+
+def on_starting(server):
+    global _daemon
+    if not DAEMON_SOCKET or os.environ.get('SIM_DAEMON_EXTERNAL'):
+        return
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sim_daemon.py')
+    _daemon = subprocess.Popen([sys.executable, script, '--socket', DAEMON_SOCKET])
+    deadline = time.monotonic() + DAEMON_START_TIMEOUT
+    while not _daemon_listening():
+        if _daemon.poll() is not None or time.monotonic() > deadline:
+            raise RuntimeError(f"Simulation daemon failed to start on {DAEMON_SOCKET}")
+        time.sleep(0.1)
+    server.log.info(f"Simulation daemon (pid {_daemon.pid}) listening on {DAEMON_SOCKET}")
+
+
+def on_exit(server):
+    if _daemon is not None and _daemon.poll() is None:
+        _daemon.terminate()
+        try:
+            _daemon.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            _daemon.kill()
+
+
+def post_worker_init(worker):
+    # Build the default model in the background so the first request doesn't
+    # pay for importing mesa; the worker starts accepting connections at once.
+    # A no-op when the daemon owns the model.
+    import app
+    app.start_preload()
@@ -0,0 +1,423 @@
+'''
+Background simulation jobs
+
+Long runs (many steps, large or comparison populations, parameter sweeps)
+are submitted to /api/jobs instead of running inside a web request. A
+JobQueue in the web process keeps the queue and the job records. The
+simulations themselves run in a pool of pre-warmed worker processes,
+separate from the web workers, in the same way as policy_sandbox. No
+external broker is needed.
+
+- Priority: small jobs (at most SIM_JOB_INTERACTIVE_WORK agent-steps) are
+  "interactive" and always dequeue before "batch" jobs. With more than one
+  worker, one worker only takes interactive jobs, so a long sweep never
+  blocks a short run.
+- Bounded queue: submit() raises QueueFull past SIM_JOB_QUEUE_DEPTH
+  waiting jobs.
+- Progress: workers report the fraction of steps done, at most a few
+  times per second.
+- Cancel and timeout: a running job's worker is killed and replaced.
+- Retention: finished jobs and their results are kept for
+  SIM_JOB_RESULT_TTL seconds.
+- Memory: a worker runs one configuration at a time, with no per-agent
+  records. Each run must fit SIM_MEMORY_BUDGET_MB on its own (memory.py),
+  else the job is refused with MemoryBudgetError.
+
+Workers receive a snapshot of the policy registry with each job, so custom
+policies and Blockly step logic apply as they do in the web process.
+'''
+
+import heapq
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+import uuid
+
+import memory
+import topology
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.environ.get('SIM_JOB_WORKERS', 2))
+JOB_QUEUE_DEPTH = int(os.environ.get('SIM_JOB_QUEUE_DEPTH', 32))
+JOB_RESULT_TTL = float(os.environ.get('SIM_JOB_RESULT_TTL', 3600))
+JOB_TIMEOUT = float(os.environ.get('SIM_JOB_TIMEOUT', 3600))
+JOB_MAX_STEPS = int(os.environ.get('SIM_JOB_MAX_STEPS', 10000))
+JOB_MAX_POPULATION = int(os.environ.get('SIM_JOB_MAX_POPULATION', 1000000))
+JOB_MAX_SWEEP = int(os.environ.get('SIM_JOB_MAX_SWEEP', 64))
+# Jobs up to this many agent-steps (population * steps, summed) count as interactive
+JOB_INTERACTIVE_WORK = int(os.environ.get('SIM_JOB_INTERACTIVE_WORK', 200000))
+PROGRESS_INTERVAL = 0.25
+
+POLICIES = ["econophysics", "fascism", "communism", "capitalism", "comparison"]
+PRIORITIES = {"interactive": 0, "batch": 1}
+KINDS = ("run", "sweep")
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+
+class QueueFull(Exception):
+    pass
+
+
+# --- Job parameters ---
+def run_params(data):
+    """Validated parameters of one simulation run; raises ValueError"""
+    params = {
+        'policy': str(data.get('policy', 'econophysics')),
+        'population': int(data.get('population', 200)),
+        'start_up_required': int(data.get('start_up_required', 1)),
+        'patron': bool(data.get('patron', False)),
+        'rng': int(data.get('rng', data.get('seed', 42))),
+        'steps': int(data.get('steps', 100)),
+        'statistics': data.get('statistics') or None,
+        'until_converged': bool(data.get('until_converged', False)),
+        'include_wealth': bool(data.get('include_wealth', False)),
+        # Exchange topology (topology.py): a kind name or {"kind", "degree", "rewire"}
+        'network': topology.parse(data.get('network'), allow_files=False),
+        # "fresh" or "equilibrium" (a burned-in population, equilibrium.py)
+        'initial_state': data.get('initial_state') or 'fresh',
+    }
+    if params['policy'] not in POLICIES:
+        raise ValueError(f"policy must be one of {POLICIES}")
+    if not 0 < params['population'] <= JOB_MAX_POPULATION:
+        raise ValueError(f"population must be between 1 and {JOB_MAX_POPULATION}")
+    if not 0 < params['steps'] <= JOB_MAX_STEPS:
+        raise ValueError(f"steps must be between 1 and {JOB_MAX_STEPS}")
+    if params['statistics'] not in (None, 'exact', 'approximate'):
+        raise ValueError("statistics must be 'exact' or 'approximate'")
+    if params['initial_state'] not in ('fresh', 'equilibrium'):
+        raise ValueError("initial_state must be 'fresh' or 'equilibrium'")
+    return params
+
+
+def job_spec(data):
+    """(kind, params, work) from a request body; raises ValueError"""
+    kind = data.get('kind', 'run')
+    if kind not in KINDS:
+        raise ValueError(f"kind must be one of {KINDS}")
+    if kind == 'run':
+        params = run_params(data)
+        runs = [params]
+    else:
+        configs = data.get('configs')
+        if not isinstance(configs, list) or not configs:
+            raise ValueError("a sweep needs a non-empty 'configs' list")
+        if len(configs) > JOB_MAX_SWEEP:
+            raise ValueError(f"a sweep may have at most {JOB_MAX_SWEEP} configs")
+        defaults = {k: v for k, v in data.items() if k not in ('kind', 'configs', 'priority')}
+        runs = [run_params({**defaults, **config}) for config in configs]
+        params = {'runs': runs}
+    for run in runs:
+        memory.check(run_bytes(run), what=f"A {run['policy']} job of {run['population']} agents "
+                                          f"for {run['steps']} steps")
+    work = sum(run['population'] * run['steps'] * (4 if run['policy'] == 'comparison' else 1) for run in runs)
+    return kind, params, work
+
+
+def run_bytes(params):
+    """Bytes a worker holds for one run: its models, their reporters and any burn-in model"""
+    configs = [dict(config, flow_window=0) for config in memory.run_configs(
+        params['policy'], params['population'], cacheable=False, agent_record_every=0, network=params['network'])]
+    needed = memory.estimate(configs, params['steps'])
+    if params['initial_state'] == 'equilibrium':
+        # equilibrium.burn_in builds a second model of the same size
+        needed += max(memory.build_bytes(config) for config in configs)
+    return needed
+
+
+# --- Worker side ---
+def _run_model(params, report):
+    from model import WealthModel
+    import convergence
+
+    model = WealthModel(policy=params['policy'], population=params['population'],
+                        start_up_required=params['start_up_required'], patron=params['patron'],
+                        rng=params['rng'], statistics=params['statistics'],
+                        network=params.get('network'), initial_state=params.get('initial_state', 'fresh'),
+                        agent_record_every=0)
+    steps = params['steps']
+    if params['until_converged']:
+        convergence.run_until_converged(model, steps, on_step=lambda done: report(done / steps))
+    else:
+        for done in range(1, steps + 1):
+            model.step()
+            report(done / steps)
+
+    runs = model.comparison_models if model.policy == "comparison" else {model.policy: model}
+    result = {'steps': model.steps, 'converged_step': model.converged_step, 'policies': {}}
+    for policy, run in runs.items():
+        summary = {'metrics': run.metrics(), 'converged_step': run.converged_step,
+                   'series': {name: run.series(name) for name in ("Gini", "Total", "Mobility", "Transitions")}}
+        if params['include_wealth']:
+            summary['wealth'] = run.wealth_values()
+        result['policies'][policy] = summary
+    return result
+
+
+def run_job(kind, params, report):
+    if kind == 'run':
+        return _run_model(params, report)
+    runs = params['runs']
+    results = []
+    for i, run in enumerate(runs):
+        results.append({'params': run, **_run_model(run, lambda fraction: report((i + fraction) / len(runs)))})
+    return {'runs': results}
+
+
+def _worker_main(conn):
+    # Pre-warm the simulation imports before the first job
+    from policy_registry import registry
+    import model  # noqa: F401
+    registry.snapshot_file = None   # workers never write the shared snapshot
+    loaded = None
+    conn.send(('ready', None))
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        last = [0.0]
+
+        def report(fraction):
+            now = time.monotonic()
+            if now - last[0] >= PROGRESS_INTERVAL:
+                last[0] = now
+                conn.send(('progress', fraction))
+
+        try:
+            if job['registry'] != loaded:
+                registry.reset(persist=False)
+                registry.restore(job['registry'])
+                loaded = job['registry']
+            conn.send(('done', run_job(job['kind'], job['params'], report)))
+        except Exception as e:
+            conn.send(('failed', {'error': f"{type(e).__name__}: {e}", 'traceback': traceback.format_exc()}))
+
+
+class JobWorker:
+    def __init__(self, ctx):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join(timeout=1)
+        self.conn.close()
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except (OSError, BrokenPipeError):
+            pass
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.kill()
+
+
+# --- Web side ---
+class Job:
+    def __init__(self, kind, params, priority, work):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.priority = priority
+        self.work = work
+        self.status = QUEUED
+        self.progress = 0.0
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancel_requested = False
+
+    def describe(self):
+        return {'id': self.id, 'kind': self.kind, 'status': self.status, 'priority': self.priority,
+                'progress': round(self.progress, 4), 'work': self.work, 'params': self.params,
+                'created': self.created, 'started': self.started, 'finished': self.finished,
+                'error': self.error}
+
+
+class JobQueue:
+
+    def __init__(self, workers=JOB_WORKERS, depth=JOB_QUEUE_DEPTH, ttl=JOB_RESULT_TTL, timeout=JOB_TIMEOUT):
+        self.depth = depth
+        self.ttl = ttl
+        self.timeout = timeout
+        self.ctx = multiprocessing.get_context('spawn')
+        self.cond = threading.Condition()
+        self.jobs = {}
+        self.waiting = []             # heap of (priority, sequence, job id)
+        self.sequence = itertools.count()
+        self.closed = False
+        self.runners = []
+        for slot in range(max(1, workers)):
+            # With several workers, slot 0 is kept for interactive jobs
+            interactive_only = workers > 1 and slot == 0
+            thread = threading.Thread(target=self._runner, args=(interactive_only,),
+                                      name=f"job-runner-{slot}", daemon=True)
+            thread.start()
+            self.runners.append(thread)
+
+    def submit(self, kind, params, work, priority=None):
+        # Heavy jobs are always batch; a client may demote, not promote
+        heavy = work > JOB_INTERACTIVE_WORK
+        if priority not in PRIORITIES or heavy:
+            priority = "batch" if heavy else "interactive"
+        with self.cond:
+            self._expire()
+            if len(self.waiting) >= self.depth:
+                raise QueueFull(f"Job queue is full ({self.depth} waiting)")
+            job = Job(kind, params, priority, work)
+            self.jobs[job.id] = job
+            heapq.heappush(self.waiting, (PRIORITIES[priority], next(self.sequence), job.id))
+            self.cond.notify_all()
+        return job
+
+    def get(self, job_id):
+        with self.cond:
+            self._expire()
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.cond:
+            self._expire()
+            return [job.describe() for job in sorted(self.jobs.values(), key=lambda j: j.created)]
+
+    def cancel(self, job_id):
+        """Cancels a queued job, or flags a running one (its runner kills the worker)"""
+        with self.cond:
+            job = self.jobs.get(job_id)
+            if job is None or job.status in FINISHED:
+                return job
+            job.cancel_requested = True
+            if job.status == QUEUED:
+                self.waiting = [entry for entry in self.waiting if entry[2] != job_id]
+                heapq.heapify(self.waiting)
+                self._finish(job, CANCELLED)
+            return job
+
+    def stats(self):
+        with self.cond:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return {'workers': len(self.runners), 'depth': self.depth, 'waiting': len(self.waiting),
+                    'jobs': counts}
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        for job_id in [j.id for j in self.jobs.values() if j.status in FINISHED and j.finished < cutoff]:
+            del self.jobs[job_id]
+
+    def _finish(self, job, status, result=None, error=None):
+        job.status = status
+        job.result = result
+        job.error = error
+        job.finished = time.time()
+        if status == DONE:
+            job.progress = 1.0
+
+    def _next(self, interactive_only):
+        """Blocks for the best job this runner may take; None when closed"""
+        with self.cond:
+            while True:
+                if self.closed:
+                    return None
+                if self.waiting and (not interactive_only or self.waiting[0][0] == PRIORITIES["interactive"]):
+                    _, _, job_id = heapq.heappop(self.waiting)
+                    job = self.jobs[job_id]
+                    job.status = RUNNING
+                    job.started = time.time()
+                    return job
+                self.cond.wait()
+
+    def _runner(self, interactive_only):
+        from policy_registry import registry
+        worker = JobWorker(self.ctx)
+        try:
+            while True:
+                job = self._next(interactive_only)
+                if job is None:
+                    return
+                with registry.lock:
+                    snapshot = registry.snapshot()
+                try:
+                    worker = self._run(worker, job, snapshot)
+                except Exception as e:
+                    logger.exception(f"Job {job.id} failed in its runner")
+                    with self.cond:
+                        self._finish(job, FAILED, error=f"{type(e).__name__}: {e}")
+        finally:
+            worker.close()
+
+    def _run(self, worker, job, snapshot):
+        """Runs job on worker; returns the worker to use next (replaced if killed)"""
+        try:
+            worker.conn.send({'kind': job.kind, 'params': job.params, 'registry': snapshot})
+        except (OSError, BrokenPipeError):
+            worker.kill()
+            worker = JobWorker(self.ctx)
+            worker.conn.send({'kind': job.kind, 'params': job.params, 'registry': snapshot})
+        deadline = time.monotonic() + self.timeout
+        while True:
+            if job.cancel_requested or time.monotonic() > deadline:
+                worker.kill()
+                with self.cond:
+                    if job.cancel_requested:
+                        self._finish(job, CANCELLED)
+                    else:
+                        self._finish(job, FAILED, error=f"Job exceeded the {self.timeout:.0f}s time limit")
+                return JobWorker(self.ctx)
+            try:
+                if not worker.conn.poll(0.2):
+                    continue
+                kind, payload = worker.conn.recv()
+            except (EOFError, OSError):
+                worker.kill()
+                with self.cond:
+                    self._finish(job, FAILED, error="Simulation worker exited unexpectedly")
+                return JobWorker(self.ctx)
+            if kind == 'ready':
+                continue
+            if kind == 'progress':
+                job.progress = payload
+            elif kind == 'done':
+                with self.cond:
+                    self._finish(job, DONE, result=payload)
+                return worker
+            else:
+                with self.cond:
+                    self._finish(job, FAILED, error=payload['error'])
+                logger.warning(f"Job {job.id} failed:\n{payload['traceback']}")
+                return worker
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for thread in self.runners:
+            thread.join(timeout=2)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    """Process-wide job queue, started on first use so importing app stays cheap"""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue()
+        return _queue
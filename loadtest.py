@@ -0,0 +1,366 @@
+'''
+Load test that simulates classroom traffic
+
+Replays the request pattern of docs/app.js for N concurrent simulated users
+against a locally started server (or --url):
+
+- POST /api/initialize with a random policy.
+- One second later, GET /api/status and a full chart refresh.
+- Continuous run: every --step-interval seconds (0.5, like the
+  "Run" button), POST /api/step followed by a refresh. A refresh is two
+  parallel groups of requests. The stat cards fetch /data/gini and
+  /data/total-wealth. The person view fetches /status, then
+  /data/wealth-distribution, /data/mobility and /data/exchanges.
+- GET /api/status every 2 seconds.
+- With --chat-fraction, that share of users sends one /api/chat prompt and
+  polls GET /api/chat/<id> every second until the task finishes, like the
+  editor. The time from submit to done is reported as the route "chat
+  (submit to done)". The server runs with GEMINI_STUB=1, so no API key or
+  quota is needed.
+
+Ticks fire on schedule whether or not the previous one has finished, like
+setInterval. An overloaded server therefore sees requests pile up, as it
+would in a classroom. All users share the server's one current model, as
+real sessions do.
+
+The report has, per route, the count, the error rate and the p50/p95/p99
+latency. It also has the server's simulation-lock wait
+(/api/server_stats) and the CPU used by the server's process tree (Linux
+/proc, when this script started the server). Reports can be saved as a
+baseline and later runs compared against it:
+
+    python loadtest.py --users 30 --duration 60
+    python loadtest.py --users 100 --workers 4 --save-baseline loadtest_baseline.json
+    python loadtest.py --users 100 --workers 4 --baseline loadtest_baseline.json
+
+--workers > 1 starts gunicorn with the simulation daemon (SIM_DAEMON_SOCKET).
+The exit status is 1 when a route regresses past the baseline.
+'''
+
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+
+POLICIES = ["econophysics", "fascism", "communism", "capitalism"]
+STATUS_INTERVAL = 2.0
+INIT_DELAY = 1.0
+REQUEST_TIMEOUT = 60
+# The editor polls a queued chat task this often (waitForChat)
+CHAT_POLL_INTERVAL = 1.0
+CHAT_FINISHED = ("done", "failed", "cancelled")
+# A route regresses when its p95 grows by more than this fraction, or its
+# error rate by more than REGRESSION_ERRORS
+REGRESSION_LATENCY = 0.25
+REGRESSION_ERRORS = 0.01
+
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Recorder:
+    """Latency and outcome of every request, by route"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def add(self, route, seconds, ok):
+        with self.lock:
+            self.samples.setdefault(route, []).append((seconds, ok))
+
+    def report(self, duration):
+        routes = {}
+        for route, samples in sorted(self.samples.items()):
+            latency = np.array([s for s, _ in samples]) * 1000
+            errors = sum(1 for _, ok in samples if not ok)
+            p50, p95, p99 = np.percentile(latency, [50, 95, 99]).tolist()
+            routes[route] = {'count': len(samples), 'per_s': round(len(samples) / duration, 2),
+                             'error_rate': round(errors / len(samples), 4),
+                             'p50_ms': round(p50, 1), 'p95_ms': round(p95, 1), 'p99_ms': round(p99, 1)}
+        return routes
+
+
+class Client:
+    def __init__(self, base_url, recorder):
+        self.base_url = base_url.rstrip('/')
+        self.recorder = recorder
+
+    def call(self, method, path, data=None, route=None):
+        """Returns (ok, response body); the latency is recorded under route (default "METHOD path")"""
+        body = json.dumps(data).encode() if data is not None else None
+        req = urllib.request.Request(self.base_url + path, data=body, method=method,
+                                     headers={'Content-Type': 'application/json'} if body else {})
+        start = time.perf_counter()
+        ok, payload = False, b''
+        try:
+            with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT) as response:
+                payload = response.read()
+                ok = response.status < 400
+        except urllib.error.HTTPError as e:
+            payload = e.read()
+            # "Model not initialized" is the app's normal answer before the first initialize
+            ok = e.code == 400 and path.startswith('/api/data/')
+        except (OSError, urllib.error.URLError):
+            ok = False
+        self.recorder.add(route or f"{method} {path}", time.perf_counter() - start, ok)
+        return ok, payload
+
+
+class SimulatedUser:
+    '''One browser tab running the simulator continuously'''
+
+    def __init__(self, index, client, pool, args, rng):
+        self.index = index
+        self.client = client
+        self.pool = pool
+        self.args = args
+        self.rng = rng
+        self.policy = rng.choice(POLICIES)
+        self.chat = rng.random() < args.chat_fraction
+
+    def refresh(self):
+        # refreshCharts(): stat cards and the person view run in parallel
+        cards = [self.pool.submit(self.client.call, 'GET', path)
+                 for path in ('/api/data/gini', '/api/data/total-wealth')]
+        self.client.call('GET', '/api/status')
+        person = [self.pool.submit(self.client.call, 'GET', path)
+                  for path in ('/api/data/wealth-distribution', '/api/data/mobility', '/api/data/exchanges')]
+        wait(cards + person)
+
+    def send_chat(self, deadline):
+        # sendMessage() + waitForChat(): queue the generation, then poll it until it finishes
+        start = time.perf_counter()
+        ok, payload = self.client.call('POST', '/api/chat',
+                                       {'message': f"Tax everyone richer than the upper bracket {self.index % 30 + 1}%"})
+        task = json.loads(payload) if ok else {}
+        while ok and task.get('status') not in CHAT_FINISHED:     # a prompt-cache hit is done at once
+            if time.monotonic() >= deadline:
+                return      # still running when the test ends: no end-to-end sample
+            time.sleep(CHAT_POLL_INTERVAL)
+            ok, payload = self.client.call('GET', f"/api/chat/{task['id']}", route="GET /api/chat/<id>")
+            task = json.loads(payload) if ok else {}
+        self.client.recorder.add("chat (submit to done)", time.perf_counter() - start,
+                                 ok and task.get('status') == "done")
+
+    def tick(self):
+        self.client.call('POST', '/api/step', {})
+        self.refresh()
+
+    def run(self, deadline):
+        # Students do not all click at once
+        time.sleep(self.rng.uniform(0, min(5.0, self.args.duration / 4)))
+        self.client.call('POST', '/api/initialize', {'policy': self.policy, 'population': self.args.population,
+                                                     'patron': False})
+        time.sleep(INIT_DELAY)
+        self.client.call('GET', '/api/status')
+        self.refresh()
+        if self.chat:
+            self.pool.submit(self.send_chat, deadline)
+        next_step = next_status = time.monotonic()
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                return
+            if now >= next_step:
+                self.pool.submit(self.tick)          # fires even if the last tick is still running
+                next_step += self.args.step_interval
+            if now >= next_status:
+                self.pool.submit(self.client.call, 'GET', '/api/status')
+                next_status += STATUS_INTERVAL
+            time.sleep(max(0.0, min(next_step, next_status, deadline) - time.monotonic()))
+
+
+# --- Server ---
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(workers, port):
+    env = dict(os.environ, PORT=str(port), GEMINI_STUB='1', PYTHONUNBUFFERED='1')
+    if workers > 1:
+        env['SIM_DAEMON_SOCKET'] = os.path.join(tempfile.mkdtemp(prefix='loadtest-'), 'sim.sock')
+        command = [sys.executable, '-m', 'gunicorn', '-w', str(workers), '--bind', f'127.0.0.1:{port}', 'app:app']
+    else:
+        env.pop('SIM_DAEMON_SOCKET', None)
+        command = [sys.executable, 'app.py']
+    log = tempfile.NamedTemporaryFile(prefix='loadtest-server-', suffix='.log', delete=False)
+    process = subprocess.Popen(command, cwd=_BASE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited during startup; see {log.name}")
+        try:
+            with urllib.request.urlopen(url + '/api/status', timeout=2):
+                return process, url, log.name
+        except OSError:
+            time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError(f"Server did not answer within 120s; see {log.name}")
+
+
+def _process_tree(pid):
+    pids = [pid]
+    for tid in os.listdir(f'/proc/{pid}/task'):
+        try:
+            with open(f'/proc/{pid}/task/{tid}/children') as f:
+                for child in f.read().split():
+                    pids.extend(_process_tree(int(child)))
+        except OSError:
+            pass
+    return pids
+
+
+def tree_cpu_seconds(pid):
+    """User + system CPU of pid and all its descendants (Linux only), or None"""
+    if pid is None or not os.path.isdir(f'/proc/{pid}'):
+        return None
+    ticks = 0
+    for p in _process_tree(pid):
+        try:
+            with open(f'/proc/{p}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            ticks += int(fields[11]) + int(fields[12])      # utime, stime
+        except (OSError, IndexError, ValueError):
+            pass
+    return ticks / os.sysconf('SC_CLK_TCK')
+
+
+def server_stats(url):
+    try:
+        with urllib.request.urlopen(url + '/api/server_stats', timeout=10) as response:
+            return json.load(response)
+    except (OSError, ValueError):
+        return None
+
+
+# --- Run and compare ---
+def run(args):
+    process = None
+    url = args.url
+    if url is None:
+        process, url, log = start_server(args.workers, args.port or _free_port())
+        print(f"Started server at {url} (log: {log})")
+    try:
+        recorder = Recorder()
+        client = Client(url, recorder)
+        # Each user can have a tick, a status poll and a refresh group in flight
+        pool = ThreadPoolExecutor(max_workers=max(8, args.users * 8))
+        rng = random.Random(args.seed)
+        users = [SimulatedUser(i, client, pool, args, random.Random(rng.random())) for i in range(args.users)]
+        before = server_stats(url)
+        cpu_before = tree_cpu_seconds(process.pid if process else None)
+        start = time.monotonic()
+        deadline = start + args.duration
+        threads = [threading.Thread(target=user.run, args=(deadline,), daemon=True) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        pool.shutdown(wait=True)
+        elapsed = time.monotonic() - start
+        cpu_after = tree_cpu_seconds(process.pid if process else None)
+        after = server_stats(url)
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    report = {'config': {'users': args.users, 'duration': args.duration, 'population': args.population,
+                         'step_interval': args.step_interval, 'chat_fraction': args.chat_fraction,
+                         'workers': args.workers, 'url': args.url},
+              'elapsed_s': round(elapsed, 1), 'routes': recorder.report(elapsed), 'server': {}}
+    if cpu_before is not None and cpu_after is not None:
+        report['server']['cpu_s'] = round(cpu_after - cpu_before, 2)
+        report['server']['cpu_cores'] = round((cpu_after - cpu_before) / elapsed, 2)
+    if before and after:
+        lock_before, lock_after = before['simulation']['lock'], after['simulation']['lock']
+        acquisitions = lock_after['acquisitions'] - lock_before['acquisitions']
+        report['server']['lock'] = {
+            'acquisitions': acquisitions,
+            'wait_total_s': round(lock_after['wait_total_s'] - lock_before['wait_total_s'], 3),
+            'wait_mean_ms': round(1000 * (lock_after['wait_total_s'] - lock_before['wait_total_s'])
+                                  / max(acquisitions, 1), 3),
+            # Over the server's recent acquisitions, which are mostly this run's
+            'wait_p95_ms': lock_after['wait_p95_ms'], 'wait_p99_ms': lock_after['wait_p99_ms'],
+            'wait_max_ms': lock_after['wait_max_ms'],
+        }
+    return report
+
+
+def compare(report, baseline):
+    """Per-route differences against a baseline report; returns (lines, regressed)"""
+    lines, regressed = [], False
+    for route, now in report['routes'].items():
+        then = baseline['routes'].get(route)
+        if then is None:
+            lines.append(f"  {route}: new route")
+            continue
+        growth = (now['p95_ms'] - then['p95_ms']) / max(then['p95_ms'], 1e-9)
+        worse = growth > REGRESSION_LATENCY or now['error_rate'] - then['error_rate'] > REGRESSION_ERRORS
+        regressed = regressed or worse
+        lines.append(f"  {'REGRESSED ' if worse else ''}{route}: p95 {then['p95_ms']} -> {now['p95_ms']} ms "
+                     f"({growth:+.0%}), errors {then['error_rate']:.2%} -> {now['error_rate']:.2%}")
+    if baseline['config'] != report['config']:
+        lines.append(f"  note: baseline config differs: {baseline['config']}")
+    return lines, regressed
+
+
+def print_report(report):
+    print(f"\n{report['config']['users']} users for {report['elapsed_s']}s")
+    print(f"{'route':<36}{'count':>7}{'req/s':>8}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for route, r in report['routes'].items():
+        print(f"{route:<36}{r['count']:>7}{r['per_s']:>8}{r['error_rate']:>8.1%}"
+              f"{r['p50_ms']:>9}{r['p95_ms']:>9}{r['p99_ms']:>9}")
+    server = report['server']
+    if 'cpu_cores' in server:
+        print(f"server CPU: {server['cpu_s']}s ({server['cpu_cores']} cores)")
+    if 'lock' in server:
+        lock = server['lock']
+        print(f"simulation lock: {lock['acquisitions']} acquisitions, mean wait {lock['wait_mean_ms']} ms, "
+              f"p95 {lock['wait_p95_ms']} ms, max {lock['wait_max_ms']} ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Simulate classroom traffic against the simulator")
+    parser.add_argument('--users', type=int, default=30)
+    parser.add_argument('--duration', type=float, default=60, help="Seconds of traffic")
+    parser.add_argument('--population', type=int, default=200)
+    parser.add_argument('--step-interval', type=float, default=0.5, help="Seconds between steps per user")
+    parser.add_argument('--chat-fraction', type=float, default=0.0, help="Share of users who send one chat")
+    parser.add_argument('--workers', type=int, default=1, help="gunicorn workers (>1 uses the simulation daemon)")
+    parser.add_argument('--url', help="Test a running server instead of starting one")
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save-baseline', help="Write the report to this JSON file")
+    parser.add_argument('--baseline', help="Compare against this saved report")
+    args = parser.parse_args()
+
+    report = run(args)
+    print_report(report)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=1)
+        print(f"Saved baseline to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            lines, regressed = compare(report, json.load(f))
+        print(f"\nAgainst {args.baseline}:")
+        print("\n".join(lines))
+        sys.exit(1 if regressed else 0)
@@ -4,18 +4,25 @@ import traceback
 from dotenv import load_dotenv
 import google.genai as genai
 from flask import Flask, request, jsonify
-from app import validate_policy_code, sanitize_ai_response # Reusing your existing logic
+from chat_tasks import generate, prompt_cache, CHAT_FANOUT, CHAT_MAX_FANOUT # Reusing your existing logic
+from policy_sandbox import BATCH_PROMPT
 
 load_dotenv()
 
 app = Flask(__name__)
 client = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
+# Candidates requested at once (speculative mode, see chat_tasks.py); the first valid one is returned
+MCP_FANOUT = int(os.getenv("MCP_FANOUT", CHAT_FANOUT))
 
 @app.route('/mcp/generate_policy', methods=['POST'])
 def mcp_generate_policy():
     user_input = request.json.get("prompt")
+
+    cached = prompt_cache.get(user_input)
+    if cached:
+        return jsonify(cached[0])
     
-    # 1. GENERATION PHASE
+    # 1. GENERATION PHASE (the user idea is appended by generate)
     prompt = (
         "You are a Policy Generator for a Mesa Agent simulation (Mesa 3.0+). "
         "Convert the user's idea into a Python class and a Blockly block definition.\n\n"
@@ -25,35 +32,30 @@ def mcp_generate_policy():
         "2. **SCOPE SAFETY**: This code runs inside `Agent.step(self)`. The variable `model` is NOT global. You MUST use `self.model`.\n"
         "3. **GENERATOR**: In the block generator, pass `self.model` to your class. Ex: `MyPol().execute(self, self.model)`.\n"
         "4. **ATTRIBUTES**: Verify attributes exist. The model has `survival_cost` (NOT survival_amount or threshold).\n\n"
+        + BATCH_PROMPT +
 
         "### OUTPUT FORMAT (Strict JSON) ###\n"
         "Return a single JSON object with ALL four of these fields:\n"
         "{\n"
         '  "description": "A plain-English, numbered step-by-step explanation of exactly what this policy does during each simulation step. Each numbered step should be one sentence. Example: 1. Every agent pays 10% of their wealth as tax. 2. The collected tax is pooled together. 3. The pool is divided equally among agents below the survival threshold.",\n'
-        '  "python_code": "class MyPolicy:\\n    def execute(self, agent, model):\\n        # logic",\n'
+        '  "python_code": "class MyPolicy:\\n    def execute(self, agent, model):\\n        # logic\\n    def execute_batch(self, pop, model):\\n        # optional: the same logic on arrays",\n'
         '  "block_json": { "type": "my_policy", "message0": "Execute My Policy", "previousStatement": null, "nextStatement": null, "colour": 0 },\n'
         '  "block_generator": "Blockly.Python.forBlock[\'my_policy\'] = function(block) { return \'MyPolicy().execute(self, self.model)\\n\'; };"\n'
         "}\n\n"
         "The `description` field is REQUIRED. It must be a numbered list in plain language that a non-programmer can understand. "
         "Do not use code or technical jargon in the description.\n"
-        f"\nUser Idea: {user_input}"
-    )
-    
-    response = client.models.generate_content(
-        model='gemini-2.5-pro',
-        contents=prompt,
-        config={'response_mime_type': 'application/json'}
     )
-    
-    payload = sanitize_ai_response(response.text)
-    
+
     # 2. TEST PHASE (Pre-Verification)
-    # Reuses the MockModel and MockAgent logic from your app.py
-    valid, error_message = validate_policy_code(payload['python_code'])
-    
-    if not valid:
-        # Self-correction loop: Send error back to Gemini to fix once
-        # (This implements your "test the codes prior to providing" requirement)
-        return jsonify({"error": "Validation failed", "details": error_message}), 400
+    # Single shot: each candidate gets the mock smoke test and benchmark in a
+    # policy_sandbox worker. With a fanout above 1 they are requested and
+    # validated in parallel, and the first that passes is returned.
+    fanout = max(1, min(int(request.json.get("fanout", MCP_FANOUT)), CHAT_MAX_FANOUT))
+    log = []
+    payload = generate(client, user_input, log, attempts=1, fanout=fanout, prompt=prompt, model='gemini-2.5-pro')
+
+    if payload is None:
+        return jsonify({"error": "Validation failed", "details": "\n".join(log)}), 400
 
+    prompt_cache.put(user_input, payload)
     return jsonify(payload)
\ No newline at end of file
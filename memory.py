@@ -0,0 +1,403 @@
+'''
+Memory accounting and admission control for simulation models
+
+A run's footprint is what it holds once built plus what it adds per step:
+
+- build: the agents (a WealthAgent object, or a row of compact_agents
+  columns), the preallocated exchange buffer and the rolling money-flow
+  window, per agent, plus the exchange network's adjacency if any
+- per step: the model reporters (a few floats and the transition matrix),
+  plus either the agent-reporter records of the DataCollector (a tuple per
+  agent per recorded step) or, for a cached run, the result cache row
+  (wealth, bracket, mobility and the exchange edges of every agent)
+
+The costs below were measured with tracemalloc. Rerun the measurement after
+changing what a model stores:
+
+    python memory.py calibrate
+
+Admission control keeps the models the daemon holds within
+SIM_MEMORY_BUDGET_MB:
+
+- /api/initialize (including comparison mode, four runs) must fit for
+  SIM_MEMORY_HORIZON_STEPS steps. If the requested configuration does not,
+  it is downscaled along DOWNSCALE: first simulated live instead of cached,
+  then with agents recorded every n-th step, then with no per-agent
+  records, then with compact agents. If nothing fits, it is refused.
+- /api/step?n=, /api/run_until_converged and branch steps must fit their
+  step count. The run's agent-record rate is lowered if needed, else the
+  request is refused.
+
+Refusals raise MemoryBudgetError; the routes answer 413.
+
+footprint() accounts for a model from what it has actually recorded and is
+cheap enough to call on every step. measure() walks the model's object graph
+(sampling long containers) for a measured figure, served at /api/memory next
+to the process RSS.
+'''
+
+import gc
+import os
+import sys
+import types
+from collections import deque
+
+import numpy as np
+
+BUDGET_BYTES = int(float(os.environ.get('SIM_MEMORY_BUDGET_MB', 512)) * 2**20)
+# A new run must fit the budget for this many steps
+HORIZON_STEPS = int(os.environ.get('SIM_MEMORY_HORIZON_STEPS', 1000))
+POLICIES = ("econophysics", "fascism", "communism", "capitalism")
+
+# --- Costs in bytes (python memory.py calibrate) ---
+# Per agent once built, including its share of the exchange buffer
+AGENT_BYTES = {'object': 720, 'compact': 145}
+# Per agent per step recorded by the DataCollector's agent reporters
+AGENT_RECORD_BYTES = 141
+# Per agent per step in a result cache entry; the exchange edges depend on the policy
+CACHE_ROW_BYTES = {'econophysics': 78, 'fascism': 100, 'communism': 78, 'capitalism': 78}
+# Per step: model reporters (object runs also churn a bounded ~100 KB of agent state)
+STEP_BYTES = 1024
+# Per run: the Mesa model, collectors and RNGs
+RUN_BYTES = 64 * 1024
+# Per agent per comparison run: the wealth snapshot kept for the histograms
+COMPARISON_AGENT_BYTES = 64
+# Per agent per step of the rolling money-flow window (paid and received floats)
+FLOW_AGENT_BYTES = 16
+# Per agent per replay keyframe (replay.py: a pickled model without its flow window)
+KEYFRAME_AGENT_BYTES = {'object': 234, 'compact': 134}
+
+# Agent-record rates tried when a run does not fit; 0 records none. Each
+# divides the next, so after a rate is lowered every step of the new rate
+# has been recorded since the run started
+RECORD_EVERY = (1, 2, 4, 8, 16, 32, 64, 0)
+# Settings tried in order for a new run
+DOWNSCALE = ([{'cacheable': True, 'compact_agents': None, 'agent_record_every': 1}]
+             + [{'cacheable': False, 'compact_agents': None, 'agent_record_every': every} for every in RECORD_EVERY]
+             + [{'cacheable': False, 'compact_agents': True, 'agent_record_every': 0}])
+# Settings tried in order for a replay run, which records no agents
+REPLAY_DOWNSCALE = [{'cacheable': False, 'compact_agents': None, 'agent_record_every': 0},
+                    {'cacheable': False, 'compact_agents': True, 'agent_record_every': 0}]
+# Containers longer than this are measured from an evenly spaced sample
+SAMPLE = 100
+
+
+class MemoryBudgetError(Exception):
+    def __init__(self, message, needed, budget):
+        super().__init__(message)
+        self.needed = needed
+        self.budget = budget
+
+    def body(self):
+        return {'error': str(self), 'needed_bytes': int(self.needed), 'budget_bytes': int(self.budget)}
+
+
+def _mb(n):
+    return f"{n / 2**20:.0f} MB"
+
+
+# --- Estimates ---
+def run_config(policy, population, cacheable=True, compact_agents=None, agent_record_every=1, network=None):
+    """What open_run() builds for one single-policy run with these settings"""
+    import topology
+    from model import COMPACT_AGENTS_MIN_POPULATION
+    from result_cache import CACHE_MAX_POPULATION, FLOW_WINDOW
+    cached = cacheable and population <= CACHE_MAX_POPULATION
+    if cached or compact_agents is None:
+        compact_agents = population >= COMPACT_AGENTS_MIN_POPULATION
+    return {'policy': policy, 'population': int(population), 'cached': cached, 'flow_window': FLOW_WINDOW,
+            'engine': 'compact' if compact_agents else 'object',
+            'network_bytes': topology.estimate_bytes(network, population),
+            # Cached runs keep their per-agent history in the entry; compact agents keep none
+            'agent_record_every': 0 if cached or compact_agents else agent_record_every}
+
+
+def run_configs(policy, population, **settings):
+    """One run_config per run: four for comparison mode"""
+    policies = POLICIES if policy == "comparison" else (policy,)
+    return [run_config(name, population, **settings) for name in policies]
+
+
+def _flow_bytes(window, population):
+    # The window's per-step vectors plus the running totals
+    return (window + 2) * population * FLOW_AGENT_BYTES if window else 0
+
+
+def build_bytes(config, comparison=False):
+    size = RUN_BYTES + config['population'] * AGENT_BYTES[config['engine']]
+    size += _flow_bytes(config.get('flow_window', 0), config['population'])
+    size += config.get('network_bytes', 0)
+    if config['cached']:
+        size += config['population'] * CACHE_ROW_BYTES.get(config['policy'], max(CACHE_ROW_BYTES.values()))
+    if comparison:
+        size += config['population'] * COMPARISON_AGENT_BYTES
+    return size
+
+
+def step_bytes(config):
+    size = STEP_BYTES
+    if config['cached']:
+        size += config['population'] * CACHE_ROW_BYTES.get(config['policy'], max(CACHE_ROW_BYTES.values()))
+    elif config['agent_record_every']:
+        size += config['population'] * AGENT_RECORD_BYTES / config['agent_record_every']
+    return size
+
+
+def replay_bytes(config, steps):
+    """Keyframes of a replay run after steps steps, plus its cache of reconstructed states"""
+    import replay
+    keyframes = steps // replay.KEYFRAME_EVERY + 1
+    return (keyframes * config['population'] * KEYFRAME_AGENT_BYTES[config['engine']]
+            + replay.CACHE_STATES * build_bytes(dict(config, flow_window=0)))
+
+
+def estimate(configs, steps, replay=False):
+    """Bytes the runs hold after steps steps"""
+    comparison = len(configs) > 1
+    return sum(build_bytes(config, comparison) + steps * step_bytes(config)
+               + (replay_bytes(config, steps) if replay else 0) for config in configs)
+
+
+# --- Accounting of existing models ---
+def _runs(model):
+    if getattr(model, 'policy', None) == "comparison":
+        return list(model.comparison_models.values())
+    return [model]
+
+
+def footprint(model):
+    """Bytes model holds, from the runs' sizes and the history they have actually recorded"""
+    if model is None:
+        return 0
+    runs = _runs(model)
+    comparison = len(runs) > 1 or model is not runs[0]
+    size = 0
+    for run in runs:
+        flows = getattr(run, 'flows', None)
+        if flows is not None:
+            size += _flow_bytes(len(flows.steps), run.population)
+        network = getattr(getattr(run, 'live', None) or run, 'network', None)
+        if network is not None:
+            size += network.nbytes
+        entry = getattr(run, 'entry', None)
+        if entry is not None:
+            # CachedRun: the entry's arrays, plus its live model once it simulates past the entry
+            size += RUN_BYTES + entry.nbytes() + STEP_BYTES * run.steps
+            if run.live is not None:
+                size += run.population * AGENT_BYTES['object']
+            continue
+        engine = 'compact' if run.agent_table is not None else 'object'
+        size += build_bytes({'population': run.population, 'engine': engine, 'cached': False}, comparison)
+        size += STEP_BYTES * (run.steps - run.fork_step)
+        records = getattr(run.datacollector, '_agent_records', {})
+        size += len(records) * run.population * AGENT_RECORD_BYTES
+    return size
+
+
+def record_every(model):
+    """The agent-record rate of a live run (None for cached runs)"""
+    runs = [run for run in _runs(model) if getattr(run, 'entry', None) is None]
+    return max((run.agent_record_every for run in runs), default=None)
+
+
+def _growth(model, steps, every):
+    """Bytes model adds over steps more steps if agents are recorded every `every` steps from now"""
+    size = 0
+    for run in _runs(model):
+        entry = getattr(run, 'entry', None)
+        if entry is not None:
+            # Replayed steps are already in the entry
+            new_steps = max(0, run.steps + steps - entry.steps)
+            row = CACHE_ROW_BYTES.get(run.policy, max(CACHE_ROW_BYTES.values()))
+            size += new_steps * run.population * row + steps * STEP_BYTES
+            continue
+        records = 0 if run.agent_table is not None or not run.agent_record_every else every
+        size += step_bytes({'population': run.population, 'cached': False, 'agent_record_every': records}) * steps
+    return size
+
+
+# --- Admission ---
+def admit_run(policy, population, in_use=0, steps=HORIZON_STEPS, budget=BUDGET_BYTES, network=None,
+              replay=False):
+    """
+    Settings (open_run keyword arguments) for a new run that fit the budget
+    for steps steps, plus 'estimate_bytes' and 'downscaled'. Raises
+    MemoryBudgetError when even the smallest configuration does not fit.
+    replay runs (replay.py) keep keyframes instead of agent records.
+    """
+    if population < 1:
+        raise ValueError("population must be at least 1")
+    ladder = REPLAY_DOWNSCALE if replay else DOWNSCALE
+    for level, settings in enumerate(ladder):
+        needed = estimate(run_configs(policy, population, network=network, **settings), steps, replay)
+        if in_use + needed <= budget:
+            return dict(settings, estimate_bytes=int(needed), downscaled=level > 0)
+    smallest = estimate(run_configs(policy, population, network=network, **ladder[-1]), 0, replay)
+    if in_use + smallest > budget:
+        message = f"A {policy} run of {population} agents needs about {_mb(smallest)} to build"
+    else:
+        message = f"A {policy} run of {population} agents does not fit in memory for {steps} steps"
+    raise MemoryBudgetError(f"{message}; the budget is {_mb(budget)} ({_mb(in_use)} in use)",
+                            in_use + needed, budget)
+
+
+def admit_steps(model, steps, in_use=0, budget=BUDGET_BYTES):
+    """
+    Makes room for steps more steps of model: lowers its agent-record rate
+    if needed. Returns the new rate, or None when unchanged. Raises
+    MemoryBudgetError when even recording no agents does not fit.
+    """
+    current = footprint(model) + in_use
+    every = record_every(model)
+    if current + _growth(model, steps, every or 0) <= budget:
+        return None
+    if every:
+        for lower in RECORD_EVERY[RECORD_EVERY.index(every) + 1:] if every in RECORD_EVERY else (0,):
+            if current + _growth(model, steps, lower) <= budget:
+                model.set_agent_record_every(lower)
+                return lower
+    needed = current + _growth(model, steps, 0)
+    raise MemoryBudgetError(f"{steps} more steps need about {_mb(needed)}; the budget is {_mb(budget)}. "
+                            "Initialize a new run or delete branches to free memory", needed, budget)
+
+
+def fork_bytes(model):
+    """Bytes a fork of model holds once cloned: its agents, not the history it shares"""
+    engine = 'compact' if getattr(model, 'agent_table', None) is not None else 'object'
+    return RUN_BYTES + model.population * AGENT_BYTES[engine]
+
+
+def check(extra, in_use=0, budget=BUDGET_BYTES, what="This request"):
+    """Raises MemoryBudgetError unless extra more bytes fit"""
+    if in_use + extra > budget:
+        raise MemoryBudgetError(f"{what} needs about {_mb(extra)}; {_mb(in_use)} of the "
+                                f"{_mb(budget)} budget is in use", in_use + extra, budget)
+
+
+# --- Measurement ---
+_OPAQUE = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType)
+# References to memory that belongs to something else
+_SHARED_ATTRS = {'history_parent', 'submodel_factory', 'cache'}
+
+
+def _shared(obj):
+    """Objects Python shares process-wide: singletons and cached small ints"""
+    if obj is None or isinstance(obj, bool):
+        return True
+    return type(obj) is int and -5 <= obj <= 256
+
+
+def _size(obj, seen):
+    if id(obj) in seen or isinstance(obj, _OPAQUE) or _shared(obj):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)       # includes the data of arrays that own it
+    if isinstance(obj, (str, bytes, bytearray, int, float, complex, np.ndarray, np.generic)):
+        return size
+    if isinstance(obj, dict):
+        return size + _sum(list(obj.keys()), seen) + _sum(list(obj.values()), seen)
+    if isinstance(obj, (list, tuple, set, frozenset, deque)):
+        return size + _sum(list(obj), seen)
+    state = getattr(obj, '__dict__', None)
+    if state:
+        size += sys.getsizeof(state) + _sum([value for name, value in state.items() if name not in _SHARED_ATTRS],
+                                            seen)
+    return size + _sum([getattr(obj, name) for name in getattr(type(obj), '__slots__', ())
+                        if isinstance(name, str) and hasattr(obj, name)], seen)
+
+
+def _sum(children, seen):
+    if len(children) > SAMPLE:
+        stride = len(children) / SAMPLE
+        return int(sum(_size(children[int(i * stride)], seen) for i in range(SAMPLE)) * stride)
+    return sum(_size(child, seen) for child in children)
+
+
+def measure(model):
+    """Measured bytes held by model: its object graph, sizing long containers from a sample"""
+    if model is None:
+        return 0
+    return _size(model, set())
+
+
+def rss_bytes():
+    """Resident set size of this process (Linux), or None"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def report(model):
+    """Accounted and measured footprint of a model, for /api/memory"""
+    if model is None:
+        return None
+    return {'accounted_bytes': int(footprint(model)), 'measured_bytes': measure(model),
+            'steps': model.steps, 'agent_record_every': record_every(model)}
+
+
+# --- Calibration ---
+def _traced(build):
+    import tracemalloc
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = build()
+        gc.collect()
+        return result, tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+
+def calibrate(population=2000, compact_population=5000, steps=20, warmup=20):
+    """Measures the costs above with tracemalloc; one row per policy and engine"""
+    import result_cache
+    import tempfile
+    from model import WealthModel
+    rows = []
+    for policy in POLICIES:
+        for engine, size in (('object', population), ('compact', compact_population)):
+            compact = engine == 'compact'
+
+            def build(every=0):
+                model = WealthModel(policy=policy, population=size, compact_agents=compact,
+                                    agent_record_every=every)
+                for _ in range(warmup):     # bracket histories reach their full length
+                    model.step()
+                return model
+
+            per_step = {}
+            for every in ((0,) if compact else (0, 1)):
+                model = build(every)
+                _, grown = _traced(lambda: [model.step() for _ in range(steps)])
+                per_step[every] = grown / steps
+            _, built = _traced(build)
+            rows.append({'policy': policy, 'engine': engine, 'step_bytes': per_step[0],
+                         'agent_bytes': (built - warmup * per_step[0]) / size,
+                         'record_bytes': (per_step[1] - per_step[0]) / size if not compact else None})
+        with tempfile.TemporaryDirectory() as directory:
+            run = result_cache.open_run(policy=policy, population=population,
+                                        cache=result_cache.ResultCache(directory))
+            for _ in range(steps):
+                run.step()
+            # Cached runs are object runs (CACHE_MAX_POPULATION < COMPACT_AGENTS_MIN_POPULATION)
+            rows[-2]['cache_row_bytes'] = run.entry.nbytes() / (run.entry.steps + 1) / population
+    return rows
+
+
+if __name__ == "__main__":
+    import argparse
+    import logging
+    logging.disable(logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['calibrate'])
+    parser.add_argument('--population', type=int, default=2000)
+    parser.add_argument('--compact-population', type=int, default=5000)
+    args = parser.parse_args()
+    print(f"{'policy':<14}{'engine':<9}{'agent B':>9}{'step B':>9}{'record B/agent':>16}{'cache row B/agent':>19}")
+    for row in calibrate(args.population, args.compact_population):
+        optional = [row['record_bytes'], row.get('cache_row_bytes')]
+        print(f"{row['policy']:<14}{row['engine']:<9}{row['agent_bytes']:>9.0f}{row['step_bytes']:>9.0f}"
+              + "".join(f"{'-' if value is None else f'{value:.1f}':>{width}}"
+                        for value, width in zip(optional, (16, 19))))
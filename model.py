@@ -1,13 +1,31 @@
+import os
+
 import mesa
 import numpy as np
-from scipy.stats import expon
-from utilities import calc_brackets
-from agent import WealthAgent
+from utilities import calc_brackets, transition_matrix
+from agent import WealthAgent, CompactWealthAgent
+from compact_agents import AgentTable, BRACKET_CODES
+from policy_registry import registry
 from policyblocks import (Communism, Capitalism, Patron)
+from exchanges import ExchangeBuffer, FlowWindow, edge_list
+from sketches import QuantileSketch
+import convergence
+import equilibrium
+import topology
+
+# Survival cost is this quantile of an exponential distribution scaled to mean wealth
+SURVIVAL_QUANTILE = 0.1
+# Populations from this size store agents in columns (compact_agents.py)
+COMPACT_AGENTS_MIN_POPULATION = int(os.environ.get('SIM_COMPACT_AGENTS_MIN_POPULATION', 10000))
+# "exact" or "approximate": brackets and Gini from a mergeable sketch (sketches.py)
+STATISTICS = os.environ.get('SIM_STATISTICS', 'exact')
+STATISTICS_MODES = ("exact", "approximate")
 
 def compute_gini(model):
     #if not model.agents: return 0
-    agent_wealths = [abs(float(agent.wealth)) for agent in model.agents]
+    if model.statistics == "approximate":
+        return model.wealth_sketch().gini()
+    agent_wealths = [abs(float(wealth)) for wealth in model.agent_values("wealth")]
     x = sorted(agent_wealths)
     N = len(agent_wealths)
     if N == 0: return 0
@@ -16,17 +34,95 @@ def compute_gini(model):
 
 def total_wealth(model): 
     #if not model.agents: return 0
-    return sum([agent.wealth for agent in model.agents])
+    return sum(model.agent_values("wealth"))
 
 def compute_mobility(model):
     #if not model.agents: return 0
-    return np.mean([agent.mobility for agent in model.agents])
+    return np.mean(model.agent_values("mobility"))
+
+def compute_transitions(model):
+    """Last step's 3x3 bracket transition counts (rows: start bracket, columns: end bracket)"""
+    return model.transitions.tolist()
+
+def draw_population(rng, population):
+    """Pay proportion, innovation and party-elite arrays for a new population"""
+    mean = 0.2
+    sigma = 0.05
+    variance = 2 * sigma**2
+
+    payday_array = rng.normal(mean, np.sqrt(variance), population)
+    innovation_array = rng.pareto(2.5, size=population)
+    
+    payday_array = np.around(payday_array, decimals=2)
+    party_elite_cut = np.percentile(payday_array, 95)
+    
+    innovation_array = np.around(innovation_array, decimals=2)
+    innovation_array = np.where(innovation_array < 1, innovation_array + 1, innovation_array)
+    innovation_array = np.where(innovation_array > 3, 3, innovation_array)
+    return payday_array, innovation_array, payday_array >= party_elite_cut
+
+
+class SampledDataCollector(mesa.DataCollector):
+    """DataCollector that records agents only every agent_every-th step (0: never); model reporters every step"""
+
+    def __init__(self, agent_every=1, **kwargs):
+        super().__init__(**kwargs)
+        self.agent_every = agent_every
+
+    def collect(self, model):
+        if self.agent_every == 1 or (self.agent_every and model.steps % self.agent_every == 0):
+            return super().collect(model)
+        reporters, self.agent_reporters = self.agent_reporters, {}
+        try:
+            super().collect(model)
+        finally:
+            self.agent_reporters = reporters
+
        
 class WealthModel(mesa.Model): 
+
+    # Column store of the population when agents are compact, else None
+    agent_table = None
+    # Step at which run_until_converged found the metrics settled
+    converged_step = None
+    # A fork (branches.py) reads its parent's series up to fork_step
+    history_parent = None
+    fork_step = 0
+    # Per-agent records every n-th step (0: none); memory.py lowers this to fit the budget
+    agent_record_every = 1
+    # Exchange topology (topology.py): the parsed spec and its graph; None is well mixed
+    network_spec = None
+    network = None
+    # "fresh" (every agent at wealth 1) or "equilibrium" (burned in, equilibrium.py)
+    initial_state = "fresh"
+    # Description of the burn-in the agents were taken from, if any
+    burn_in = None
     
-    def __init__(self, policy="econophysics", population=100, start_up_required=1, patron=False, rng=42):
+    def __init__(self, policy="econophysics", population=100, start_up_required=1, patron=False, rng=42,
+                 submodel_factory=None, flow_window=0, compact_agents=None, statistics=None,
+                 agent_record_every=1, network=None, initial_state="fresh"):
         
         super().__init__(rng=rng)
+        if initial_state not in equilibrium.INITIAL_STATES:
+            raise ValueError(f"initial_state must be one of {equilibrium.INITIAL_STATES}, not {initial_state!r}")
+        self.initial_state = initial_state
+        statistics = statistics or STATISTICS
+        if statistics not in STATISTICS_MODES:
+            raise ValueError(f"statistics must be one of {STATISTICS_MODES}, not {statistics!r}")
+        self.statistics = statistics
+        # A topology.Network is used as given; anything else is a spec for topology.parse
+        if isinstance(network, topology.Network):
+            self.network_spec, self.network = {'kind': network.kind}, network
+        else:
+            self.network_spec = topology.parse(network)
+        # Compact agents give the same results as WealthAgent objects at a
+        # fraction of the memory; by default they are used for large populations
+        if compact_agents is None:
+            compact_agents = population >= COMPACT_AGENTS_MIN_POPULATION
+        self.compact_agents = compact_agents
+        self.agent_record_every = agent_record_every
+        self.agent_list = []
+        self.seed = rng
         self.policy = policy
         self.population = population
         self.party_elite = None
@@ -35,17 +131,25 @@ class WealthModel(mesa.Model):
         self.start_up_required = start_up_required
         self.patron = patron
         self.total = total_wealth(self)
+        # Bracket transitions over the last step (utilities.transition_matrix)
+        self.transitions = np.zeros((3, 3), dtype=np.int64)
         
         # Initialize containers
         self.comparison_results = {}
         self.comparison_models = {} 
         self.comparison_step_count = 0
+        # Builds comparison sub-models; result_cache.open_run swaps in cached runs
+        self.submodel_factory = submodel_factory or WealthModel
+
+        # Exchange edges of the current step (survival, thrive, tax, patron),
+        # sized for the worst case so the hot loop never allocates
+        self.exchanges = ExchangeBuffer(4 * population)
+        self.agent_uids = np.zeros(0, dtype=np.int64)
+        # Optional rolling money-flow aggregate over the last flow_window steps
+        self.flows = FlowWindow(flow_window, population) if flow_window and policy != "comparison" else None
         
         # Data Collector
-        self.datacollector = mesa.DataCollector(
-            model_reporters={"Gini": compute_gini, "Total": total_wealth, "Mobility": compute_mobility},
-            agent_reporters={"Wealth": "wealth", "Bracket": "bracket", "Pay": "W", "Mobility": "mobility"}
-        )
+        self.datacollector = self.new_datacollector()
 
         # --- LOGIC BRANCHING ---
         if self.policy == "comparison":
@@ -56,35 +160,140 @@ class WealthModel(mesa.Model):
             # If Single Policy Mode: Create agents for this model
             self.create_agents()
             self.initialize_agent_brackets()
+            if self.network_spec is not None and self.network is None:
+                self.network = topology.build(self.network_spec, self.population, self.rng)
+            if initial_state == "equilibrium":
+                self.burn_in = equilibrium.default_store.load(self)
+                self.brackets = calc_brackets(self)
+                self.total = total_wealth(self)
+
+    def new_datacollector(self):
+        model_reporters = {"Gini": compute_gini, "Total": total_wealth, "Mobility": compute_mobility,
+                           "Transitions": compute_transitions}
+        if self.compact_agents:
+            # Per-agent records would store a tuple per agent per step
+            return mesa.DataCollector(model_reporters=model_reporters)
+        return SampledDataCollector(
+            agent_every=self.agent_record_every,
+            model_reporters=model_reporters,
+            agent_reporters={"Wealth": "wealth", "Bracket": "bracket", "Pay": "W", "Mobility": "mobility"}
+        )
+
+    def set_agent_record_every(self, every):
+        """Records agents every n-th step from now on (0: stop); history already recorded is kept"""
+        self.agent_record_every = every
+        for model in self.comparison_models.values():
+            model.set_agent_record_every(every)
+        if hasattr(self.datacollector, 'agent_every'):
+            self.datacollector.agent_every = every
+
+    @property
+    def agents(self):
+        if self.agent_table is not None:
+            return self.agent_table.agents
+        return super().agents
+
+    def random_agent(self):
+        """Uniformly random agent; O(1), unlike indexing the Mesa AgentSet"""
+        return self.random.choice(self.agent_list)
+
+    def random_partner(self, agent):
+        """Exchange partner for agent: a random neighbour in network mode, else random_agent()"""
+        if self.network is None:
+            return self.random_agent()
+        return self.agent_list[self.network.sample(agent.index, self.random)]
+
+    def agent_values(self, name):
+        """An attribute of every agent, in creation order"""
+        if self.agent_table is not None:
+            return self.agent_table.values(name)
+        return [getattr(agent, name) for agent in self.agents]
+
+    def wealth_sketch(self):
+        """Mergeable approximate summary of current wealth (sketches.py)"""
+        return QuantileSketch.from_values(self.agent_values("wealth"))
+
+    # DataCollector reporters are closures and cannot be pickled, so a pickled
+    # model (result cache tail state) restores with a fresh, empty collector.
+    # A fork's parent is not pickled along with it either.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("datacollector", None)
+        state.pop("history_parent", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.datacollector = self.new_datacollector()
+
+    # --- Data accessors (mirrored by result_cache.CachedRun) ---
+    def metrics(self):
+        return {"Gini": compute_gini(self), "Total": total_wealth(self), "Mobility": compute_mobility(self)}
+
+    def series(self, name):
+        """Per-step history of a model reporter (one entry per completed step)"""
+        own = list(self.datacollector.model_vars.get(name, []))
+        if self.history_parent is None:
+            return own
+        return self.history_parent.series(name)[:self.fork_step] + own
+
+    def wealth_values(self):
+        return list(self.agent_values("wealth"))
+
+    def bracket_values(self):
+        return self.agent_values("bracket")
+
+    def agent_records(self):
+        return [{'bracket': bracket, 'mobility': mobility, 'wealth': wealth, 'policy': self.policy}
+                for bracket, mobility, wealth in zip(self.agent_values("bracket"),
+                                                     self.agent_values("mobility"),
+                                                     self.agent_values("wealth"))]
+
+    def bracket_codes(self):
+        if self.agent_table is not None:
+            return self.agent_table.column("bracket").astype(np.int64)
+        return np.array([BRACKET_CODES[agent.bracket] for agent in self.agents], dtype=np.int64)
+
+    def exchange_edges(self):
+        """[payer_uid, receiver_uid, amount, kind] for every payment made last step"""
+        return edge_list(self.exchanges.as_array(), self.agent_uids)
+
+    def flow_summary(self, top_k=10):
+        if self.flows is None:
+            return None
+        return self.flows.summary(self.agent_uids, top_k)
 
     def create_agents(self):
         """Generates the population for a single model instance"""
-        mean = 0.2
-        sigma = 0.05
-        variance = 2 * sigma**2
-
-        payday_array = np.random.normal(mean, np.sqrt(variance), self.population)
-        innovation_array = np.random.pareto(2.5, size=self.population)
-        
-        payday_array = np.around(payday_array, decimals=2)
-        party_elite_cut = np.percentile(payday_array, 95)
-        
-        innovation_array = np.around(innovation_array, decimals=2)
-        innovation_array = np.where(innovation_array < 1, innovation_array + 1, innovation_array)
-        innovation_array = np.where(innovation_array > 3, 3, innovation_array)
+        # Draw from the model's seeded generator so runs are reproducible
+        payday_array, innovation_array, elite_array = draw_population(self.rng, self.population)
         
+        if self.compact_agents:
+            # One batched build of the column store; no per-agent objects
+            self.agent_table = AgentTable(self, payday_array, innovation_array, elite_array,
+                                          view_class=CompactWealthAgent)
+            self.agent_list = self.agent_table.agents
+            self.agent_uids = np.arange(1, self.population + 1, dtype=np.int64)
+            return
+
         for idx in range(self.population):
-            party_elite = False
-            if payday_array[idx] >= party_elite_cut: 
-                party_elite = True
+            party_elite = bool(elite_array[idx])
             # Note: We don't need to explicitly add to a schedule list in Mesa 3.0+, 
             # but we ensure agents are registered to this model instance.
-            WealthAgent(self, float(payday_array[idx]), float(innovation_array[idx]), party_elite)
+            WealthAgent(self, float(payday_array[idx]), float(innovation_array[idx]), party_elite, index=idx)
+        # Creation order, so random_agent() draws the same agents as
+        # random.choice(self.agents) would
+        self.agent_list = list(self.agents)
+        self.agent_uids = np.array([agent.unique_id for agent in self.agents], dtype=np.int64)
 
     def initialize_agent_brackets(self):
         """Initialize agent brackets based on their starting wealth"""
         if not self.agents: return
         self.brackets = calc_brackets(self)
+        if self.agent_table is not None:
+            self.agent_table.assign_brackets(self.brackets)
+            self.agent_table.reset_history()
+            return
         for agent in self.agents:
             if agent.wealth < self.brackets[0]:
                 agent.bracket = "Lower"
@@ -105,26 +314,29 @@ class WealthModel(mesa.Model):
         print("Initializing comparison sub-models...")
         for policy in policies:
             # Create sub-model
-            model = WealthModel(
+            model = self.submodel_factory(
                 policy=policy,
                 population=self.population,
                 start_up_required=self.start_up_required,
                 patron=self.patron,
-                seed=self._seed # Inherit seed
+                rng=self.seed, # Inherit seed
+                statistics=self.statistics,
+                agent_record_every=self.agent_record_every,
+                compact_agents=self.compact_agents,
+                network=self.network or self.network_spec,
+                initial_state=self.initial_state
             )
             self.comparison_models[policy] = model
             
             # Collect initial data (Step 0)
-            gini = compute_gini(model)
-            total = total_wealth(model)
-            mobility = compute_mobility(model)
+            metrics = model.metrics()
             
-            self.comparison_results[policy]['gini'].append(gini)
-            self.comparison_results[policy]['total'].append(total)
-            self.comparison_results[policy]['mobility'].append(mobility)
+            self.comparison_results[policy]['gini'].append(metrics["Gini"])
+            self.comparison_results[policy]['total'].append(metrics["Total"])
+            self.comparison_results[policy]['mobility'].append(metrics["Mobility"])
             
             # Initial wealth snapshot for histograms
-            self.comparison_results[policy]['final_wealth'] = [a.wealth for a in model.agents]
+            self.comparison_results[policy]['final_wealth'] = model.wealth_values()
 
     def step_comparison_models(self):
         """Run one step for each comparison model"""
@@ -133,17 +345,15 @@ class WealthModel(mesa.Model):
             # Note: model.step() calls model.datacollector.collect(model) inside it
             
             # Collect aggregate data for the comparison views
-            gini = compute_gini(model)
-            total = total_wealth(model)
-            mobility = compute_mobility(model)
+            metrics = model.metrics()
 
-            self.comparison_results[policy]['gini'].append(gini)
-            self.comparison_results[policy]['total'].append(total)
-            self.comparison_results[policy]['mobility'].append(mobility)
+            self.comparison_results[policy]['gini'].append(metrics["Gini"])
+            self.comparison_results[policy]['total'].append(metrics["Total"])
+            self.comparison_results[policy]['mobility'].append(metrics["Mobility"])
             
             # Update snapshots
-            self.comparison_results[policy]['final_wealth'] = [a.wealth for a in model.agents]
-            self.comparison_results[policy]['final_classes'] = [a.bracket for a in model.agents]
+            self.comparison_results[policy]['final_wealth'] = model.wealth_values()
+            self.comparison_results[policy]['final_classes'] = model.bracket_values()
         
         self.comparison_step_count += 1
         print(f"Comparison Step {self.comparison_step_count} completed.")
@@ -157,13 +367,15 @@ class WealthModel(mesa.Model):
             return
 
         # --- SINGLE MODEL LOGIC ---
+        self.exchanges.reset()
         self.brackets = calc_brackets(self)
         self.total = total_wealth(self)
         
         # Survival Cost
-        exp_scale = np.mean([agent.wealth for agent in self.agents])
+        exp_scale = np.mean(self.agent_values("wealth"))
         if exp_scale > 1:
-            self.survival_cost = expon.ppf(0.1, scale=exp_scale)
+            # Closed-form exponential quantile, same as scipy's expon.ppf(q, scale=exp_scale)
+            self.survival_cost = -exp_scale * np.log1p(-SURVIVAL_QUANTILE)
 
         # Start up cost logic
         if self.policy == "capitalism":
@@ -172,5 +384,16 @@ class WealthModel(mesa.Model):
         if self.patron: 
             Patron().execute(self)
 
+        start_codes = self.bracket_codes()
+
         self.agents.shuffle_do("step")
-        self.datacollector.collect(self)
\ No newline at end of file
+        codes = self.bracket_codes()
+        self.transitions = transition_matrix(start_codes, codes)
+        if self.flows is not None:
+            self.flows.update(*self.exchanges.view(), codes)
+        self.datacollector.collect(self)
+
+    def run_until_converged(self, max_steps, **options):
+        """Steps until Gini, growth and mobility settle (convergence.py); returns the converged step or None"""
+        convergence.run_until_converged(self, max_steps, **options)
+        return self.converged_step
\ No newline at end of file
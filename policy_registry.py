@@ -0,0 +1,216 @@
+'''
+In-memory registry of user-defined policies and agent step logic
+
+Custom policy classes (from the AI assistant) and the agent step function
+(from the Blockly editor) are compiled once, stored by content hash, and
+published into one shared namespace. Agents resolve them by name at step
+time, so nothing is re-imported per step and lookups stay constant-time
+however many policies have been generated.
+
+Every update is built in a scratch namespace first and then published with a
+single dict update / attribute swap, so a failing update leaves the previous
+version in place. Persistence is optional: set POLICY_SNAPSHOT_FILE to write
+a JSON snapshot after each change and restore it on startup.
+'''
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import threading
+import types
+
+import numpy as np
+
+import policyblocks
+import utilities
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FILE = os.environ.get('POLICY_SNAPSHOT_FILE')
+
+
+def _base_namespace():
+    """Names available to user code, as the old user_logic.py imports provided"""
+    namespace = {'__name__': 'custom_policies', '__builtins__': __builtins__, 'np': np}
+    for module in (policyblocks, utilities):
+        namespace.update({k: v for k, v in vars(module).items() if not k.startswith('_')})
+    return namespace
+
+
+class PolicyVersion:
+    def __init__(self, digest, kind, source, code, names, version, batch=()):
+        self.hash = digest
+        self.kind = kind          # "policy" or "logic"
+        self.source = source
+        self.code = code
+        self.names = names
+        self.version = version
+        self.batch = list(batch)  # classes that define execute_batch(pop, model)
+
+    def describe(self):
+        return {'hash': self.hash, 'kind': self.kind, 'names': self.names, 'version': self.version,
+                'batch': self.batch}
+
+
+class PolicyRegistry:
+
+    def __init__(self, snapshot_file=None):
+        self.lock = threading.Lock()
+        self.snapshot_file = snapshot_file
+        self.reset(persist=False)
+
+    def reset(self, persist=True):
+        with self.lock:
+            self.namespace = _base_namespace()
+            self.versions = {}        # content hash -> PolicyVersion
+            self.by_name = {}         # policy class name -> content hash
+            self.policies = []        # hashes of registered policy sources, in order
+            self.logic = None         # hash of the active step logic
+            self.step_logic = None    # compiled agent step function, or None
+            self.version = 0
+        if persist:
+            self._persist()
+
+    @staticmethod
+    def content_hash(source):
+        return hashlib.sha256(source.encode()).hexdigest()
+
+    def _compile(self, source, kind):
+        digest = self.content_hash(source)
+        code = compile(source, f'<{kind} {digest[:8]}>', 'exec')
+        scratch = dict(self.namespace)
+        exec(code, scratch)
+        new = {k: v for k, v in scratch.items()
+               if not k.startswith('__') and self.namespace.get(k, _MISSING) is not v}
+        return digest, code, new
+
+    def _rebind(self, obj):
+        # Functions resolve globals in the shared namespace, so policies
+        # registered later are still found by name at step time
+        if isinstance(obj, types.FunctionType):
+            return types.FunctionType(obj.__code__, self.namespace, obj.__name__,
+                                      obj.__defaults__, obj.__closure__)
+        return obj
+
+    def register_policy(self, source):
+        """Compiles source and publishes every class it defines. Returns the PolicyVersion."""
+        with self.lock:
+            digest = self.content_hash(source)
+            if digest in self.versions:
+                return self.versions[digest]
+            digest, code, new = self._compile(source, 'policy')
+            classes = {k: v for k, v in new.items() if isinstance(v, type)}
+            if not classes:
+                raise ValueError("Policy code defines no class")
+            self.version += 1
+            entry = PolicyVersion(digest, 'policy', source, code, sorted(classes), self.version,
+                                  batch=sorted(k for k, v in classes.items() if hasattr(v, 'execute_batch')))
+            self.versions[digest] = entry
+            self.policies.append(digest)
+            self.namespace.update({k: self._rebind(v) for k, v in new.items()})
+            self.by_name.update({name: digest for name in classes})
+        self._persist()
+        return entry
+
+    def set_step_logic(self, source):
+        """Compiles Blockly/AI agent logic, which must define step(self), and activates it"""
+        with self.lock:
+            digest, code, new = self._compile(source, 'logic')
+            if not isinstance(new.get('step'), types.FunctionType):
+                raise ValueError("Agent logic must define a function step(self)")
+            published = {k: self._rebind(v) for k, v in new.items()}
+            self.version += 1
+            entry = self.versions.get(digest) or PolicyVersion(digest, 'logic', source, code, ['step'], self.version)
+            self.versions[digest] = entry
+            self.namespace.update(published)
+            self.logic = digest
+            self.step_logic = published['step']
+        self._persist()
+        return entry
+
+    @contextlib.contextmanager
+    def activated(self, other):
+        '''
+        Runs another registry's code (e.g. one restored from an older
+        snapshot, for replay.py) in place of this one's for the duration of
+        the block. Updates to this registry wait until the block exits.
+        '''
+        with self.lock:
+            saved = {name: getattr(self, name) for name in _STATE}
+            for name in _STATE:
+                setattr(self, name, getattr(other, name))
+            try:
+                yield
+            finally:
+                for name, value in saved.items():
+                    setattr(self, name, value)
+
+    def clear_step_logic(self):
+        with self.lock:
+            self.version += 1
+            self.logic = None
+            self.step_logic = None
+        self._persist()
+
+    def get(self, name):
+        """The current class registered under name, or None"""
+        return self.namespace.get(name) if name in self.by_name else None
+
+    def source_hash(self):
+        """Hash of everything user code can change; part of the result cache key"""
+        digest = hashlib.sha256()
+        for policy in self.policies:
+            digest.update(policy.encode())
+        digest.update((self.logic or '').encode())
+        return digest.hexdigest()
+
+    def describe(self):
+        return {
+            'version': self.version,
+            'policies': {name: self.versions[digest].describe() for name, digest in self.by_name.items()},
+            'step_logic': self.versions[self.logic].describe() if self.logic else None,
+        }
+
+    # --- Optional persistence ---
+    def snapshot(self):
+        return {
+            'version': self.version,
+            'policies': [self.versions[digest].source for digest in self.policies],
+            'step_logic': self.versions[self.logic].source if self.logic else None,
+        }
+
+    def _persist(self):
+        if not self.snapshot_file:
+            return
+        with self.lock:
+            data = self.snapshot()
+        tmp = f'{self.snapshot_file}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, self.snapshot_file)
+
+    def load(self, path):
+        with open(path) as f:
+            self.restore(json.load(f))
+
+    def restore(self, data):
+        """Re-registers everything in a snapshot() (e.g. in a worker process)"""
+        for source in data.get('policies', []):
+            self.register_policy(source)
+        if data.get('step_logic'):
+            self.set_step_logic(data['step_logic'])
+
+
+_MISSING = object()
+# Everything reset() initializes; swapped as a whole by activated()
+_STATE = ('namespace', 'versions', 'by_name', 'policies', 'logic', 'step_logic', 'version')
+
+# Shared process-wide registry
+registry = PolicyRegistry(snapshot_file=SNAPSHOT_FILE)
+if SNAPSHOT_FILE and os.path.exists(SNAPSHOT_FILE):
+    try:
+        registry.load(SNAPSHOT_FILE)
+    except Exception as e:
+        logger.warning(f"Could not restore policy snapshot {SNAPSHOT_FILE}: {e}")
@@ -0,0 +1,404 @@
+'''
+Isolated validation of AI-generated policy code.
+
+Generated code runs in a pool of pre-warmed worker processes, never in the
+web process. Each worker runs under an address-space limit, and every job is
+time-boxed by the parent, which kills and replaces a worker that overruns.
+Besides the mock smoke test, a worker benchmarks the candidate policy inside a
+real WealthModel at a production-sized population and reports its per-agent
+step cost, so slow (e.g. O(N^2)) policies are rejected or flagged before they
+reach the live simulation.
+
+A policy may also define the batch form execute_batch(pop, model), which does
+the same for the whole population at once on compact_agents.PopulationArrays
+(BATCH_PROMPT). It is checked against the per-agent form on a seeded
+population (see batch_equivalence) and must match it. The live step still
+calls execute() once per agent, so the budget applies to the per-agent cost.
+'''
+
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SANDBOX_WORKERS = int(os.environ.get('POLICY_SANDBOX_WORKERS', 2))
+SANDBOX_TIMEOUT = float(os.environ.get('POLICY_SANDBOX_TIMEOUT', 10))
+SANDBOX_MEMORY_MB = int(os.environ.get('POLICY_SANDBOX_MEMORY_MB', 1024))
+BENCH_POPULATION = int(os.environ.get('POLICY_BENCH_POPULATION', 1000))
+BENCH_STEPS = int(os.environ.get('POLICY_BENCH_STEPS', 3))
+# Per-agent cost of one policy.execute call, in microseconds
+STEP_BUDGET_US = float(os.environ.get('POLICY_STEP_BUDGET_US', 25))
+# "reject" fails validation over budget; "flag" passes it with a warning
+BUDGET_MODE = os.environ.get('POLICY_BUDGET_MODE', 'reject')
+# A stochastic batch form may differ from the per-agent form by this much
+# (relative to the field's mean) in the mean, 10/50/90th percentiles and Gini
+BATCH_TOLERANCE = float(os.environ.get('POLICY_BATCH_TOLERANCE', 0.05))
+BATCH_SEED = 7
+BATCH_FIELDS = ('wealth', 'W', 'I')
+
+# Asks the generator for the batch form (appended to the chat and MCP prompts)
+BATCH_PROMPT = (
+    "### OPTIONAL BATCH FORM (FAST PATH) ###\n"
+    "`execute` runs once per agent per step. Also add `def execute_batch(self, pop, model):` to the class "
+    "when the policy can be written with NumPy over the whole population. It must have the same effect as "
+    "calling `execute(agent, model)` for every agent. `pop` holds one array entry per agent: `pop.wealth`, "
+    "`pop.W`, `pop.I`, `pop.mobility` (float arrays), `pop.party_elite`, `pop.innovating` (bool arrays), "
+    "`pop.bracket` (0=Lower, 1=Middle, 2=Upper) and `pop.size`. Modify the arrays in place "
+    "(e.g. `pop.wealth[mask] -= tax`). Use `pop.everyone()` for an all-True mask, "
+    "`pop.credit(indices, amounts)` to add money to agents (repeated indices accumulate) and `model.rng` "
+    "for random draws (e.g. `model.rng.integers(0, pop.size, n)`). No Python loops over agents. "
+    "The model attributes are the same as for `execute`. Leave `execute_batch` out if the policy cannot "
+    "be expressed this way. It is tested against `execute` and the code is rejected if they disagree.\n\n"
+)
+
+
+# --- Mock environment (smoke test) ---
+class MockModel:
+    def __init__(self):
+        # Match attributes from WealthModel in model.py
+        self.agents = []
+        self.survival_cost = 1.0
+        self.policy = "custom"
+        self.population = 10
+        self.brackets = [10, 20]
+        self.start_up_required = 1
+        self.patron = False
+        self.total = 1000.0
+        self.comparison_results = {}
+        # Mock DataCollector
+        self.datacollector = type('MockDataCollector', (), {'collect': lambda s, m: None})()
+
+class MockAgent:
+    def __init__(self, model):
+        # Match attributes from WealthAgent
+        self.wealth = 10.0
+        self.W = 0.2
+        self.I = 1.0 # Innovation
+        self.model = model
+        self.unique_id = 1
+        self.bracket = "Middle"
+        self.bracket_history = []
+        self.party_elite = False
+        self.mobility = 0
+
+
+def attribute_hint():
+    m_attrs = [k for k in MockModel().__dict__.keys() if not k.startswith('_')]
+    a_attrs = [k for k in MockAgent(MockModel()).__dict__.keys() if not k.startswith('_')]
+    return (f"\n[HINT] Available Model attributes: {m_attrs}"
+            f"\n[HINT] Available Agent attributes: {a_attrs}"
+            "\nPlease check your variable names.")
+
+
+def load_policy_class(code_str):
+    """Compiles code_str and returns the first class it defines (or None)"""
+    compile(code_str, '<string>', 'exec')
+    local_scope = {}
+    exec(code_str, {'np': np, 'random': np.random}, local_scope)
+    for val in local_scope.values():
+        if isinstance(val, type):
+            return val
+    return None
+
+
+def call_execute(instance, agent, model):
+    try:
+        instance.execute(agent, model)
+    except TypeError:
+        instance.execute(agent)
+
+
+def smoke_test(code_str):
+    """The original three-stage check: syntax, definition, one mock execution"""
+    policy_class = load_policy_class(code_str)
+    if not policy_class:
+        return False, "Code executed but no class definition was found."
+    instance = policy_class()
+    if not hasattr(instance, 'execute'):
+        return False, f"Class '{policy_class.__name__}' missing 'execute' method."
+
+    mock_model = MockModel()
+    mock_agent = MockAgent(mock_model)
+    mock_model.agents.append(mock_agent)
+    call_execute(instance, mock_agent, mock_model)
+    return True, "Verified: Code compiled and ran successfully in test environment."
+
+
+def benchmark(code_str, population=BENCH_POPULATION, steps=BENCH_STEPS):
+    """
+    Runs the policy once per agent per step inside a real WealthModel and
+    returns the mean cost of one execute() call in microseconds. Only the
+    policy calls are timed; the model step in between just evolves the state.
+    """
+    from model import WealthModel
+
+    instance = load_policy_class(code_str)()
+    model = WealthModel(population=population)
+    agents = list(model.agents)
+    elapsed = 0.0
+    for _ in range(steps):
+        start = time.perf_counter()
+        for agent in agents:
+            call_execute(instance, agent, model)
+        elapsed += time.perf_counter() - start
+        model.step()
+    return elapsed / (steps * len(agents)) * 1e6
+
+
+def _gini(values):
+    values = np.sort(np.abs(values))
+    n, total = len(values), values.sum()
+    if n == 0 or total == 0:
+        return 0.0
+    return float(1 + 1 / n - 2 * np.sum(values * np.arange(n, 0, -1)) / (n * total))
+
+
+def _summary(name, values):
+    stats = {'mean': float(np.mean(values))}
+    stats.update(zip(('p10', 'p50', 'p90'), np.percentile(values, [10, 50, 90]).tolist()))
+    if name == 'wealth':
+        stats['gini'] = _gini(values)
+    return stats
+
+
+def batch_equivalence(code_str, population=BENCH_POPULATION, seed=BATCH_SEED, tolerance=BATCH_TOLERANCE):
+    '''
+    Applies execute() to every agent (in a seeded random order) of a seeded
+    WealthModel, and execute_batch() to a clone of it, then compares the two
+    populations. Deterministic, order-independent policies must match
+    exactly. Otherwise the mean, 10/50/90th percentiles and wealth Gini must
+    agree within tolerance. Also times both forms.
+    '''
+    import pickle
+    from compact_agents import PopulationArrays
+    from model import WealthModel
+
+    policy_class = load_policy_class(code_str)
+    model = WealthModel(population=population, rng=seed)
+    for _ in range(BENCH_STEPS):
+        model.step()        # spread wealth across the brackets first
+    clone = pickle.loads(pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL))
+
+    instance = policy_class()
+    agents = list(model.agent_list)
+    model.random.shuffle(agents)
+    start = time.perf_counter()
+    for agent in agents:
+        call_execute(instance, agent, model)
+    per_agent = time.perf_counter() - start
+
+    pop = PopulationArrays(clone)
+    start = time.perf_counter()
+    policy_class().execute_batch(pop, clone)
+    batch = time.perf_counter() - start
+    pop.commit()
+
+    expected, actual = PopulationArrays(model), PopulationArrays(clone)
+    exact = all(np.allclose(getattr(expected, name), getattr(actual, name), rtol=1e-9, atol=1e-12)
+                for name in BATCH_FIELDS)
+    worst, worst_stat = 0.0, None
+    for name in BATCH_FIELDS:
+        want, got = _summary(name, getattr(expected, name)), _summary(name, getattr(actual, name))
+        # Low quantiles sit near zero, so they are compared on the field's scale
+        scale = max(float(np.mean(np.abs(getattr(expected, name)))), 1e-9)
+        for stat in want:
+            diff = abs(got[stat] - want[stat]) / max(abs(want[stat]), 1e-9 if stat == 'gini' else scale)
+            if diff > worst:
+                worst, worst_stat = diff, f"{name} {stat}"
+    return {'exact': exact, 'equivalent': exact or worst <= tolerance, 'max_rel_diff': worst,
+            'worst_stat': worst_stat, 'tolerance': tolerance,
+            'per_agent_us': per_agent / len(agents) * 1e6, 'batch_us': batch / len(agents) * 1e6}
+
+
+def run_validation(code_str, population=BENCH_POPULATION, budget_us=STEP_BUDGET_US, mode=BUDGET_MODE):
+    """Smoke test + benchmark; runs inside a sandbox worker"""
+    try:
+        valid, message = smoke_test(code_str)
+    except MemoryError:
+        raise
+    except Exception as e:
+        message = f"{type(e).__name__}: {str(e)}"
+        if isinstance(e, AttributeError):
+            message += attribute_hint()
+        return {'valid': False, 'message': message}
+    if not valid:
+        return {'valid': False, 'message': message}
+
+    try:
+        cost = benchmark(code_str, population)
+    except MemoryError:
+        raise
+    except Exception as e:
+        return {'valid': False,
+                'message': f"Policy failed inside a real WealthModel: {type(e).__name__}: {str(e)}"}
+
+    batch = None
+    if hasattr(load_policy_class(code_str), 'execute_batch'):
+        try:
+            batch = batch_equivalence(code_str, population)
+        except MemoryError:
+            raise
+        except Exception as e:
+            return {'valid': False, 'batch_mismatch': True,
+                    'message': f"execute_batch failed: {type(e).__name__}: {str(e)}"}
+        if not batch['equivalent']:
+            return {'valid': False, 'batch_mismatch': True, 'batch': batch,
+                    'message': (f"execute_batch does not match execute applied to every agent: {batch['worst_stat']} "
+                                f"differs by {batch['max_rel_diff']:.1%} (tolerance {batch['tolerance']:.0%}).")}
+
+    result = {'valid': True, 'message': message, 'cost_us': cost, 'budget_us': budget_us,
+              'population': population, 'over_budget': cost > budget_us}
+    if result['over_budget']:
+        report = (f"Policy costs {cost:.1f} us per agent per step at population {population} "
+                  f"(budget {budget_us:.0f} us).")
+        result['valid'] = mode != 'reject'
+        result['message'] = ("⚠️ " + report) if result['valid'] else report
+    else:
+        result['message'] += f" ({cost:.1f} us per agent per step)"
+    if batch is not None:
+        result['batch'] = batch
+        result['message'] += (f" Batch form {'matches exactly' if batch['exact'] else 'matches statistically'}, "
+                              f"{batch['per_agent_us'] / max(batch['batch_us'], 1e-3):.0f}x faster than per agent.")
+    return result
+
+
+# --- Worker processes ---
+def _limit_memory(memory_mb):
+    try:
+        import resource
+    except ImportError:   # not available on Windows
+        return
+    limit = memory_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _worker_main(conn, memory_mb):
+    # Pre-warm: pay for the heavy imports and first model build before any job
+    from model import WealthModel
+    WealthModel(population=10).step()
+    _limit_memory(memory_mb)
+    conn.send('ready')
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        try:
+            result = run_validation(**job)
+        except MemoryError:
+            result = {'valid': False, 'message': f"MemoryError: policy exceeded the {memory_mb} MB sandbox limit."}
+        except Exception as e:
+            result = {'valid': False, 'message': f"{type(e).__name__}: {str(e)}",
+                      'traceback': traceback.format_exc()}
+        conn.send(result)
+
+
+class SandboxWorker:
+    def __init__(self, ctx, memory_mb):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn, memory_mb), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+
+    def wait_ready(self, timeout):
+        if not self.ready and self.conn.poll(timeout):
+            self.ready = self.conn.recv() == 'ready'
+        return self.ready
+
+    def run(self, job, timeout):
+        """Returns the worker's result dict, or None if it timed out or died"""
+        self.conn.send(job)
+        if not self.conn.poll(timeout):
+            return None
+        try:
+            return self.conn.recv()
+        except EOFError:
+            return None
+
+    def kill(self):
+        self.process.kill()
+        self.process.join(timeout=1)
+        self.conn.close()
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except (OSError, BrokenPipeError):
+            pass
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.kill()
+
+
+class SandboxPool:
+    """Fixed-size pool of pre-warmed validation workers"""
+
+    def __init__(self, size=SANDBOX_WORKERS, timeout=SANDBOX_TIMEOUT, memory_mb=SANDBOX_MEMORY_MB):
+        self.timeout = timeout
+        self.memory_mb = memory_mb
+        self.ctx = multiprocessing.get_context('spawn')
+        self.idle = queue.Queue()
+        for _ in range(size):
+            self.idle.put(SandboxWorker(self.ctx, memory_mb))
+
+    def validate(self, code_str, population=BENCH_POPULATION, budget_us=STEP_BUDGET_US, mode=BUDGET_MODE):
+        worker = self.idle.get()
+        started = time.perf_counter()
+        try:
+            ready = worker.wait_ready(self.timeout)
+        except (EOFError, OSError):
+            ready = False
+        if not ready:
+            logger.warning("Policy sandbox worker failed to start")
+            worker.kill()
+            self.idle.put(SandboxWorker(self.ctx, self.memory_mb))
+            return {'valid': False, 'message': "Validation sandbox is unavailable; please try again."}
+        job = {'code_str': code_str, 'population': population, 'budget_us': budget_us, 'mode': mode}
+        try:
+            result = worker.run(job, self.timeout)
+        except (OSError, BrokenPipeError) as e:
+            logger.warning(f"Policy sandbox worker failed: {e}")
+            result = None
+        if result is None:
+            # Timed out, crashed or hit the memory limit hard: replace the worker
+            worker.kill()
+            worker = SandboxWorker(self.ctx, self.memory_mb)
+            result = {'valid': False, 'timed_out': True,
+                      'message': (f"Validation did not finish within {self.timeout:.0f}s "
+                                  f"({time.perf_counter() - started:.1f}s elapsed). The policy probably "
+                                  "loops forever or is far too slow for a population of "
+                                  f"{population} agents.")}
+        self.idle.put(worker)
+        return result
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get().close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Process-wide pool, started on first use so importing app stays cheap"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SandboxPool()
+        return _pool
+
+
+def validate(code_str, **kwargs):
+    """Validates code_str in a sandbox worker; returns the result dict"""
+    return get_pool().validate(code_str, **kwargs)
@@ -5,6 +5,16 @@ inequality model
 
 import numpy as np
 
+from exchanges import SURVIVAL, THRIVE, TAX, PATRON
+
+
+def random_partners(model, agents, population):
+    """A partner for each agent index: a random neighbour in network mode (topology.py), else uniform"""
+    network = getattr(model, 'network', None)
+    if network is None:
+        return model.rng.integers(0, population, len(agents))
+    return network.sample_many(agents, model.rng)
+
 # Called by Agent
 class WealthExchange:
     '''
@@ -12,12 +22,12 @@ class WealthExchange:
     1- Agent adds agent proportion of wealth per their attribute
     2- Agent Pays survival cost to other agent (e.g. bread, shelter)
     3- Agent pays thrive cost to other agent (e.g. TV)
+    Partners are any agent, or only the agent's neighbours when the model
+    has an exchange network.
     '''
 
     def execute(self, agent):
-        # Clear previous step's exchange record
-        agent.last_paid_uids = []
-        agent.last_paid_amounts = []
+        exchanges = agent.model.exchanges
 
         # Get paid - Base injector of wealth into the economy
         agent.wealth += (agent.W*agent.wealth)
@@ -27,12 +37,11 @@ class WealthExchange:
         Pays another agent based on population wealth cost some
         amount of money
         """
-        survival_agent = agent.model.random.choice(agent.model.agents) 
-        if agent.wealth > agent.model.survival_cost and agent is not survival_agent: 
+        survival_agent = agent.model.random_partner(agent)
+        if agent.wealth > agent.model.survival_cost and agent != survival_agent: 
             agent.wealth -= agent.model.survival_cost
             survival_agent.wealth += agent.model.survival_cost
-            agent.last_paid_uids.append(survival_agent.unique_id)
-            agent.last_paid_amounts.append(agent.model.survival_cost)
+            exchanges.record(agent.index, survival_agent.index, agent.model.survival_cost, SURVIVAL)
         else: 
             agent.wealth -= agent.wealth
             survival_agent.wealth += agent.wealth
@@ -44,13 +53,46 @@ class WealthExchange:
         Thrive dynamic pays other agent based on their wealth proportion
         for some good or service
         """
-        thrive_agent = agent.model.random.choice(agent.model.agents)
-        if agent.wealth > (thrive_agent.W*agent.wealth) and thrive_agent is not agent: 
+        thrive_agent = agent.model.random_partner(agent)
+        if agent.wealth > (thrive_agent.W*agent.wealth) and thrive_agent != agent: 
             amount = thrive_agent.W * agent.wealth
             thrive_agent.wealth += amount
             agent.wealth -= amount
-            agent.last_paid_uids.append(thrive_agent.unique_id)
-            agent.last_paid_amounts.append(amount)
+            exchanges.record(agent.index, thrive_agent.index, amount, THRIVE)
+
+    def execute_population(self, pop, mask):
+        '''
+        The same three parts for every agent in mask at once. Partners are
+        drawn in one batch and payments are applied together (scatter-add),
+        so agents do not see each other's payments within the step.
+        '''
+        model = pop.model
+        exchanges = model.exchanges
+        wealth = pop.wealth
+        agents = np.flatnonzero(mask)
+
+        # Get paid
+        wealth[agents] += pop.W[agents] * wealth[agents]
+
+        # Survival Cost
+        partners = random_partners(model, agents, pop.size)
+        cost = model.survival_cost
+        pays = (wealth[agents] > cost) & (partners != agents)
+        payers, receivers = agents[pays], partners[pays]
+        # Broke agents pay what they have (nothing left over) and reset to 1
+        wealth[agents[~pays]] = 1
+        wealth[payers] -= cost
+        pop.credit(receivers, cost)
+        exchanges.record_many(payers, receivers, cost, SURVIVAL)
+
+        # Thrive cost
+        partners = random_partners(model, agents, pop.size)
+        amount = pop.W[partners] * wealth[agents]
+        pays = (wealth[agents] > amount) & (partners != agents)
+        payers, receivers, amount = agents[pays], partners[pays], amount[pays]
+        wealth[payers] -= amount
+        pop.credit(receivers, amount)
+        exchanges.record_many(payers, receivers, amount, THRIVE)
 
 
 # Called by Agent
@@ -67,8 +109,22 @@ class Fascism:
             party_elites = agent.model.agents.select(lambda a: a.party_elite==True)
             # Pay tax to party elite
             party_elite = agent.random.choice(party_elites)
-            party_elite.wealth += agent.wealth*0.2 # Party tax is a hyper parameter
-            agent.wealth -= agent.wealth*0.2
+            tax = agent.wealth*0.2 # Party tax is a hyper parameter
+            party_elite.wealth += tax
+            agent.wealth -= tax
+            agent.model.exchanges.record(agent.index, party_elite.index, tax, TAX)
+
+    def execute_population(self, pop, mask):
+        elites = np.flatnonzero(pop.party_elite)
+        payers = np.flatnonzero(mask & ~pop.party_elite)
+        if len(elites) == 0 or len(payers) == 0:
+            return
+        # Pay tax to a random party elite
+        receivers = elites[pop.model.rng.integers(0, len(elites), len(payers))]
+        tax = pop.wealth[payers] * 0.2 # Party tax is a hyper parameter
+        pop.wealth[payers] -= tax
+        pop.credit(receivers, tax)
+        pop.model.exchanges.record_many(payers, receivers, tax, TAX)
 
 # Called by agent and model 
 class Capitalism: 
@@ -78,20 +134,20 @@ class Capitalism:
         # Number of bins using Sturges' rule
         num_bins = int(np.ceil(np.log2(model.population) + 1))
         
-        wealth_list = np.array([agent.wealth for agent in model.agents])
+        # Sorted once, so each bin's max is a binary search instead of a pass
+        wealth_list = np.sort(np.asarray(model.agent_values("wealth"), dtype=float))
         # Create the bins
-        bin_edges = np.linspace(min(wealth_list), max(wealth_list), num_bins + 1)
+        bin_edges = np.linspace(wealth_list[0], wealth_list[-1], num_bins + 1)
         # Find the max value in each bin
         bin_max_values = []
         for i in range(len(bin_edges) - 1):
             # Get the lower and upper bound of the current bin
             lower_bound = bin_edges[i]
             upper_bound = bin_edges[i + 1]
-            # Find the values in this bin
-            values_in_bin = wealth_list[(wealth_list >= lower_bound) & (wealth_list <= upper_bound)]
-            # Find the max value in the bin (if any values are in the bin)
-            if len(values_in_bin) > 0:
-                bin_max_values.append(max(values_in_bin))
+            # Largest value <= upper bound; it is in this bin if it is >= lower bound
+            top = np.searchsorted(wealth_list, upper_bound, side="right") - 1
+            if top >= 0 and wealth_list[top] >= lower_bound:
+                bin_max_values.append(wealth_list[top])
             else:
                 bin_max_values.append(None)  # No values in this bin
         return bin_max_values
@@ -125,7 +181,7 @@ class Capitalism:
         elif agent.I < 1: 
             self.innovating = False 
             # New agent innovation changes due to shifting fitness landscape
-            innovation_multiplier = np.random.pareto(2.5) # Hyper parameter
+            innovation_multiplier = agent.model.rng.pareto(2.5) # Hyper parameter
             if innovation_multiplier < 1: 
                 innovation_multiplier += 1
             agent.I = innovation_multiplier
@@ -139,6 +195,9 @@ class Patron():
         # Identify the wealthiest 20% --in 200 thats 40.
         top_count = max(1, int(model.population * 0.20))
         patron_agents = sorted(model.agents, key=lambda a: a.wealth, reverse=True)[:top_count]
+        if getattr(model, 'network', None) is not None:
+            self.execute_network(model, patron_agents)
+            return
         patron_set = set(patron_agents)
 
         # Build a pool that excludes all top agents (they cannot be sampled)
@@ -155,8 +214,25 @@ class Patron():
             #if agent.wealth > transfer_amount:
             patron.wealth -= transfer_amount
             client_agent.wealth += transfer_amount
+            model.exchanges.record(patron.index, client_agent.index, transfer_amount, PATRON)
         
         
 
 
-        
\ No newline at end of file
+        
+
+    def execute_network(self, model, patron_agents):
+        # Each patron's network is its neighbours in the exchange topology,
+        # excluding the other top agents
+        top = np.zeros(model.population, dtype=np.bool_)
+        top[[patron.index for patron in patron_agents]] = True
+        for patron in patron_agents:
+            clients = model.network.neighbours(patron.index)
+            clients = clients[~top[clients]]
+            if len(clients) == 0:
+                continue
+            client_agent = model.agent_list[int(clients[model.random.randrange(len(clients))])]
+            transfer_amount = 0.10 * patron.wealth  # 10% of agent's wealth
+            patron.wealth -= transfer_amount
+            client_agent.wealth += transfer_amount
+            model.exchanges.record(patron.index, client_agent.index, transfer_amount, PATRON)
@@ -0,0 +1,126 @@
+'''
+Cache of validated AI policy responses keyed by normalized prompt
+
+Students in a classroom often type nearly the same idea ("tax the rich 10%",
+"Tax the rich 10 %!"). Validated responses (description, python_code,
+block_json, block_generator) are stored under a normalized form of the
+prompt. A lookup also matches prompts that differ only in filler words
+("please", "the", ...): the remaining words and numbers must be the same and
+in the same order. Word sets are not enough, since "take from the rich and
+give to the poor" and "take from the poor and give to the rich" share theirs.
+Entries are evicted least-recently-used past max_entries and persisted to a
+local JSON file.
+'''
+
+import json
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+CACHE_FILE = os.environ.get('PROMPT_CACHE_FILE', 'prompt_cache.json')
+CACHE_MAX_ENTRIES = int(os.environ.get('PROMPT_CACHE_MAX_ENTRIES', 500))
+
+RESPONSE_FIELDS = ('description', 'python_code', 'block_json', 'block_generator', 'performance')
+
+STOPWORDS = {'a', 'an', 'the', 'of', 'to', 'and', 'or', 'for', 'in', 'on', 'at', 'by', 'with',
+             'is', 'are', 'be', 'that', 'this', 'it', 'their', 'them', 'they', 'all', 'every',
+             'each', 'please', 'policy', 'make', 'create', 'i', 'want', 'would', 'like', 'should'}
+
+_WORD = re.compile(r'[a-z]+|\d+(?:\.\d+)?%?')
+
+
+def normalize_prompt(text):
+    """Lowercase, join numbers to their units ("10 %" -> "10%"), drop punctuation"""
+    text = text.lower().strip()
+    text = re.sub(r'(\d)\s+(%|percent\b)', r'\1%', text)
+    text = text.replace('percent', '%')
+    return ' '.join(_WORD.findall(text))
+
+
+def content_key(normalized):
+    """The words and numbers that carry meaning, in their order"""
+    return ' '.join(w for w in normalized.split() if w not in STOPWORDS)
+
+
+class PromptCache:
+
+    def __init__(self, path=CACHE_FILE, max_entries=CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()      # normalized prompt -> response dict
+        self.by_content = {}              # content key -> normalized prompt stored last
+        self.hits = 0
+        self.misses = 0
+        if path and os.path.exists(path):
+            self._load()
+
+    def _index(self, key):
+        self.by_content[content_key(key)] = key
+
+    def _unindex(self, key):
+        if self.by_content.get(content_key(key)) == key:
+            del self.by_content[content_key(key)]
+
+    def get(self, prompt):
+        """Returns (response, exact) for the same prompt, or one differing only in filler words; else None"""
+        key = normalize_prompt(prompt)
+        with self.lock:
+            match = key if key in self.entries else self.by_content.get(content_key(key))
+            if match is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(match)
+            return dict(self.entries[match]), match == key
+
+    def put(self, prompt, response):
+        key = normalize_prompt(prompt)
+        record = {field: response[field] for field in RESPONSE_FIELDS if field in response}
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            self.entries[key] = record
+            self._index(key)
+            while len(self.entries) > self.max_entries:
+                evicted, _ = self.entries.popitem(last=False)
+                self._unindex(evicted)
+        self._save()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.by_content.clear()
+        self._save()
+
+    def stats(self):
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+    # --- Local file backend ---
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable prompt cache {self.path}: {e}")
+            return
+        for key, record in data.get('entries', [])[-self.max_entries:]:
+            self.entries[key] = record
+            self._index(key)
+
+    def _save(self):
+        if not self.path:
+            return
+        with self.lock:
+            data = {'entries': list(self.entries.items())}
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.warning(f"Could not write prompt cache {self.path}: {e}")
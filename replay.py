@@ -0,0 +1,154 @@
+'''
+Event-sourced replay: any past step of a run, reconstructed on demand
+
+A run initialized with replay=True records no per-agent history in its
+DataCollector. Instead its ReplayLog keeps:
+
+- keyframes: the pickled WealthModel (agents, RNG state, parameters) every
+  SIM_REPLAY_KEYFRAME_EVERY steps and at every control event
+- the control events: parameter changes (/api/control) and user code
+  updates, with the policy registry's sources from each code change on
+
+at(n) restores the nearest keyframe at or before step n and re-simulates
+the steps after it with the code that was active then. A run continues
+deterministically from a pickled state (the RNG state is part of it), so
+the result is the run's state at step n. Every event also writes a
+keyframe, so re-simulation never crosses one. The last few reconstructed
+states are kept (LRU) and also serve as starting points, so scrubbing
+forward one step at a time re-simulates one step per request.
+
+History is then O(population * steps / K) instead of O(population * steps),
+for at most K - 1 re-simulated steps per request. Cached runs
+(result_cache.py) store every step anyway and are served from their rows.
+'''
+
+import contextlib
+import os
+import pickle
+from collections import OrderedDict
+
+KEYFRAME_EVERY = int(os.environ.get('SIM_REPLAY_KEYFRAME_EVERY', 50))
+# Reconstructed states kept for repeated and nearby requests
+CACHE_STATES = int(os.environ.get('SIM_REPLAY_CACHE_STATES', 4))
+
+
+def _dumps(model):
+    # The rolling flow window is not part of a step's state and would
+    # dominate the keyframe; a reconstructed model runs without one. The
+    # exchange network never changes, so the log keeps it once
+    flows, network = model.flows, model.network
+    model.flows = model.network = None
+    try:
+        return pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)
+    finally:
+        model.flows, model.network = flows, network
+
+
+def _loads(frame, network):
+    model = pickle.loads(frame)
+    model.network = network
+    return model
+
+
+def state(model):
+    """The per-step state /api/data/at_step serves, from a WealthModel at that step"""
+    return {'metrics': model.metrics(), 'wealth': model.wealth_values(), 'bracket': model.bracket_values(),
+            'mobility': [float(m) for m in model.agent_values("mobility")], 'exchanges': model.exchange_edges()}
+
+
+class ReplayLog:
+    def __init__(self, model, keyframe_every=KEYFRAME_EVERY, cache_states=CACHE_STATES):
+        self.keyframe_every = max(1, int(keyframe_every))
+        self.cache_states = max(1, int(cache_states))
+        self.events = []            # {'step', 'kind', 'changes'}, in order
+        self.keyframes = {}         # step -> pickled WealthModel
+        self.code = []              # (from step, registry source hash, registry snapshot)
+        self.registries = {}        # source hash -> PolicyRegistry restored from its snapshot
+        self.states = OrderedDict() # step -> reconstructed WealthModel, least recently used first
+        self.hits = self.misses = self.resimulated = 0
+        self.network = model.network
+        self._record_code(model.steps)
+        self.keyframe(model)
+
+    def _record_code(self, step):
+        from policy_registry import registry
+        with registry.lock:
+            digest, snapshot = registry.source_hash(), registry.snapshot()
+        if not self.code or self.code[-1][1] != digest:
+            self.code.append((step, digest, snapshot))
+
+    def keyframe(self, model):
+        self.keyframes[model.steps] = _dumps(model)
+
+    def record(self, model):
+        """Called after every step of the run"""
+        if model.steps % self.keyframe_every == 0:
+            self.keyframe(model)
+
+    def event(self, model, kind, changes=None):
+        """A control event at the run's current step, recorded after it has been applied"""
+        self.events.append({'step': model.steps, 'kind': kind, 'changes': changes or {}})
+        if kind == 'code':
+            self._record_code(model.steps)
+        self.keyframe(model)
+
+    def _code_at(self, step):
+        """Context in which steps after step run with the code that was active then"""
+        from policy_registry import registry, PolicyRegistry
+        _, digest, snapshot = [entry for entry in self.code if entry[0] <= step][-1]
+        if digest == registry.source_hash():
+            return contextlib.nullcontext()
+        if digest not in self.registries:
+            scratch = PolicyRegistry()
+            scratch.restore(snapshot)
+            self.registries[digest] = scratch
+        return registry.activated(self.registries[digest])
+
+    def at(self, step):
+        '''
+        The run's state at step (0 <= step <= the run's current step) as a
+        WealthModel. It is shared with the cache: read it, do not step it.
+        '''
+        if step in self.states:
+            self.hits += 1
+            self.states.move_to_end(step)
+            return self.states[step]
+        self.misses += 1
+        start = max(s for s in self.keyframes if s <= step)
+        cached = max((s for s in self.states if start <= s <= step), default=None)
+        if cached is not None:
+            start = cached
+            model = _loads(_dumps(self.states[cached]), self.network)
+        else:
+            model = _loads(self.keyframes[start], self.network)
+        if step > start:
+            with self._code_at(start):
+                for _ in range(step - start):
+                    model.step()
+            self.resimulated += step - start
+        self.states[step] = model
+        while len(self.states) > self.cache_states:
+            self.states.popitem(last=False)
+        return model
+
+    def frame(self, step):
+        """state() at step, like CachedRun.frame"""
+        return state(self.at(step))
+
+    def nbytes(self):
+        import memory
+        return sum(len(frame) for frame in self.keyframes.values()) + sum(
+            memory.footprint(model) for model in self.states.values())
+
+    def growth(self, steps):
+        """Bytes the keyframes of steps more steps will add"""
+        if not self.keyframes:
+            return 0
+        frame = max(len(frame) for frame in self.keyframes.values())
+        return (steps // self.keyframe_every + 1) * frame
+
+    def describe(self):
+        return {'keyframe_every': self.keyframe_every, 'keyframes': sorted(self.keyframes),
+                'events': self.events, 'code_versions': len(self.code),
+                'cached_states': list(self.states), 'cache_hits': self.hits, 'cache_misses': self.misses,
+                'resimulated_steps': self.resimulated, 'bytes': self.nbytes()}
@@ -0,0 +1,511 @@
+'''
+Content-addressed cache of deterministic simulation results.
+
+A run is fully determined by (policy, population, start_up_required, patron,
+seed) plus the simulation source, including whatever custom policies and
+agent logic the policy registry currently holds. The per-step metric series and agent
+snapshots are stored on local disk under a hash of those inputs, so a repeat
+of the same configuration replays stored steps instead of simulating them.
+
+Each entry also keeps a pickled copy of the model at its last recorded step,
+so a run that outgrows its entry resumes from there rather than from step 0.
+On disk an entry is a small header (<key>.pkl: parameters, agent ids, that
+tail) and an append-only rows file (<key>.rows) of pickled row segments, so
+flushing a growing run writes only its new rows. A run whose entry would
+outgrow SIM_CACHE_MAX_BYTES stops being cached.
+
+Warm the cache at deploy time with:
+
+    python result_cache.py warm --steps 300
+'''
+
+import argparse
+import functools
+import hashlib
+import json
+import logging
+import os
+import pickle
+import threading
+
+import numpy as np
+
+import convergence
+import topology
+from exchanges import FlowWindow, edge_list
+from model import WealthModel, STATISTICS
+from policy_registry import registry
+from sketches import SKETCH_ALPHA
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.environ.get('SIM_CACHE_DIR', '.sim_cache')
+CACHE_MAX_BYTES = int(os.environ.get('SIM_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+# Runs larger than this are simulated live; their snapshots would crowd out the cache
+CACHE_MAX_POPULATION = int(os.environ.get('SIM_CACHE_MAX_POPULATION', 5000))
+# Write the entry back to disk every N newly simulated steps
+FLUSH_EVERY = 50
+# On-disk layout of an entry; headers of another format are dropped
+FORMAT = 2
+# Steps covered by the rolling money-flow aggregate (0 disables it)
+FLOW_WINDOW = int(os.environ.get('SIM_FLOW_WINDOW', 20))
+
+# Everything that can change the outcome of a seeded run
+SOURCE_FILES = ['model.py', 'agent.py', 'policyblocks.py', 'utilities.py', 'exchanges.py',
+                'policy_registry.py', 'compact_agents.py', 'topology.py', 'equilibrium.py', 'convergence.py',
+                'sketches.py']
+
+POLICIES = ["econophysics", "fascism", "communism", "capitalism", "comparison"]
+BRACKETS = ["Lower", "Middle", "Upper"]
+BRACKET_CODES = {name: code for code, name in enumerate(BRACKETS)}
+METRICS = ["Gini", "Total", "Mobility"]
+
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@functools.lru_cache(maxsize=None)
+def _source_digest():
+    """Hash of SOURCE_FILES, read once per process"""
+    digest = hashlib.sha256()
+    for name in SOURCE_FILES:
+        digest.update(name.encode())
+        try:
+            with open(os.path.join(_BASE_DIR, name), 'rb') as f:
+                digest.update(f.read())
+        except OSError:
+            pass
+    return digest.hexdigest()
+
+
+def code_hash():
+    """Hash of the simulation source, including registered user code"""
+    return hashlib.sha256((registry.source_hash() + _source_digest()).encode()).hexdigest()
+
+
+def run_key(policy, population, start_up_required, patron, seed, code=None, statistics=STATISTICS, network=None,
+            initial_state="fresh"):
+    """Content address of a single-policy run"""
+    params = {'policy': policy, 'population': int(population), 'start_up_required': int(start_up_required),
+              'patron': bool(patron), 'seed': seed, 'statistics': statistics}
+    if statistics == "approximate":
+        # Approximate brackets and Gini depend on the sketch's accuracy
+        params['sketch_alpha'] = SKETCH_ALPHA
+    if network is not None:
+        params['network'] = network
+    if initial_state != "fresh":
+        params['initial_state'] = initial_state
+    params = json.dumps(params, sort_keys=True)
+    code = code if code is not None else code_hash()
+    return hashlib.sha256((params + code).encode()).hexdigest()[:32]
+
+
+def snapshot(model):
+    """Metrics and per-agent state of a live WealthModel at its current step"""
+    metrics = model.metrics()
+    agents = list(model.agents)
+    return {
+        'metrics': np.array([metrics[name] for name in METRICS], dtype=float),
+        'wealth': np.array([a.wealth for a in agents], dtype=float),
+        'bracket': np.array([BRACKET_CODES.get(a.bracket, 1) for a in agents], dtype=np.int8),
+        'mobility': np.array([a.mobility for a in agents], dtype=float),
+        'edges': model.exchanges.as_array(),
+        'transitions': np.asarray(model.transitions, dtype=np.int64),
+    }
+
+
+class RunEntry:
+    """Recorded history of one run: a snapshot per step plus a resumable tail"""
+
+    def __init__(self, params, uids):
+        self.params = params
+        self.uids = uids
+        self.rows = []
+        self.tail = None          # pickled WealthModel at the last recorded step
+        self.stored_rows = 0      # rows already in the rows file
+        self.stored_bytes = 0     # and its size
+
+    @property
+    def steps(self):
+        return len(self.rows) - 1
+
+    def append(self, row):
+        self.rows.append(row)
+
+    def truncate(self, step):
+        del self.rows[step + 1:]
+        self.tail = None
+
+    def resume(self):
+        return pickle.loads(self.tail)
+
+    def nbytes(self):
+        return sum(arr.nbytes for row in self.rows for arr in row.values())
+
+
+class ResultCache:
+    """Bounded on-disk store of RunEntry objects with LRU eviction (by mtime)"""
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.pkl')
+
+    @staticmethod
+    def _rows_path(path):
+        return path[:-len('.pkl')] + '.rows'
+
+    def get(self, key):
+        path = self._path(key)
+        with self.lock:
+            try:
+                with open(path, 'rb') as f:
+                    header = pickle.load(f)
+            except FileNotFoundError:
+                return None
+            try:
+                if header['format'] != FORMAT:
+                    raise ValueError(f"format {header['format']}")
+                entry = RunEntry(header['params'], header['uids'])
+                entry.tail = header['tail']
+                # Segments past the header's count are from a flush that did not finish
+                with open(self._rows_path(path), 'rb') as f:
+                    while len(entry.rows) < header['rows']:
+                        entry.rows.extend(pickle.load(f))
+                del entry.rows[header['rows']:]
+                entry.stored_rows, entry.stored_bytes = header['rows'], header['row_bytes']
+                os.utime(path)  # mark as recently used
+                return entry
+            except Exception as e:
+                logger.warning(f"Dropping unreadable cache entry {key}: {e}")
+                self._remove(path)
+                return None
+
+    def put(self, key, entry):
+        '''
+        Appends the rows of entry not yet on disk as one segment and rewrites
+        the header. Returns False, writing nothing, if the entry would then
+        exceed max_bytes.
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        rows_path = self._rows_path(path)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with self.lock:
+            try:
+                size = os.path.getsize(rows_path)
+            except FileNotFoundError:
+                size = 0
+            if size < entry.stored_bytes:
+                # Evicted (or cleared) since it was read: write every row again
+                entry.stored_rows = entry.stored_bytes = 0
+            segment = pickle.dumps(entry.rows[entry.stored_rows:], protocol=pickle.HIGHEST_PROTOCOL)
+            row_bytes = entry.stored_bytes + len(segment)
+            header = pickle.dumps({'format': FORMAT, 'params': entry.params, 'uids': entry.uids, 'tail': entry.tail,
+                                   'rows': len(entry.rows), 'row_bytes': row_bytes},
+                                  protocol=pickle.HIGHEST_PROTOCOL)
+            if row_bytes + len(header) > self.max_bytes:
+                return False
+            with open(rows_path, 'r+b' if entry.stored_bytes else 'wb') as f:
+                f.seek(entry.stored_bytes)
+                f.truncate()
+                f.write(segment)
+            with open(tmp, 'wb') as f:
+                f.write(header)
+            os.replace(tmp, path)
+            entry.stored_rows, entry.stored_bytes = len(entry.rows), row_bytes
+            self._evict()
+        return True
+
+    def clear(self):
+        with self.lock:
+            for path in self._entries():
+                self._remove(path)
+
+    def _entries(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                if name.endswith('.pkl')]
+
+    def _evict(self):
+        entries = []
+        for path in self._entries():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            try:
+                rows = os.path.getsize(self._rows_path(path))
+            except FileNotFoundError:
+                rows = 0
+            entries.append((stat.st_mtime, stat.st_size + rows, path))
+        total = sum(size for _, size, _ in entries)
+        # Oldest access first; always keep the most recent entry
+        for _, size, path in sorted(entries)[:-1]:
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @classmethod
+    def _remove(cls, path):
+        for name in (path, cls._rows_path(path)):
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+
+
+class CachedRun:
+    """
+    Stands in for a single-policy WealthModel. Steps covered by the cache entry
+    are replayed from stored snapshots; past its end the run continues on a
+    live model and the new steps are recorded back into the entry.
+    """
+
+    converged_step = None
+
+    def __init__(self, cache, key, params, entry=None, flow_window=FLOW_WINDOW):
+        self.cache = cache
+        self.key = key
+        self.params = params
+        self.policy = params['policy']
+        self.population = params['population']
+        self.start_up_required = params['start_up_required']
+        self.patron = params['patron']
+        self.statistics = params['statistics']
+        self.network_spec = params.get('network')
+        self.initial_state = params.get('initial_state', "fresh")
+        self.cacheable = True
+        self.cursor = 0
+        self.live = None
+        # Live models record no per-agent history of their own; the entry rows hold it
+        if entry is None:
+            self.live = WealthModel(**params, agent_record_every=0)
+            entry = RunEntry(params, self.live.agent_uids)
+            entry.append(snapshot(self.live))
+        self.entry = entry
+        self._stored_steps = entry.steps if self.live is None else -1
+        # Fed from the recorded rows, so replayed and live steps aggregate alike
+        self.flows = FlowWindow(flow_window, self.population) if flow_window else None
+
+    @property
+    def steps(self):
+        return self.cursor
+
+    @property
+    def replaying(self):
+        return self.live is None
+
+    @property
+    def burn_in(self):
+        """The live model's burn-in description; None while replaying"""
+        return self.live.burn_in if self.live is not None else None
+
+    def step(self):
+        if self.live is None and self.cursor < self.entry.steps:
+            self.cursor += 1
+        else:
+            if self.live is None:
+                self.live = self.entry.resume()
+                self.live.set_agent_record_every(0)
+            self.live.step()
+            self.cursor += 1
+            self.entry.append(snapshot(self.live))
+            if self.cacheable and self.cursor % FLUSH_EVERY == 0:
+                self.flush()
+        if self.flows is not None:
+            row = self._row()
+            self.flows.update_edges(row['edges'], row['bracket'])
+
+    def run_until_converged(self, max_steps, **options):
+        convergence.run_until_converged(self, max_steps, **options)
+        return self.converged_step
+
+    def live_model(self):
+        """A live WealthModel at the current step, for forking (branches.py); this run does not step it"""
+        if self.live is not None:
+            return self.live
+        if self.cursor == self.entry.steps and self.entry.tail is not None:
+            return self.entry.resume()
+        logger.info(f"Re-simulating {self.policy} to step {self.cursor} to fork it")
+        model = WealthModel(**self.params, agent_record_every=0)
+        for _ in range(self.cursor):
+            model.step()
+        return model
+
+    def flush(self):
+        """Write newly simulated steps back to the cache"""
+        if not self.cacheable or self.live is None or self.entry.steps <= self._stored_steps:
+            return
+        self.entry.tail = pickle.dumps(self.live, protocol=pickle.HIGHEST_PROTOCOL)
+        if not self.cache.put(self.key, self.entry):
+            logger.info(f"Result cache entry for {self.policy} would exceed {self.cache.max_bytes} bytes; "
+                        f"no longer caching it")
+            self.cacheable = False
+            return
+        self._stored_steps = self.entry.steps
+
+    def detach(self):
+        """
+        Stop caching this run because its inputs changed (e.g. user code was
+        updated mid-run). A replaying run is rebuilt live up to the current
+        step under the code that is loaded now.
+        """
+        if not self.cacheable:
+            return
+        self.flush()
+        self.cacheable = False
+        self.entry.truncate(self.cursor)
+        if self.live is None:
+            self.live = WealthModel(**self.params, agent_record_every=0)
+            for _ in range(self.cursor):
+                self.live.step()
+
+    def set_agent_record_every(self, every):
+        """No-op: the per-agent history of a cached run is its entry's rows"""
+
+    # --- Data accessors (mirror WealthModel) ---
+    def _row(self):
+        return self.entry.rows[self.cursor]
+
+    def metrics(self):
+        return dict(zip(METRICS, self._row()['metrics'].tolist()))
+
+    def series(self, name):
+        if name == "Transitions":
+            return [row['transitions'].tolist() for row in self.entry.rows[1:self.cursor + 1]]
+        col = METRICS.index(name)
+        return [row['metrics'][col] for row in self.entry.rows[1:self.cursor + 1]]
+
+    def wealth_values(self):
+        return self._row()['wealth'].tolist()
+
+    def bracket_values(self):
+        return [BRACKETS[code] for code in self._row()['bracket']]
+
+    def agent_records(self):
+        row = self._row()
+        return [{'bracket': BRACKETS[code], 'mobility': mobility, 'wealth': wealth, 'policy': self.policy}
+                for code, mobility, wealth in zip(row['bracket'], row['mobility'].tolist(),
+                                                  row['wealth'].tolist())]
+
+    def exchange_edges(self):
+        return edge_list(self._row()['edges'], self.entry.uids)
+
+    def frame(self, step):
+        """The recorded state at step (up to the current step), in replay.state()'s form"""
+        row = self.entry.rows[step]
+        return {'metrics': dict(zip(METRICS, row['metrics'].tolist())), 'wealth': row['wealth'].tolist(),
+                'bracket': [BRACKETS[code] for code in row['bracket']], 'mobility': row['mobility'].tolist(),
+                'exchanges': edge_list(row['edges'], self.entry.uids)}
+
+    def flow_summary(self, top_k=10):
+        if self.flows is None:
+            return None
+        return self.flows.summary(self.entry.uids, top_k)
+
+
+# Shared process-wide cache
+default_cache = ResultCache()
+
+
+def open_run(policy="econophysics", population=100, start_up_required=1, patron=False, rng=42,
+             cache=None, flow_window=FLOW_WINDOW, statistics=None, cacheable=True, compact_agents=None,
+             agent_record_every=1, network=None, initial_state="fresh"):
+    """
+    Returns a model for the given configuration, replaying from the cache when
+    it holds a matching run. Comparison mode builds its four sub-models through
+    this function so each of them is cached individually.
+
+    cacheable=False always simulates live with the given compact_agents and
+    agent_record_every (memory.py's downscaled settings). network is a
+    topology spec; runs on edge-list files (or a given Network) are live.
+    """
+    cache = cache or default_cache
+    statistics = statistics or STATISTICS
+    if not isinstance(network, topology.Network):
+        network = topology.parse(network)
+        if network is not None and network['kind'] == "edge_list":
+            cacheable = False
+    if policy == "comparison":
+        return WealthModel(policy=policy, population=population, start_up_required=start_up_required,
+                           patron=patron, rng=rng, statistics=statistics, compact_agents=compact_agents,
+                           agent_record_every=agent_record_every, network=network, initial_state=initial_state,
+                           submodel_factory=lambda **kw: open_run(cache=cache, flow_window=flow_window,
+                                                                  cacheable=cacheable, **kw))
+    if not cacheable or population > CACHE_MAX_POPULATION or isinstance(network, topology.Network):
+        return WealthModel(policy=policy, population=population, start_up_required=start_up_required,
+                           patron=patron, rng=rng, flow_window=flow_window, statistics=statistics,
+                           compact_agents=compact_agents, agent_record_every=agent_record_every,
+                           network=network, initial_state=initial_state)
+    params = {'policy': policy, 'population': population, 'start_up_required': start_up_required,
+              'patron': patron, 'rng': rng, 'statistics': statistics}
+    if network is not None:
+        params['network'] = network
+    if initial_state != "fresh":
+        params['initial_state'] = initial_state
+    key = run_key(policy, population, start_up_required, patron, rng, statistics=statistics, network=network,
+                  initial_state=initial_state)
+    entry = cache.get(key)
+    if entry is not None:
+        logger.info(f"Result cache hit for {policy} (pop {population}, {entry.steps} steps)")
+    return CachedRun(cache, key, params, entry, flow_window=flow_window)
+
+
+def _sub_runs(model):
+    if getattr(model, 'policy', None) == "comparison":
+        return list(model.comparison_models.values())
+    return [model]
+
+
+def flush_run(model):
+    """Persist any newly simulated steps of model (or its comparison sub-models)"""
+    for run in _sub_runs(model):
+        if isinstance(run, CachedRun):
+            run.flush()
+
+
+def detach_run(model):
+    """Stop caching model because the code it runs has changed"""
+    for run in _sub_runs(model):
+        if isinstance(run, CachedRun):
+            run.detach()
+
+
+def warm(steps=300, population=100, start_up_required=1, patron=False, rng=42, policies=POLICIES,
+         cache=None, until_converged=False):
+    """
+    Precompute the default scenarios so first visitors get cache hits. With
+    until_converged, each scenario stops as soon as its metrics settle
+    (at most `steps` steps).
+    """
+    for policy in policies:
+        model = open_run(policy=policy, population=population, start_up_required=start_up_required,
+                         patron=patron, rng=rng, cache=cache)
+        if until_converged:
+            convergence.run_until_converged(model, steps)
+        else:
+            for _ in range(steps):
+                model.step()
+        flush_run(model)
+        logger.info(f"Warmed {policy}: {model.steps} steps"
+                    + (f", converged at step {model.converged_step}" if until_converged else ""))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['warm', 'clear'])
+    parser.add_argument('--steps', type=int, default=300)
+    parser.add_argument('--population', type=int, default=100)
+    parser.add_argument('--until-converged', action='store_true',
+                        help="stop each scenario once its metrics settle (--steps is the cap)")
+    args = parser.parse_args()
+    if args.command == 'clear':
+        default_cache.clear()
+    else:
+        warm(steps=args.steps, population=args.population, until_converged=args.until_converged)
@@ -9,19 +9,17 @@ import threading
 def run_server():
     """Run the Flask backend server"""
     # Import app and the setup functions
-    from app import app, init_gemini, setup_simulation
+    from app import app, setup_simulation
     
     print("=" * 60)
     print("Initializing Inequality Simulator Environment...")
     print("=" * 60)
     
-    # 1. SETUP SIMULATION (This runs reset_logic_internal)
-    # This guarantees we start with the original version (no user logic)
+    # SETUP SIMULATION (This runs reset_logic_internal)
+    # This guarantees we start with the original version (no user logic).
+    # The default model and the Gemini client load per STARTUP_MODE.
     setup_simulation()
     
-    # 2. Initialize RAG Engine
-    init_gemini()
-    
     print("\nBackend API will be available at: http://localhost:5000/api")
     print("Frontend will be available at: http://localhost:5000")
     print("\nPress Ctrl+C to stop the server")
@@ -0,0 +1,507 @@
+'''
+Sharded multi-process simulation for very large populations
+
+ShardedWealthModel splits the population into contiguous slices, one per
+worker process. All agent columns live in one multiprocessing.shared_memory
+block, so workers read the whole population but each writes only its own
+slice. A step runs the vectorized policy kernels (policyblocks
+execute_population) in phases:
+
+1. The parent reduces the global quantities the kernels need (brackets,
+   total, survival cost) from the previous step's result.
+2. Every shard runs the phase for its own agents in parallel. Payments to
+   agents in the same shard are applied at once. Payments to agents in other
+   shards are written, grouped by destination, into the shard's slice of a
+   shared outbox.
+3. At the barrier each shard applies the transfers addressed to it.
+4. After the last phase, shards update bracket history and metrics and sort
+   their wealth slice. The parent merges the sorted runs for Gini and the
+   next step's percentiles. With statistics="approximate" the shards send
+   a QuantileSketch of their slice instead (sketches.py): the parent merges
+   a few thousand bucket counts rather than sorting the whole population.
+
+Agents act simultaneously and do not spend payments received earlier in the
+step. Runs are reproducible for a given seed and shard count, and differ
+from single-process runs in their dynamics, not just draw for draw: at 2000
+agents over 50 steps (seed 3), Gini is within about 0.01, but econophysics
+Total is about 5x lower and fascism Mobility about 0.1 higher. Use them for
+scale, not to compare against single-process results.
+
+Only econophysics and fascism are supported. Simultaneous kernels cannot
+reproduce capitalism (no agent ever reaches the capital bar) or communism
+(it ends fully equal). Patron dynamics, comparison mode and custom step
+logic are not supported either.
+
+With an exchange network (topology.py) the parent builds the CSR adjacency
+once, into a shared memory block that every shard reads its agents'
+neighbours from.
+
+    python sharded.py --population 10000000 --steps 20
+'''
+
+import argparse
+import logging
+import multiprocessing
+import os
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import convergence
+from compact_agents import BRACKETS, BRACKET_CODES, HISTORY_LEN, PopulationArrays
+from model import draw_population, SURVIVAL_QUANTILE, STATISTICS, STATISTICS_MODES
+from policyblocks import WealthExchange, Fascism
+from sketches import QuantileSketch
+import topology
+from utilities import transition_matrix
+
+logger = logging.getLogger(__name__)
+
+SHARDS = int(os.environ.get('SIM_SHARDS', os.cpu_count() or 1))
+# Most payments one agent makes in a phase (survival, thrive, party tax)
+PAYMENTS_PER_AGENT = 3
+
+# Phases per policy: one barrier (transfer exchange) after each
+PHASES = {
+    "econophysics": ["exchange"],
+    "fascism": ["fascism"],
+}
+
+COLUMNS = [
+    ("wealth", np.float64, ()), ("W", np.float64, ()), ("I", np.float64, ()),
+    ("mobility", np.float64, ()), ("sorted_wealth", np.float64, ()),
+    ("bracket", np.int8, ()), ("previous", np.int8, ()), ("party_elite", np.bool_, ()),
+    ("innovating", np.bool_, ()), ("history_len", np.int8, ()), ("history", np.int8, (HISTORY_LEN,)),
+]
+
+
+def _layout(population):
+    """(name, dtype, shape, byte offset) for each column, and the total size"""
+    fields, offset = [], 0
+    for name, dtype, shape in COLUMNS:
+        fields.append((name, dtype, (population,) + shape, offset))
+        size = population * int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize
+        offset += -(-size // 8) * 8
+    return fields, offset
+
+
+def _attach_columns(buf, population):
+    fields, _ = _layout(population)
+    return {name: np.ndarray(shape, dtype=dtype, buffer=buf, offset=offset)
+            for name, dtype, shape, offset in fields}
+
+
+def _attach_outbox(buf, population):
+    capacity = PAYMENTS_PER_AGENT * population
+    receivers = np.ndarray((capacity,), dtype=np.int32, buffer=buf)
+    amounts = np.ndarray((capacity,), dtype=np.float64, buffer=buf, offset=capacity * 4)
+    return receivers, amounts
+
+
+def _attach_network(buf, population, entries, kind):
+    """topology.Network over a shared block holding indptr (int64) then its entries indices"""
+    indptr = np.ndarray((population + 1,), dtype=np.int64, buffer=buf)
+    indices = np.ndarray((entries,), dtype=topology.index_dtype(population), buffer=buf, offset=indptr.nbytes)
+    return topology.Network(indptr, indices, kind)
+
+
+def _split(population, shards):
+    return np.linspace(0, population, shards + 1).astype(np.int64)
+
+
+class ShardContext:
+    """The model attributes the policy kernels read, filled in by the parent each step"""
+
+    def __init__(self, policy, population, rng):
+        self.policy = policy
+        self.population = population
+        self.rng = rng
+        self.brackets = [0.0, 0.0]
+        self.total = 0.0
+        self.survival_cost = 1
+        self.exchanges = _NoExchanges()
+        self.network = None
+
+    def update(self, quantities):
+        for name, value in quantities.items():
+            setattr(self, name, value)
+
+
+class _NoExchanges:
+    # Exchange edges are not kept in sharded runs
+    def record_many(self, payer, receiver, amount, kind):
+        pass
+
+
+class ShardPopulation(PopulationArrays):
+    '''
+    PopulationArrays over the shared columns, restricted to one shard's slice.
+    credit() applies payments to local agents and queues the rest, by
+    destination shard, in this shard's region of the shared outbox.
+    '''
+
+    def __init__(self, context, columns, bounds, shard, outbox):
+        self.model = context
+        self.table = None
+        self.size = context.population
+        for name in ('wealth', 'W', 'I', 'mobility', 'bracket', 'previous', 'party_elite',
+                     'innovating', 'history', 'history_len'):
+            setattr(self, name, columns[name])
+        self.bounds = bounds
+        self.lo, self.hi = int(bounds[shard]), int(bounds[shard + 1])
+        self.mask = np.zeros(self.size, dtype=np.bool_)
+        self.mask[self.lo:self.hi] = True
+        start, stop = PAYMENTS_PER_AGENT * self.lo, PAYMENTS_PER_AGENT * self.hi
+        self.out_receivers = outbox[0][start:stop]
+        self.out_amounts = outbox[1][start:stop]
+        self.outbox_start = start
+        self.pending = []
+
+    def everyone(self):
+        return self.mask
+
+    def credit(self, receivers, amount):
+        amount = np.broadcast_to(amount, receivers.shape)
+        local = (receivers >= self.lo) & (receivers < self.hi)
+        np.add.at(self.wealth, receivers[local], amount[local])
+        if not local.all():
+            self.pending.append((receivers[~local], amount[~local]))
+
+    def flush_outbox(self):
+        """Writes queued transfers sorted by destination; returns per-shard [start, stop) offsets"""
+        shards = len(self.bounds) - 1
+        if self.pending:
+            receivers = np.concatenate([r for r, _ in self.pending])
+            amounts = np.concatenate([a for _, a in self.pending])
+        else:
+            receivers, amounts = np.zeros(0, dtype=np.int64), np.zeros(0)
+        self.pending = []
+        if len(receivers) > len(self.out_receivers):
+            raise RuntimeError("Shard outbox overflow: more than "
+                               f"{PAYMENTS_PER_AGENT} payments per agent in one phase")
+        destination = np.searchsorted(self.bounds, receivers, side="right") - 1
+        order = np.argsort(destination, kind="stable")
+        n = len(receivers)
+        self.out_receivers[:n] = receivers[order]
+        self.out_amounts[:n] = amounts[order]
+        counts = np.bincount(destination, minlength=shards)
+        offsets = self.outbox_start + np.concatenate([[0], np.cumsum(counts)])
+        return offsets.tolist()
+
+    def run_phase(self, phase):
+        mask = self.mask
+        if phase == "exchange":
+            WealthExchange().execute_population(self, mask)
+        elif phase == "fascism":
+            Fascism().execute_population(self, mask)
+            WealthExchange().execute_population(self, mask & ~self.party_elite)
+        else:
+            raise ValueError(f"Unknown phase {phase!r}")
+
+    def finish(self, approximate=False):
+        """
+        History, bracket and mobility for this slice. Summarizes its wealth for
+        the parent's reductions: sorted, or as a sketch when approximate.
+        """
+        self.update_history(self.mask)
+        self.calc_agent_metrics(self.mask)
+        lo, hi = self.lo, self.hi
+        wealth = self.wealth[lo:hi]
+        summary = QuantileSketch.from_values(wealth) if approximate else np.sort(wealth)
+        transitions = transition_matrix(self.previous[lo:hi], self.bracket[lo:hi])
+        return summary, float(wealth.sum()), float(self.mobility[lo:hi].sum()), transitions
+
+
+def _shard_main(conn, columns_name, outbox_name, population, bounds, shard, seed, policy, network=None):
+    columns_shm = shared_memory.SharedMemory(name=columns_name)
+    outbox_shm = shared_memory.SharedMemory(name=outbox_name)
+    columns = _attach_columns(columns_shm.buf, population)
+    outbox = _attach_outbox(outbox_shm.buf, population)
+    context = ShardContext(policy, population, np.random.default_rng(seed))
+    network_shm = None
+    if network is not None:
+        network_name, entries, kind = network
+        network_shm = shared_memory.SharedMemory(name=network_name)
+        context.network = _attach_network(network_shm.buf, population, entries, kind)
+    pop = ShardPopulation(context, columns, np.asarray(bounds), shard, outbox)
+    conn.send('ready')
+    try:
+        while True:
+            try:
+                message = conn.recv()
+            except EOFError:
+                break
+            if message is None:
+                break
+            command = message[0]
+            if command == 'phase':
+                _, phase, quantities, first = message
+                context.update(quantities)
+                if first:
+                    pop.previous[pop.lo:pop.hi] = pop.bracket[pop.lo:pop.hi]
+                pop.run_phase(phase)
+                conn.send(pop.flush_outbox())
+            elif command == 'apply':
+                # Transfers from other shards, in shard order
+                for start, stop in message[1]:
+                    np.add.at(pop.wealth, outbox[0][start:stop], outbox[1][start:stop])
+                conn.send(True)
+            elif command == 'finish':
+                _, quantities, approximate = message
+                context.update(quantities)
+                summary, wealth_sum, mobility_sum, transitions = pop.finish(approximate)
+                sketch = None
+                if approximate:
+                    sketch = summary
+                else:
+                    columns['sorted_wealth'][pop.lo:pop.hi] = summary
+                conn.send((wealth_sum, mobility_sum, transitions, sketch))
+    finally:
+        del pop, columns, outbox
+        context.network = None
+        columns_shm.close()
+        outbox_shm.close()
+        if network_shm is not None:
+            network_shm.close()
+
+
+class ShardedWealthModel:
+    '''
+    WealthModel run across worker processes. Same constructor arguments as
+    WealthModel plus `shards`, and the same data accessors (metrics, series,
+    wealth_values, bracket_values) as WealthModel and CachedRun. Call close()
+    (or use it as a context manager) to stop the workers and free the shared
+    memory.
+    '''
+
+    def __init__(self, policy="econophysics", population=100000, start_up_required=1, patron=False, rng=42,
+                 shards=SHARDS, statistics=None, network=None):
+        if policy not in PHASES:
+            raise ValueError(f"Sharded runs support {sorted(PHASES)}, not {policy!r}")
+        if patron:
+            raise ValueError("Patron dynamics need a global ranking each step; not supported in sharded runs")
+        if population >= 2**31:
+            raise ValueError("Sharded runs index agents with int32")
+        statistics = statistics or STATISTICS
+        if statistics not in STATISTICS_MODES:
+            raise ValueError(f"statistics must be one of {STATISTICS_MODES}, not {statistics!r}")
+        self.statistics = statistics
+        self.network_spec = topology.parse(network)
+        self.network = None
+        self.network_shm = None
+        # Merged shard sketches of the last step's wealth (approximate statistics)
+        self.sketch = None
+        self.policy = policy
+        self.population = population
+        self.start_up_required = start_up_required
+        self.patron = patron
+        self.seed = rng
+        self.shards = max(1, min(int(shards), population))
+        self.bounds = _split(population, self.shards)
+        self.steps = 0
+        self.converged_step = None
+        self.model_vars = {"Gini": [], "Total": [], "Mobility": [], "Transitions": []}
+        self.survival_cost = 1
+        self.workers = []
+
+        _, nbytes = _layout(population)
+        self.columns_shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        self.outbox_shm = shared_memory.SharedMemory(
+            create=True, size=PAYMENTS_PER_AGENT * population * (4 + 8))
+        try:
+            self.columns = _attach_columns(self.columns_shm.buf, population)
+            rng = np.random.default_rng(self.seed)
+            self._create_agents(rng)
+            if self.network_spec is not None:
+                self._build_network(rng)
+            self._start_workers()
+        except BaseException:
+            self.close()
+            raise
+
+    def _create_agents(self, rng):
+        # Same draws as WealthModel.create_agents for this seed
+        payday, innovation, party_elite = draw_population(rng, self.population)
+        c = self.columns
+        c['wealth'][:] = 1.0
+        c['W'][:] = payday
+        c['I'][:] = innovation
+        c['party_elite'][:] = party_elite
+        c['mobility'][:] = 0.0
+        c['innovating'][:] = False
+        c['sorted_wealth'][:] = 1.0
+        self.brackets = self._percentiles(c['sorted_wealth'])
+        wealth = c['wealth']
+        c['bracket'][:] = np.where(wealth < self.brackets[0], 0, np.where(wealth >= self.brackets[1], 2, 1))
+        c['previous'][:] = BRACKET_CODES["Middle"]
+        c['history'][:, 0] = c['bracket']
+        c['history_len'][:] = 1
+        self.total = float(wealth.sum())
+
+    def _build_network(self, rng):
+        # Same graph as WealthModel builds for this seed, copied into shared memory
+        built = topology.build(self.network_spec, self.population, rng)
+        self.network_shm = shared_memory.SharedMemory(create=True, size=max(built.nbytes, 1))
+        self.network = _attach_network(self.network_shm.buf, self.population, len(built.indices), built.kind)
+        self.network.indptr[:] = built.indptr
+        self.network.indices[:] = built.indices
+
+    def _start_workers(self):
+        ctx = multiprocessing.get_context('spawn')
+        seeds = np.random.SeedSequence(self.seed).spawn(self.shards)
+        network = None
+        if self.network is not None:
+            network = (self.network_shm.name, len(self.network.indices), self.network.kind)
+        for shard in range(self.shards):
+            parent_conn, child_conn = ctx.Pipe()
+            process = ctx.Process(target=_shard_main, daemon=True,
+                                  args=(child_conn, self.columns_shm.name, self.outbox_shm.name,
+                                        self.population, self.bounds.tolist(), shard, seeds[shard], self.policy,
+                                        network))
+            process.start()
+            child_conn.close()
+            self.workers.append((process, parent_conn))
+        for process, conn in self.workers:
+            if conn.recv() != 'ready':
+                raise RuntimeError("Shard worker failed to start")
+
+    def _broadcast(self, messages):
+        for (_, conn), message in zip(self.workers, messages):
+            conn.send(message)
+        return [conn.recv() for _, conn in self.workers]
+
+    @staticmethod
+    def _percentiles(sorted_wealth):
+        lower, upper = np.percentile(sorted_wealth, [33, 67])
+        return [float(lower), float(upper)]
+
+    # --- Global reductions (the parent's part of a step) ---
+    def _quantities(self):
+        if self.sketch is not None:
+            self.brackets = self.sketch.quantiles([0.33, 0.67])
+        else:
+            self.brackets = self._percentiles(self.columns['sorted_wealth'])
+        exp_scale = self.total / self.population
+        if exp_scale > 1:
+            self.survival_cost = -exp_scale * np.log1p(-SURVIVAL_QUANTILE)
+        return {'brackets': self.brackets, 'total': self.total, 'survival_cost': self.survival_cost}
+
+    def step(self):
+        quantities = self._quantities()
+        for i, phase in enumerate(PHASES[self.policy]):
+            offsets = self._broadcast([('phase', phase, quantities, i == 0)] * self.shards)
+            # Barrier: every shard applies what the others sent it
+            self._broadcast([('apply', [(offsets[src][dest], offsets[src][dest + 1])
+                                        for src in range(self.shards) if src != dest])
+                             for dest in range(self.shards)])
+        approximate = self.statistics == "approximate"
+        partials = self._broadcast([('finish', quantities, approximate)] * self.shards)
+
+        if approximate:
+            self.sketch = QuantileSketch.merged(sketch for _, _, _, sketch in partials)
+            gini = self.sketch.gini()
+        else:
+            # Merge the shards' sorted runs (stable sort is a k-way merge for presorted runs)
+            sorted_wealth = self.columns['sorted_wealth']
+            sorted_wealth.sort(kind="stable")
+            gini = _gini_sorted(sorted_wealth)
+        self.total = sum(wealth for wealth, _, _, _ in partials)
+        self.steps += 1
+        self.model_vars["Gini"].append(gini)
+        self.model_vars["Total"].append(self.total)
+        self.model_vars["Mobility"].append(sum(mobility for _, mobility, _, _ in partials) / self.population)
+        self.model_vars["Transitions"].append(sum(transitions for _, _, transitions, _ in partials).tolist())
+
+    def run_until_converged(self, max_steps, **options):
+        convergence.run_until_converged(self, max_steps, **options)
+        return self.converged_step
+
+    # --- Data accessors (as WealthModel / CachedRun) ---
+    def metrics(self):
+        if not self.steps:
+            return {"Gini": _gini_sorted(self.columns['sorted_wealth']), "Total": self.total,
+                    "Mobility": float(self.columns['mobility'].mean())}
+        return {name: self.model_vars[name][-1] for name in ("Gini", "Total", "Mobility")}
+
+    def series(self, name):
+        return list(self.model_vars.get(name, []))
+
+    def wealth_values(self):
+        return self.columns['wealth'].tolist()
+
+    def bracket_codes(self):
+        return self.columns['bracket'].astype(np.int64)
+
+    def bracket_values(self):
+        return [BRACKETS[code] for code in self.columns['bracket']]
+
+    def close(self):
+        for process, conn in self.workers:
+            try:
+                conn.send(None)
+            except (OSError, BrokenPipeError):
+                pass
+        for process, conn in self.workers:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.kill()
+            conn.close()
+        self.workers = []
+        self.columns = None
+        self.network = None
+        for shm in (getattr(self, 'columns_shm', None), getattr(self, 'outbox_shm', None),
+                    getattr(self, 'network_shm', None)):
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        self.columns_shm = self.outbox_shm = self.network_shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _gini_sorted(x):
+    """compute_gini for wealth already sorted ascending"""
+    n = len(x)
+    if n == 0:
+        return 0
+    total = x.sum()
+    B = np.dot(x, np.arange(n, 0, -1, dtype=np.float64)) / (n * total)
+    return float(1 + (1 / n) - 2 * B)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a sharded WealthModel")
+    parser.add_argument('--policy', default='econophysics', choices=sorted(PHASES))
+    parser.add_argument('--population', type=int, default=1000000)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--shards', type=int, default=SHARDS)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--statistics', default=STATISTICS, choices=STATISTICS_MODES)
+    parser.add_argument('--network', choices=topology.KINDS, help="exchange topology (default: well mixed)")
+    parser.add_argument('--network-degree', type=int, default=topology.DEGREE)
+    parser.add_argument('--network-rewire', type=float, default=topology.REWIRE)
+    parser.add_argument('--network-edges', help="edge list file for --network edge_list")
+    args = parser.parse_args()
+
+    network = None
+    if args.network:
+        network = {'kind': args.network, 'degree': args.network_degree, 'rewire': args.network_rewire,
+                   'path': args.network_edges}
+    started = time.perf_counter()
+    with ShardedWealthModel(args.policy, args.population, rng=args.seed, shards=args.shards,
+                            statistics=args.statistics, network=network) as model:
+        print(f"{args.population} agents on {model.shards} shards, "
+              f"set up in {time.perf_counter() - started:.1f}s")
+        if model.network is not None:
+            print(f"network: {model.network.describe()}")
+        for _ in range(args.steps):
+            started = time.perf_counter()
+            model.step()
+            metrics = model.metrics()
+            print(f"step {model.steps}: {time.perf_counter() - started:.2f}s  "
+                  f"gini={metrics['Gini']:.4f} total={metrics['Total']:.4g} mobility={metrics['Mobility']:.4f}")
@@ -0,0 +1,864 @@
+'''
+Simulation daemon shared by all web workers
+
+The running model and its what-if branches, the policy registry, the active
+policy and the background job queue all live in one Simulation object. app.py reaches it through
+backend():
+
+- SIM_DAEMON_SOCKET unset: the Simulation lives inside the web process, as
+  before. Run a single web worker.
+- SIM_DAEMON_SOCKET set: one daemon process (`python sim_daemon.py`,
+  started by gunicorn.conf.py) owns the Simulation and serves it on that
+  Unix-domain socket. Web workers are stateless, and every worker sees the
+  same model, so gunicorn can run as many as the traffic needs.
+
+Protocol: each message is one frame. A frame is a 7-byte header followed by
+a payload:
+
+- header: code (1 byte), status (2 bytes) and payload length (4 bytes),
+  big-endian
+- request: code is the command's opcode (OPCODES), status is 0, and the
+  payload is the JSON-encoded arguments
+- response: code echoes the opcode, status is the HTTP status, and the
+  payload is the JSON body (raw CSV/Arrow bytes for export_chunk)
+
+The daemon encodes each response body once, and the web worker returns
+those bytes unchanged. Nothing is pickled, so a client can only invoke
+these commands. The socket is created with mode 0600.
+
+Each web process has a DaemonClient that keeps up to SIM_DAEMON_POOL idle
+connections and reuses them across requests. If sending on a pooled
+connection fails because the daemon has closed it (for example after a
+daemon restart), the request is sent again on a fresh one. Once a request
+has been sent it is never repeated, since the daemon may already have run
+it.
+'''
+
+import argparse
+import inspect
+import json
+import logging
+import os
+import queue
+import signal
+import socket
+import socketserver
+import struct
+import threading
+import time
+import traceback
+from collections import deque
+
+import numpy as np
+
+import memory
+import startup
+import topology
+from branches import BranchSet, apply_changes
+from replay import ReplayLog
+from utilities import BRACKETS, churn_summary, transition_window
+
+logger = logging.getLogger(__name__)
+
+SOCKET_PATH = os.environ.get('SIM_DAEMON_SOCKET')
+POOL_SIZE = int(os.environ.get('SIM_DAEMON_POOL', 8))
+# Seconds a web worker waits for one command (run_until_converged can be long)
+DAEMON_TIMEOUT = float(os.environ.get('SIM_DAEMON_TIMEOUT', 600))
+MAX_FRAME = 1 << 30
+# Steps one /api/step or /api/run_until_converged request may run
+MAX_STEPS = 1000
+
+HEADER = struct.Struct('!BHI')
+COMMANDS = ('preload', 'initialize', 'step', 'run_until_converged', 'status', 'data', 'system_reset',
+            'reset_code', 'add_custom_policy', 'update_code', 'policies', 'get_active_policy',
+            'set_active_policy', 'submit_job', 'list_jobs', 'get_job', 'get_job_result', 'cancel_job',
+            'fork', 'list_branches', 'step_branch', 'delete_branch', 'compare_branches',
+            'export_plan', 'export_chunk', 'server_stats', 'memory_usage', 'control', 'at_step',
+            'replay_log', 'submit_chat', 'get_chat', 'cancel_chat')
+OPCODES = {name: code for code, name in enumerate(COMMANDS, 1)}
+DATA_KINDS = ('wealth-distribution', 'mobility', 'gini', 'total-wealth', 'transitions', 'exchanges', 'flows')
+
+
+class DaemonUnavailable(Exception):
+    pass
+
+
+class NumpyEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, np.ndarray): return obj.tolist()
+        if isinstance(obj, np.integer): return int(obj)
+        if isinstance(obj, np.floating): return float(obj)
+        return super().default(obj)
+
+
+def encode(data):
+    return json.dumps(data, cls=NumpyEncoder).encode()
+
+
+def simulation():
+    """The result_cache module; the first call imports model.py and mesa"""
+    import result_cache
+    return result_cache
+
+
+def _transitions(model, window):
+    series = model.series('Transitions')
+    return {'labels': BRACKETS, 'series': series,
+            'latest': churn_summary(series[-1]) if series else None,
+            'window': transition_window(series, window)}
+
+
+def _burn_in(model):
+    """The burn-in a run started from (per policy in comparison mode); None for fresh runs"""
+    if model.policy == "comparison":
+        return {policy: sub.burn_in for policy, sub in model.comparison_models.items()}
+    return model.burn_in
+
+
+class TimedLock:
+    """threading.Lock that records how long each acquisition waited (for loadtest.py)"""
+
+    def __init__(self, keep=10000):
+        self.lock = threading.Lock()
+        self.waits = deque(maxlen=keep)       # seconds, most recent acquisitions
+        self.acquisitions = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        wait = time.perf_counter() - start
+        self.acquisitions += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        self.waits.append(wait)
+        return self
+
+    def __exit__(self, *exc):
+        self.lock.release()
+
+    def stats(self):
+        waits = np.array(self.waits) * 1000
+        p50, p95, p99 = np.percentile(waits, [50, 95, 99]).tolist() if len(waits) else (0.0, 0.0, 0.0)
+        return {'acquisitions': self.acquisitions, 'wait_total_s': round(self.wait_total, 4),
+                'wait_max_ms': round(self.wait_max * 1000, 3), 'wait_p50_ms': round(p50, 3),
+                'wait_p95_ms': round(p95, 3), 'wait_p99_ms': round(p99, 3)}
+
+
+NOT_INITIALIZED = ({'error': 'Model not initialized'}, 400)
+UNKNOWN_JOB = ({'error': 'Unknown or expired job'}, 404)
+UNKNOWN_CHAT = ({'error': 'Unknown or expired chat task'}, 404)
+UNKNOWN_BRANCH = ({'error': 'Unknown branch'}, 404)
+
+
+class Simulation:
+    '''
+    Everything that must be shared by all web workers. Each command method
+    takes the request arguments and returns (body, HTTP status).
+    '''
+
+    def __init__(self):
+        self.model = None
+        # Bumped whenever self.model is replaced, so a paged export notices
+        self.generation = 0
+        self.branches = BranchSet()
+        # Keyframes and control events of the current run when it was initialized with replay (replay.py)
+        self.replay = None
+        self.lock = TimedLock()
+        # Set by the Blockly editor whenever the user clicks "Update Agent Logic"
+        self.active_policy = 'econophysics'
+
+    def call(self, command, **args):
+        """Runs a command; returns (HTTP status, body bytes: JSON, or the data of export_chunk)"""
+        method = getattr(self, command) if command in OPCODES else None
+        if method is None:
+            return 400, encode({'error': f'Unknown command {command!r}'})
+        try:
+            inspect.signature(method).bind(**args)
+        except TypeError as e:
+            return 400, encode({'error': f"{command}: {e}"})
+        try:
+            body, status = method(**args)
+        except Exception as e:
+            logger.error(f"Exception in {command}:\n" + traceback.format_exc())
+            body, status = {'error': str(e), 'traceback': traceback.format_exc()}, 500
+        return status, body if isinstance(body, bytes) else encode(body)
+
+    # --- Model ---
+    def preload(self):
+        """Builds the default model unless a user initialized one in the meantime"""
+        with startup.phase("import simulation (mesa, model)"):
+            sim = simulation()
+        with startup.phase("build default model"):
+            model = sim.open_run()
+        with self.lock:
+            if self.model is None:
+                self.model = model
+                self.generation += 1
+        logger.info("Default WealthModel initialized.")
+        return {'status': 'success'}, 200
+
+    def initialize(self, policy='econophysics', population=200, start_up_required=1, patron=False,
+                   statistics=None, network=None, replay=False, initial_state=None, **_):
+        # "exact" or "approximate" (sketch-based brackets and Gini); None = SIM_STATISTICS
+        if statistics not in (None, 'exact', 'approximate'):
+            return {'error': "statistics must be 'exact' or 'approximate'"}, 400
+        # Exchange topology (topology.py); None trades with anyone
+        try:
+            network = topology.parse(network, allow_files=False)
+        except ValueError as e:
+            return {'error': str(e)}, 400
+        # "fresh" or "equilibrium" (a burned-in population, equilibrium.py)
+        initial_state = initial_state or "fresh"
+        if initial_state not in ("fresh", "equilibrium"):
+            return {'error': "initial_state must be 'fresh' or 'equilibrium'"}, 400
+        policy = str(policy)
+        population = int(population)
+        replay = bool(replay)
+        if replay and policy == "comparison":
+            return {'error': 'Replay records single-policy runs; initialize one per policy'}, 400
+        with self.lock:
+            # The new run replaces the current one, so only the branches count against it
+            try:
+                settings = memory.admit_run(policy, population, in_use=self._memory_in_use(exclude=self.model),
+                                            network=network, replay=replay)
+            except ValueError as e:
+                return {'error': str(e)}, 400
+            except memory.MemoryBudgetError as e:
+                return e.body(), 413
+            if self.model is not None:
+                simulation().flush_run(self.model)
+            self.generation += 1
+            self.model = self.replay = None     # free the old run before building the new one
+            # Replays from the result cache when this configuration has run before
+            self.model = simulation().open_run(
+                policy=policy,
+                population=population,
+                start_up_required=int(start_up_required),
+                patron=bool(patron),
+                rng=42,
+                statistics=statistics,
+                cacheable=settings['cacheable'],
+                compact_agents=settings['compact_agents'],
+                agent_record_every=settings['agent_record_every'],
+                network=network,
+                initial_state=initial_state,
+            )
+            if replay:
+                self.replay = ReplayLog(self.model)
+            burn_in = _burn_in(self.model)
+        return {'status': 'initialized', 'policy': policy, 'network': network, 'replay': replay,
+                'initial_state': initial_state, 'burn_in': burn_in, 'memory': settings}, 200
+
+    def step(self, n=1):
+        try:
+            n = int(n)
+        except (TypeError, ValueError):
+            n = 0
+        if not 1 <= n <= MAX_STEPS:
+            return {'error': f"n must be between 1 and {MAX_STEPS}"}, 400
+        with self.lock:
+            if self.model is None: return NOT_INITIALIZED
+            try:
+                lowered = memory.admit_steps(self.model, n, in_use=self._memory_in_use(exclude=self.model)
+                                             + self._replay_growth(n))
+            except memory.MemoryBudgetError as e:
+                return e.body(), 413
+            # datacollector.collect is already called inside WealthModel.step()
+            for _ in range(n):
+                self.model.step()
+                if self.replay is not None:
+                    self.replay.record(self.model)
+            body = {'status': 'success', 'steps': self.model.steps}
+        if lowered is not None:
+            body['memory'] = {'agent_record_every': lowered}
+        return body, 200
+
+    def run_until_converged(self, max_steps=500, **data):
+        """Steps until Gini, growth and mobility stop drifting, or max_steps"""
+        options = {name: data[name] for name in ('window', 'tolerance', 'test') if name in data}
+        try:
+            max_steps = int(max_steps)
+        except (TypeError, ValueError):
+            max_steps = 0
+        if not 1 <= max_steps <= MAX_STEPS:
+            return {'error': f"max_steps must be between 1 and {MAX_STEPS}; "
+                             "submit longer runs to /api/jobs with until_converged"}, 400
+        with self.lock:
+            if self.model is None: return NOT_INITIALIZED
+            try:
+                memory.admit_steps(self.model, max_steps, in_use=self._memory_in_use(exclude=self.model)
+                                   + self._replay_growth(max_steps))
+            except memory.MemoryBudgetError as e:
+                return e.body(), 413
+            if self.replay is not None:
+                options['on_step'] = lambda steps: self.replay.record(self.model)
+            try:
+                self.model.run_until_converged(max_steps, **options)
+            except (TypeError, ValueError) as e:
+                return {'error': str(e)}, 400
+            return {'status': 'success', 'steps': self.model.steps,
+                    'converged_step': self.model.converged_step,
+                    'convergence': self.model.convergence}, 200
+
+    def status(self):
+        with self.lock:
+            if self.model is None: return {'initialized': False}, 200
+            return {'initialized': True, 'policy': self.model.policy, 'network': self.model.network_spec,
+                    'replay': self.replay is not None, 'initial_state': self.model.initial_state,
+                    'burn_in': _burn_in(self.model), 'converged_step': self.model.converged_step}, 200
+
+    def control(self, policy=None, patron=None, start_up_required=None):
+        """Changes the current run's policy or parameters from its next step on"""
+        with self.lock:
+            model = self.model
+            if model is None: return NOT_INITIALIZED
+            if model.policy == "comparison":
+                return {'error': 'Change a comparison run by forking one of its policies'}, 400
+            if isinstance(model, simulation().CachedRun):
+                # The cache key no longer describes the run; continue it live
+                model.detach()
+                target = model.live
+            else:
+                target = model
+            try:
+                changes = apply_changes(target, policy=policy, patron=patron,
+                                                 start_up_required=start_up_required)
+            except (TypeError, ValueError) as e:
+                return {'error': str(e)}, 400
+            if not changes:
+                return {'error': 'Nothing to change: give policy, patron or start_up_required'}, 400
+            if target is not model:
+                for name, value in changes.items():
+                    setattr(model, name, value)
+            if self.replay is not None:
+                self.replay.event(model, 'control', changes)
+            return {'status': 'success', 'step': model.steps, 'changes': changes}, 200
+
+    def at_step(self, step):
+        """Metrics, wealth, brackets, mobility and exchanges of the current run at a past step"""
+        try:
+            step = int(step)
+        except (TypeError, ValueError):
+            return {'error': 'step must be an integer'}, 400
+        with self.lock:
+            model = self.model
+            if model is None: return NOT_INITIALIZED
+            if not 0 <= step <= model.steps:
+                return {'error': f"step must be between 0 and {model.steps}"}, 404
+            if self.replay is not None:
+                return {'step': step, 'source': 'replay', 'current': self.replay.frame(step)}, 200
+            runs = model.comparison_models if model.policy == "comparison" else {'current': model}
+            cached = simulation().CachedRun
+            if not all(isinstance(run, cached) and step <= run.entry.steps for run in runs.values()):
+                return {'error': 'This run keeps no per-step history; initialize it with "replay": true'}, 409
+            body = {'step': step, 'source': 'cache'}
+            body.update({name: run.frame(step) for name, run in runs.items()})
+            return body, 200
+
+    def replay_log(self):
+        """Keyframes, control events and reconstruction cache of a replay run"""
+        with self.lock:
+            if self.model is None: return NOT_INITIALIZED
+            if self.replay is None:
+                return {'error': 'The current run was not initialized with "replay": true'}, 404
+            return self.replay.describe(), 200
+
+    def data(self, kind, window=20, top_k=10):
+        with self.lock:
+            model = self.model
+            if model is None: return NOT_INITIALIZED
+            comparison = model.policy == "comparison"
+            if kind == 'wealth-distribution':
+                if comparison:
+                    return {policy: data['final_wealth'] for policy, data in model.comparison_results.items()}, 200
+                return {'current': model.wealth_values()}, 200
+            if kind == 'mobility':
+                if comparison:
+                    return {policy: sub.agent_records() for policy, sub in model.comparison_models.items()}, 200
+                return model.agent_records(), 200
+            if kind in ('gini', 'total-wealth'):
+                column, series = ('gini', 'Gini') if kind == 'gini' else ('total', 'Total')
+                if comparison:
+                    return {policy: data[column] for policy, data in model.comparison_results.items()}, 200
+                return {'current': model.series(series)}, 200
+            if kind == 'transitions':
+                if comparison:
+                    return {policy: _transitions(sub, window) for policy, sub in model.comparison_models.items()}, 200
+                return {'current': _transitions(model, window)}, 200
+            if kind == 'exchanges':
+                edges = []
+                if comparison:
+                    for sub in model.comparison_models.values():
+                        edges.extend(sub.exchange_edges())
+                else:
+                    edges = model.exchange_edges()
+                # In network mode every edge joins neighbours in this topology
+                return {'edges': edges, 'network': model.network_spec}, 200
+            if kind == 'flows':
+                if comparison:
+                    return {policy: sub.flow_summary(top_k) for policy, sub in model.comparison_models.items()}, 200
+                summary = model.flow_summary(top_k)
+                if summary is None: return {'error': 'Flow aggregation disabled'}, 404
+                return {'current': summary}, 200
+        return {'error': f'Unknown data series {kind!r}'}, 404
+
+    # --- What-if branches (branches.py) ---
+    def fork(self, parent='current', name=None, policy=None, patron=None, start_up_required=None):
+        """Forks the current run (or a branch) at its current step"""
+        with self.lock:
+            if parent == 'current':
+                source = self.model
+                if source is None: return NOT_INITIALIZED
+            else:
+                branch = self.branches.get(parent)
+                if branch is None: return UNKNOWN_BRANCH
+                source = branch.model
+            try:
+                memory.check(memory.fork_bytes(source), in_use=self._memory_in_use(), what="A fork")
+            except memory.MemoryBudgetError as e:
+                return e.body(), 413
+            try:
+                branch = self.branches.fork(source, parent, name, policy=policy, patron=patron,
+                                            start_up_required=start_up_required)
+            except ValueError as e:
+                return {'error': str(e)}, 400
+            except OverflowError as e:
+                return {'error': str(e)}, 409
+            return branch.describe(), 201
+
+    def list_branches(self):
+        with self.lock:
+            current = None if self.model is None else {'policy': self.model.policy, 'steps': self.model.steps}
+            return {'current': current, 'branches': self.branches.list()}, 200
+
+    def step_branch(self, branch_id, steps=1):
+        with self.lock:
+            branch = self.branches.get(branch_id)
+            if branch is None: return UNKNOWN_BRANCH
+            try:
+                memory.admit_steps(branch.model, int(steps), in_use=self._memory_in_use(exclude=branch.model))
+            except memory.MemoryBudgetError as e:
+                return e.body(), 413
+            try:
+                branch = self.branches.step(branch_id, int(steps))
+            except ValueError as e:
+                return {'error': str(e)}, 400
+            return {**branch.describe(), 'metrics': branch.model.metrics()}, 200
+
+    def delete_branch(self, branch_id):
+        with self.lock:
+            branch = self.branches.remove(branch_id)
+            if branch is None: return UNKNOWN_BRANCH
+            return branch.describe(), 200
+
+    def compare_branches(self, series='Gini', ids=None):
+        with self.lock:
+            try:
+                return self.branches.compare(self.model, series, ids), 200
+            except ValueError as e:
+                return {'error': str(e)}, 400
+
+    # --- Export (export.py): planned once, then fetched chunk by chunk ---
+    def _export_source(self, branch=None, policy=None):
+        """The run to export (current, a branch, or a comparison sub-model), or an error response"""
+        if branch is not None:
+            found = self.branches.get(branch)
+            if found is None: return None, UNKNOWN_BRANCH
+            return found.model, None
+        if self.model is None: return None, NOT_INITIALIZED
+        if self.model.policy == "comparison":
+            if policy not in self.model.comparison_models:
+                return None, ({'error': f"Choose a policy: one of {list(self.model.comparison_models)}"}, 400)
+            return self.model.comparison_models[policy], None
+        return self.model, None
+
+    def _export_replay(self, model):
+        """The ReplayLog that rebuilds model's agent history, if it is the current replay run"""
+        return self.replay if model is self.model else None
+
+    def export_plan(self, branch=None, policy=None, **options):
+        import export
+        with self.lock:
+            model, error = self._export_source(branch, policy)
+            if error: return error
+            try:
+                plan = export.plan(model, replay=self._export_replay(model), **options)
+            except (TypeError, ValueError) as e:
+                return {'error': str(e)}, 400
+            plan.update(branch=branch, policy=policy, generation=self.generation, run_policy=model.policy)
+            return plan, 200
+
+    def export_chunk(self, plan, index):
+        import export
+        with self.lock:
+            if plan['generation'] != self.generation:
+                return {'error': 'The run was replaced during the export'}, 409
+            model, error = self._export_source(plan['branch'], plan['policy'])
+            if error: return error
+            return export.chunk(model, plan, int(index), self._export_replay(model)), 200
+
+    # --- Memory (memory.py) ---
+    def _memory_in_use(self, exclude=None):
+        """Accounted bytes of the current run and the branches, except exclude (callers hold the lock)"""
+        models = [self.model] + [branch.model for branch in self.branches.branches.values()]
+        in_use = sum(memory.footprint(model) for model in models if model is not None and model is not exclude)
+        if self.replay is not None and exclude is not self.model:
+            in_use += self.replay.nbytes()
+        return in_use
+
+    def _replay_growth(self, steps):
+        return self.replay.growth(steps) if self.replay is not None else 0
+
+    def memory_usage(self):
+        """Accounted and measured footprint of every model, against the budget"""
+        with self.lock:
+            return {'budget_bytes': memory.BUDGET_BYTES, 'horizon_steps': memory.HORIZON_STEPS,
+                    'in_use_bytes': self._memory_in_use(), 'rss_bytes': memory.rss_bytes(),
+                    'current': memory.report(self.model),
+                    'replay_bytes': self.replay.nbytes() if self.replay is not None else 0,
+                    'branches': {branch.id: memory.report(branch.model)
+                                 for branch in self.branches.branches.values()}}, 200
+
+    def server_stats(self):
+        """Lock contention and CPU time of the process that runs the simulation"""
+        return {'pid': os.getpid(), 'cpu_s': round(time.process_time(), 3), 'lock': self.lock.stats()}, 200
+
+    # --- Policy registry ---
+    # Callers hold self.lock from _code_changed through the registry update to
+    # _code_event, so no step runs on the new code before the replay event
+    def _code_changed(self):
+        """The running model no longer matches its cache key once user code changes"""
+        if self.model is not None:
+            simulation().detach_run(self.model)
+
+    def _code_event(self):
+        """A replay run re-simulates later steps with the code loaded now"""
+        if self.replay is not None:
+            self.replay.event(self.model, 'code')
+
+    def system_reset(self):
+        from policy_registry import registry
+        with self.lock:
+            registry.reset()
+            if self.model is not None:
+                simulation().flush_run(self.model)
+            self.model = self.replay = None
+            self.generation += 1
+            self.branches.clear()
+        return {'status': 'success', 'message': 'System reset complete'}, 200
+
+    def reset_code(self):
+        from policy_registry import registry
+        with self.lock:
+            self._code_changed()
+            registry.reset()
+            self._code_event()
+        return {'status': 'success', 'message': 'Logic reset to default.'}, 200
+
+    def add_custom_policy(self, code=''):
+        from policy_registry import registry
+        if not code: return {'error': 'No code provided'}, 400
+        with self.lock:
+            self._code_changed()
+            try:
+                entry = registry.register_policy(code)
+            except (SyntaxError, ValueError) as e:
+                return {'error': f"{type(e).__name__}: {e}"}, 400
+            self._code_event()
+        return {'status': 'success', 'message': 'Policy added.', 'policy': entry.describe()}, 200
+
+    def update_code(self, code=None):
+        from policy_registry import registry
+        if not code: return {'error': 'No code provided'}, 400
+        with self.lock:
+            self._code_changed()
+            try:
+                registry.set_step_logic(code)
+            except (SyntaxError, ValueError) as e:
+                return {'error': f"{type(e).__name__}: {e}"}, 400
+            self._code_event()
+        return {'status': 'success', 'message': 'Logic updated!'}, 200
+
+    def policies(self):
+        from policy_registry import registry
+        return registry.describe(), 200
+
+    def get_active_policy(self):
+        return {'policy': self.active_policy}, 200
+
+    def set_active_policy(self, policy='econophysics'):
+        policy = str(policy).strip()
+        if policy:
+            self.active_policy = policy
+        return {'status': 'success', 'policy': self.active_policy}, 200
+
+    # --- Background jobs (jobs.py) ---
+    def submit_job(self, **data):
+        import jobs
+        try:
+            kind, params, work = jobs.job_spec(data)
+        except (TypeError, ValueError) as e:
+            return {'error': str(e)}, 400
+        except memory.MemoryBudgetError as e:
+            return e.body(), 413
+        try:
+            job = jobs.get_queue().submit(kind, params, work, priority=data.get('priority'))
+        except jobs.QueueFull as e:
+            return {'error': str(e)}, 429
+        return job.describe(), 202
+
+    def list_jobs(self):
+        import jobs
+        job_queue = jobs.get_queue()
+        return {'jobs': job_queue.list(), 'stats': job_queue.stats()}, 200
+
+    def get_job(self, job_id):
+        import jobs
+        job = jobs.get_queue().get(job_id)
+        if job is None: return UNKNOWN_JOB
+        return job.describe(), 200
+
+    def get_job_result(self, job_id):
+        import jobs
+        job = jobs.get_queue().get(job_id)
+        if job is None: return UNKNOWN_JOB
+        if job.status != jobs.DONE:
+            return {'error': f'Job is {job.status}', 'job': job.describe()}, 409
+        return {'job': job.describe(), 'result': job.result}, 200
+
+    def cancel_job(self, job_id):
+        import jobs
+        job = jobs.get_queue().cancel(job_id)
+        if job is None: return UNKNOWN_JOB
+        return job.describe(), 200
+
+    # --- AI policy generation (chat_tasks.py) ---
+    def submit_chat(self, message='', fanout=None):
+        import chat_tasks
+        if not isinstance(message, str) or not message.strip():
+            return {'error': 'No message provided'}, 400
+        try:
+            task = chat_tasks.get_tasks().submit(message, fanout)
+        except (TypeError, ValueError):
+            return {'error': 'fanout must be an integer'}, 400
+        except chat_tasks.QueueFull as e:
+            return {'error': str(e)}, 429
+        return task.describe(), 200 if task.status == chat_tasks.DONE else 202
+
+    def get_chat(self, task_id):
+        import chat_tasks
+        task = chat_tasks.get_tasks().get(task_id)
+        if task is None: return UNKNOWN_CHAT
+        return task.describe(), 200
+
+    def cancel_chat(self, task_id):
+        import chat_tasks
+        task = chat_tasks.get_tasks().cancel(task_id)
+        if task is None: return UNKNOWN_CHAT
+        return task.describe(), 200
+
+
+# --- Framing ---
+def send_frame(sock, code, status, payload):
+    sock.sendall(HEADER.pack(code, status, len(payload)))
+    sock.sendall(payload)
+
+
+def read_frame(rfile):
+    """(code, status, payload) of the next frame, or None at a clean end of stream"""
+    header = rfile.read(HEADER.size)
+    if not header:
+        return None
+    if len(header) < HEADER.size:
+        raise ConnectionError("Truncated frame header")
+    code, status, length = HEADER.unpack(header)
+    if length > MAX_FRAME:
+        raise ConnectionError(f"Frame of {length} bytes exceeds the limit")
+    payload = rfile.read(length)
+    if len(payload) < length:
+        raise ConnectionError("Truncated frame payload")
+    return code, status, payload
+
+
+# --- Daemon side ---
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        sim = self.server.simulation
+        while True:
+            try:
+                frame = read_frame(self.rfile)
+            except (ConnectionError, OSError) as e:
+                logger.warning(f"Dropping daemon connection: {e}")
+                return
+            if frame is None:
+                return
+            code, _, payload = frame
+            if not 1 <= code <= len(COMMANDS):
+                status, body = 400, encode({'error': f'Unknown opcode {code}'})
+            else:
+                try:
+                    args = json.loads(payload) if payload else {}
+                except ValueError:
+                    args = None
+                if isinstance(args, dict):
+                    status, body = sim.call(COMMANDS[code - 1], **args)
+                else:
+                    status, body = 400, encode({'error': 'Arguments must be a JSON object'})
+            try:
+                send_frame(self.connection, code, status, body)
+            except OSError:
+                return
+
+
+class DaemonServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, simulation):
+        self.simulation = simulation
+        super().__init__(path, _Handler)
+
+
+def _remove_stale_socket(path):
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except OSError:
+        os.unlink(path)           # left behind by a daemon that died
+    else:
+        raise RuntimeError(f"A simulation daemon is already listening on {path}")
+    finally:
+        probe.close()
+
+
+def serve(path=SOCKET_PATH):
+    if not path:
+        raise SystemExit("Set SIM_DAEMON_SOCKET (or pass --socket) to the Unix socket path to serve on")
+    sim = Simulation()
+    _remove_stale_socket(path)
+    old_umask = os.umask(0o177)   # socket file mode 0600
+    try:
+        server = DaemonServer(path, sim)
+    finally:
+        os.umask(old_umask)
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    startup.in_background("preload-default-model", sim.preload)
+    logger.info(f"Simulation daemon listening on {path}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.unlink(path)
+        import jobs
+        if jobs._queue is not None:
+            jobs._queue.close()
+        import chat_tasks
+        if chat_tasks._tasks is not None:
+            chat_tasks._tasks.close()
+        logger.info("Simulation daemon stopped")
+
+
+# --- Web side ---
+class DaemonClient:
+    '''
+    Connection pool to the daemon for one web process. call() has the same
+    signature and result as Simulation.call().
+    '''
+
+    def __init__(self, path=SOCKET_PATH, size=POOL_SIZE, timeout=DAEMON_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self.idle = queue.LifoQueue(maxsize=size)
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except OSError as e:
+            sock.close()
+            raise DaemonUnavailable(f"Simulation daemon unavailable at {self.path}: {e}") from e
+        return sock, sock.makefile('rb')
+
+    def _acquire(self):
+        try:
+            return self.idle.get_nowait(), True
+        except queue.Empty:
+            return self._connect(), False
+
+    def _release(self, conn):
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            self._close(conn)
+
+    @staticmethod
+    def _close(conn):
+        sock, rfile = conn
+        rfile.close()
+        sock.close()
+
+    def call(self, command, **args):
+        code = OPCODES[command]
+        payload = json.dumps(args, separators=(',', ':')).encode()
+        while True:
+            conn, reused = self._acquire()
+            try:
+                send_frame(conn[0], code, 0, payload)
+            except socket.timeout as e:
+                self._close(conn)
+                raise DaemonUnavailable(f"Simulation daemon did not accept {command} within {self.timeout:.0f}s") from e
+            except (ConnectionError, OSError) as e:
+                self._close(conn)
+                if reused:
+                    continue          # stale pooled connection; nothing was sent, retry on a fresh one
+                raise DaemonUnavailable(f"Lost the simulation daemon connection: {e}") from e
+            break
+        # The command may have run by now, so it is not retried past this point
+        try:
+            frame = read_frame(conn[1])
+        except socket.timeout as e:
+            self._close(conn)
+            raise DaemonUnavailable(f"Simulation daemon did not answer {command} within {self.timeout:.0f}s") from e
+        except (ConnectionError, OSError) as e:
+            self._close(conn)
+            raise DaemonUnavailable(f"Lost the simulation daemon connection: {e}") from e
+        if frame is None:
+            self._close(conn)
+            raise DaemonUnavailable("Simulation daemon closed the connection")
+        self._release(conn)
+        return frame[1], frame[2]
+
+    def close(self):
+        while True:
+            try:
+                self._close(self.idle.get_nowait())
+            except queue.Empty:
+                return
+
+
+_backend = None
+_backend_pid = None
+_backend_lock = threading.Lock()
+
+
+def backend():
+    """This process's Simulation (no daemon) or DaemonClient (SIM_DAEMON_SOCKET set)"""
+    global _backend, _backend_pid
+    with _backend_lock:
+        # A forked web worker must not share its parent's sockets
+        if _backend is None or (SOCKET_PATH and _backend_pid != os.getpid()):
+            _backend = DaemonClient() if SOCKET_PATH else Simulation()
+            _backend_pid = os.getpid()
+        return _backend
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Serve the shared simulation over a Unix socket")
+    parser.add_argument('--socket', default=SOCKET_PATH, help="Socket path (default: $SIM_DAEMON_SOCKET)")
+    serve(parser.parse_args().socket)
@@ -0,0 +1,53 @@
+'''
+Startup timing and deferred initialization helpers
+
+phase(name) records how long a block of startup work took; report() returns
+the breakdown (also served at /api/startup) so cold-start regressions show up
+in logs. For a per-module view run: python -X importtime -c "import app"
+'''
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+PROCESS_START = time.perf_counter()
+PHASES = []           # (name, seconds, thread name)
+_lock = threading.Lock()
+
+
+@contextmanager
+def phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            PHASES.append((name, elapsed, threading.current_thread().name))
+        logger.info(f"[startup] {name}: {elapsed * 1000:.0f} ms")
+
+
+def report():
+    with _lock:
+        phases = list(PHASES)
+    return {
+        'phases': [{'name': name, 'ms': round(seconds * 1000, 1), 'thread': thread}
+                   for name, seconds, thread in phases],
+        'since_start_ms': round((time.perf_counter() - PROCESS_START) * 1000, 1),
+    }
+
+
+def in_background(name, target):
+    """Runs target() in a daemon thread, timed as a startup phase"""
+    def run():
+        try:
+            with phase(name):
+                target()
+        except Exception:
+            logger.exception(f"[startup] {name} failed")
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    return thread
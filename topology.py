@@ -0,0 +1,209 @@
+'''
+Exchange network topologies for the wealth inequality model
+
+By default every agent trades with partners drawn uniformly from the whole
+population (well mixed). With a network, WealthExchange and Patron draw
+partners only from the agent's neighbours in an undirected graph:
+
+- "ring": ring lattice, each agent linked to degree/2 agents on either side
+- "small_world": the ring with each link rewired to a random agent with
+  probability rewire (Watts-Strogatz)
+- "scale_free": preferential attachment, each new agent linking to degree/2
+  existing ones (Barabasi-Albert)
+- "edge_list": edges read from a file of "source target" lines (or an .npy
+  array of shape (edges, 2)) over agent indices 0..population-1
+
+The graph is stored as CSR adjacency (indptr: offsets per agent, indices:
+neighbours), so memory is linear in edges and a neighbour draw is O(1).
+Graphs are built from the model's seeded generator with vectorized NumPy,
+so a run stays reproducible and millions of agents build in seconds.
+Self-loops are dropped; repeated edges are kept and weight the draw. An
+agent with no neighbours draws itself, which the exchange treats like any
+other self-draw.
+'''
+
+import os
+
+import numpy as np
+
+KINDS = ("ring", "small_world", "scale_free", "edge_list")
+# Mean degree of the generated graphs
+DEGREE = int(os.environ.get('SIM_NETWORK_DEGREE', 10))
+# Probability that a small-world link is rewired
+REWIRE = float(os.environ.get('SIM_NETWORK_REWIRE', 0.1))
+
+
+def parse(spec, allow_files=True):
+    '''
+    Canonical form of a network spec: None (well mixed), or a dict with
+    'kind' plus 'degree' and 'rewire' (generated graphs) or 'path'
+    (edge_list). spec may be a kind name or a dict. Raises ValueError.
+    Web requests pass allow_files=False: they must not name server files.
+    '''
+    if spec is None or spec in ("", "none", "well_mixed"):
+        return None
+    if isinstance(spec, str):
+        spec = {'kind': spec}
+    if not isinstance(spec, dict):
+        raise ValueError("network must be a kind name or an object with 'kind'")
+    kind = spec.get('kind')
+    if kind not in KINDS:
+        raise ValueError(f"network kind must be one of {KINDS}, not {kind!r}")
+    if kind == "edge_list":
+        if not allow_files:
+            raise ValueError("edge_list networks can only be loaded from Python or the command line")
+        if not spec.get('path'):
+            raise ValueError("An edge_list network needs a 'path'")
+        return {'kind': kind, 'path': str(spec['path'])}
+    try:
+        degree = int(spec.get('degree', DEGREE))
+        rewire = float(spec.get('rewire', REWIRE))
+    except (TypeError, ValueError):
+        raise ValueError("network degree must be an integer and rewire a number")
+    if degree < 2:
+        raise ValueError("network degree must be at least 2")
+    if not 0 <= rewire <= 1:
+        raise ValueError("network rewire must be between 0 and 1")
+    parsed = {'kind': kind, 'degree': degree}
+    if kind == "small_world":
+        parsed['rewire'] = rewire
+    return parsed
+
+
+def index_dtype(population):
+    return np.int32 if population < 2**31 else np.int64
+
+
+class Network:
+    '''
+    Undirected graph over agent indices as CSR adjacency: the neighbours of
+    agent i are indices[indptr[i]:indptr[i + 1]].
+    '''
+
+    def __init__(self, indptr, indices, kind="custom"):
+        self.indptr = indptr
+        self.indices = indices
+        self.kind = kind
+        self.size = len(indptr) - 1
+
+    @classmethod
+    def from_edges(cls, source, target, population, kind="custom"):
+        """Builds the adjacency of undirected edges source[i] - target[i]"""
+        source = np.asarray(source)
+        target = np.asarray(target)
+        if len(source) and (min(source.min(), target.min()) < 0 or max(source.max(), target.max()) >= population):
+            raise ValueError(f"Network edges must join agents 0..{population - 1}")
+        keep = source != target
+        dtype = index_dtype(population)
+        ends = np.concatenate([source[keep], target[keep]]).astype(dtype, copy=False)
+        others = np.concatenate([target[keep], source[keep]]).astype(dtype, copy=False)
+        del keep
+        order = np.argsort(ends, kind="stable")
+        indptr = np.zeros(population + 1, dtype=np.int64)
+        np.cumsum(np.bincount(ends, minlength=population), out=indptr[1:])
+        return cls(indptr, others[order], kind)
+
+    def degree(self):
+        return np.diff(self.indptr)
+
+    def neighbours(self, i):
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def sample(self, i, random):
+        """A random neighbour of agent i, drawn from random (a random.Random)"""
+        start = int(self.indptr[i])
+        degree = int(self.indptr[i + 1]) - start
+        if degree == 0:
+            return i
+        return int(self.indices[start + random.randrange(degree)])
+
+    def sample_many(self, agents, rng):
+        """A random neighbour for each agent in the index array agents, drawn from rng"""
+        start = self.indptr[agents]
+        degree = self.indptr[agents + 1] - start
+        if len(self.indices) == 0:
+            return np.asarray(agents, dtype=np.int64).copy()
+        offset = (rng.random(len(agents)) * degree).astype(np.int64)
+        picks = self.indices[np.minimum(start + offset, len(self.indices) - 1)]
+        return np.where(degree > 0, picks, agents)
+
+    @property
+    def nbytes(self):
+        return self.indptr.nbytes + self.indices.nbytes
+
+    def describe(self):
+        degree = self.degree()
+        return {'kind': self.kind, 'agents': int(self.size), 'edges': int(len(self.indices) // 2),
+                'mean_degree': float(degree.mean()) if self.size else 0.0,
+                'max_degree': int(degree.max()) if self.size else 0,
+                'isolated': int((degree == 0).sum()), 'bytes': int(self.nbytes)}
+
+
+# --- Generators ---
+def ring(population, degree):
+    half = max(1, min(degree // 2, (population - 1) // 2))
+    dtype = index_dtype(population)
+    source = np.repeat(np.arange(population, dtype=dtype), half)
+    target = (source.astype(np.int64) + np.tile(np.arange(1, half + 1), population)) % population
+    return source, target.astype(dtype)
+
+
+def small_world(population, degree, rewire, rng):
+    source, target = ring(population, degree)
+    rewired = rng.random(len(target)) < rewire
+    target[rewired] = rng.integers(0, population, int(rewired.sum()))
+    return source, target
+
+
+def scale_free(population, degree, rng):
+    '''
+    Preferential attachment by the Batagelj-Brandes method. Edge e joins
+    agent e // m to the agent at a uniformly random earlier position of the
+    flat list of edge endpoints, so agents are picked in proportion to their
+    degree. Positions that land on a target are resolved by following the
+    earlier draws; each hop moves strictly back, so a few passes settle all
+    of them.
+    '''
+    m = max(1, degree // 2)
+    edges = np.arange(population * m, dtype=np.int64)
+    # Endpoint 2e is the source of edge e, 2e + 1 its target
+    draws = (rng.random(len(edges)) * (2 * edges + 1)).astype(np.int64)
+    position = draws.copy()
+    pending = np.flatnonzero(position % 2 == 1)
+    while len(pending):
+        position[pending] = draws[position[pending] // 2]
+        pending = pending[position[pending] % 2 == 1]
+    dtype = index_dtype(population)
+    return (edges // m).astype(dtype), (position // 2 // m).astype(dtype)
+
+
+def read_edges(path):
+    if path.endswith('.npy'):
+        edges = np.load(path)
+    else:
+        edges = np.loadtxt(path, dtype=np.int64, comments='#', usecols=(0, 1), ndmin=2)
+    if edges.ndim != 2 or edges.shape[1] != 2:
+        raise ValueError(f"{path}: expected two agent indices per edge")
+    return edges[:, 0], edges[:, 1]
+
+
+def build(spec, population, rng):
+    """The Network for a parse()d spec over population agents, drawn from rng"""
+    kind = spec['kind']
+    if kind == "ring":
+        source, target = ring(population, spec['degree'])
+    elif kind == "small_world":
+        source, target = small_world(population, spec['degree'], spec['rewire'], rng)
+    elif kind == "scale_free":
+        source, target = scale_free(population, spec['degree'], rng)
+    else:
+        source, target = read_edges(spec['path'])
+    return Network.from_edges(source, target, population, kind)
+
+
+def estimate_bytes(spec, population):
+    """Approximate size of the built Network (memory.py); 0 for edge lists, whose size is unknown"""
+    if spec is None or spec['kind'] == "edge_list":
+        return 0
+    half = max(1, spec['degree'] // 2)
+    return 8 * (population + 1) + 2 * half * population * np.dtype(index_dtype(population)).itemsize
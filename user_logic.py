@@ -1,4 +0,0 @@
-HAS_CUSTOM_LOGIC = False
-
-def step(self):
-    pass
@@ -46,8 +46,28 @@ def calculate_bartholomew_mobility(agent):
         # Ensure the ratio is between 0 and 1
         return max(0.0, min(1.0, mobility_ratio))
 
+def bartholomew_mobility_array(history, lengths):
+        """
+        calculate_bartholomew_mobility for many agents at once.
+        history: (n, k) bracket codes, left-aligned; lengths: entries used per row
+        """
+        history = np.asarray(history, dtype=np.int64)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        changes = np.abs(np.diff(history, axis=1))
+        steps = lengths - 1
+        valid = np.arange(changes.shape[1]) < steps[:, None]
+        total = (changes * valid).sum(axis=1)
+        mobility = np.where(steps > 0, total / np.maximum(steps, 1) / 2.0, 0.0)
+        return np.clip(mobility, 0.0, 1.0)
+
 def calc_brackets(model): 
-        wealth_data = [agent.wealth for agent in model.agents]
+        if getattr(model, "statistics", "exact") == "approximate":
+            # Sketch quantiles: within SIM_SKETCH_ALPHA relative error, no full-population percentile
+            if not model.population:
+                return [0, 0]
+            return model.wealth_sketch().quantiles([0.33, 0.67])
+
+        wealth_data = model.agent_values("wealth")
 
         # If there's no wealth data, return default brackets
         if not wealth_data:
@@ -60,32 +80,45 @@ def calc_brackets(model):
         return [lower_bracket, upper_bracket]
 
 
-#Helper function for churn
+#Helper functions for bracket transitions and churn
+
+BRACKETS = ["Lower", "Middle", "Upper"]
+
+def transition_matrix(previous, current):
+        """
+        3x3 counts of agents by bracket code at the start (rows) and end
+        (columns) of a step: one bincount over previous*3 + current
+        """
+        codes = np.asarray(previous, dtype=np.int64) * 3 + np.asarray(current, dtype=np.int64)
+        return np.bincount(codes, minlength=9).reshape(3, 3)
+
+def churn_summary(matrix):
+        """Up/down moves, churn rate and bracket counts derived from a transition matrix"""
+        matrix = np.asarray(matrix, dtype=np.int64)
+        population = int(matrix.sum())
+        moving_up = int(np.triu(matrix, 1).sum())
+        moving_down = int(np.tril(matrix, -1).sum())
+        # Row-normalized: probability of ending in each bracket given the starting one
+        starting = matrix.sum(axis=1, keepdims=True)
+        probabilities = np.divide(matrix, starting, out=np.zeros(matrix.shape), where=starting > 0)
+        return {
+            'moving_up': moving_up,
+            'moving_down': moving_down,
+            'churn': (moving_up + moving_down) / population if population else 0.0,
+            'counts': dict(zip(BRACKETS, matrix.sum(axis=0).tolist())),
+            'previous_counts': dict(zip(BRACKETS, matrix.sum(axis=1).tolist())),
+            'probabilities': probabilities.tolist(),
+        }
+
+def transition_window(series, window):
+        """Aggregate of the last `window` per-step transition matrices"""
+        recent = series[-window:] if window else series
+        matrix = np.sum(recent, axis=0, dtype=np.int64) if recent else np.zeros((3, 3), dtype=np.int64)
+        summary = churn_summary(matrix)
+        summary.update({'steps': len(recent), 'matrix': matrix.tolist()})
+        return summary
 
 def calculate_churn(model): 
-    moving_up = 0
-    moving_down = 0
-
-    for agent in model.agents: 
-        if agent.previous != agent.bracket: 
-            if agent.previous == "Middle":
-                if agent.bracket == "Upper":
-                    moving_up += 1
-                elif agent.bracket == "Lower":
-                    moving_down += 1
-            if agent.previous == "Upper":
-                if agent.bracket == "Middle" or agent.bracket == "Lower": 
-                    moving_down += 1
-            if agent.previous == "Lower":
-                if agent.bracket == "Upper" or agent.bracket == "Middle":
-                    moving_up += 1
-    totals = model.agents.groupby("bracket").count()
-    if "Upper" not in totals:
-        totals["Upper"] = 0
-    if "Middle" not in totals:
-        totals["Middle"]=0
-    if "Lower" not in totals: 
-        totals["Lower"]=0
-    return [moving_up, moving_down, totals]
-                                        
-    
\ No newline at end of file
+    """[moving_up, moving_down, bracket counts] over the model's last step"""
+    summary = churn_summary(model.transitions)
+    return [summary['moving_up'], summary['moving_down'], summary['counts']]